@@ -1,155 +1,118 @@
-import os
-import json
-import requests
-import sqlite3
-from datetime import datetime
+import sys
 
-def get_fire_dep_data():
-    base_url = "https://data.lacity.org/resource/n44u-wxe4.json"
-    response = requests.get(base_url, params={"$where": "on_scene_time_gmt IS NOT NULL"})
+import numpy as np
 
-    try:
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
-        if data:
-            try:
-                with open("LA_data.json", "r") as json_file:
-                    existing_data = json.load(json_file)
-            except (FileNotFoundError, json.decoder.JSONDecodeError):
-                existing_data = []
-            # Append only the relevant entries to existing data
-            existing_data.extend(data)
-            with open("LA_data.json", "w") as json_file:
-                json.dump(existing_data, json_file, indent=4)
-                print("Data appended to LA_data.json file.")
-        else:
-            print("No data received from the API.")
-    except requests.exceptions.HTTPError as err:
-        print("HTTP error occurred:", err)
-    except json.decoder.JSONDecodeError as err:
-        print("Error decoding JSON response:", err)
-
-def set_up_database(db_name):
-    path = os.getcwd()  # Get the current working directory
-    conn = sqlite3.connect(os.path.join(path, db_name))  # Use os.path.join to construct the file path
-    cur = conn.cursor()
-    return cur, conn
-
-def create_first_table(cur, conn):
-    cur.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS "LA_Fires" (
-            "Fire_id" INTEGER PRIMARY KEY, 
-            "Time" TEXT, 
-            "Response_time" FLOAT
-        )
-        '''
-    )
-    conn.commit()
-
-def insert_data_to_fires_table(cur, conn, json_data):
-    batch_size = 25 
-    total_entries = 0 
-
-    for i in range(0, min(len(json_data), 100), batch_size):  # Process up to 100 entries
-        batch = json_data[i:i+batch_size]  # Slice the data into batches of 25 or less
-
-        data_buffer = [] 
-
-        for data in batch:
-            try:
-                if "on_scene_time_gmt" in data and "incident_creation_time_gmt" in data:
-                    incident_creation_time = datetime.strptime(data["incident_creation_time_gmt"], "%H:%M:%S.%f")
-                    on_scene_time = datetime.strptime(data["on_scene_time_gmt"], "%H:%M:%S.%f")
-
-                    Time = incident_creation_time.strftime("%H:%M")
-                    Response_time = (on_scene_time - incident_creation_time).total_seconds() / 60
-                    Response_time = round(Response_time, 2) 
-
-                    data_buffer.append((Time, Response_time))
-                    total_entries += 1  
-
-            except KeyError as e:
-                print("KeyError:", e, "Skipping this data entry.")
-            except ValueError as e:
-                print("ValueError:", e, "Skipping this data entry. Likely incorrect time format.")
-
-        # Insert data from the buffer into the table
-        cur.executemany(
-            '''
-            INSERT INTO LA_Fires (Time, Response_time) 
-            VALUES (?, ?)
-            ''',
-            data_buffer
-        )
-        conn.commit()
-
-        # Check if total entries processed is equal to or exceeds 100
-        if total_entries >= 100:
-            break  # Break the loop if 100 entries have been processed
-
-def calculate_avg_response_time_per_period(cur, conn):
-    try:
-        sql_query = '''
-            SELECT 
-                CASE 
-                    WHEN Time BETWEEN '00:00' AND '01:59' THEN '00:00 - 01:59'
-                    WHEN Time BETWEEN '02:00' AND '03:59' THEN '02:00 - 03:59'
-                    WHEN Time BETWEEN '04:00' AND '05:59' THEN '04:00 - 05:59'
-                    WHEN Time BETWEEN '06:00' AND '07:59' THEN '06:00 - 07:59'
-                    WHEN Time BETWEEN '08:00' AND '09:59' THEN '08:00 - 09:59'
-                    WHEN Time BETWEEN '10:00' AND '11:59' THEN '10:00 - 11:59'
-                    WHEN Time BETWEEN '12:00' AND '13:59' THEN '12:00 - 13:59'
-                    WHEN Time BETWEEN '14:00' AND '15:59' THEN '14:00 - 15:59'
-                    WHEN Time BETWEEN '16:00' AND '17:59' THEN '16:00 - 17:59'
-                    WHEN Time BETWEEN '18:00' AND '19:59' THEN '18:00 - 19:59'
-                    WHEN Time BETWEEN '20:00' AND '21:59' THEN '20:00 - 21:59'
-                    WHEN Time BETWEEN '22:00' AND '23:59' THEN '22:00 - 23:59'
-                    ELSE 'Unknown'
-                END AS period,
-                AVG(Response_time) AS avg_response_time
-            FROM LA_Fires
-            GROUP BY period;
-        '''
-        cur.execute(sql_query)
-
-        avg_response_times_per_period = cur.fetchall()
-
-        periods = []
-        avg_response_times = []
-
-        with open("calculations.txt", 'a') as f:  # Append to the file
-            f.write("\nAverage response time per 2-hour period in LA:\n")
-            for row in avg_response_times_per_period:
-                period, avg_response_time = row
-                periods.append(period)
-                avg_response_times.append(avg_response_time)
-                f.write(f"{period}: {avg_response_time:.2f} minutes\n")
-
-        print("Average response time per 2-hour period calculated and written to calculations.txt.")
-        return periods, avg_response_times
-    except Exception as e:
-        print("An error occurred while calculating the average response time per period:", e)
-        return None, None
+import metrics
+from charts import city_charts, render_charts
+from fire_time import MICROSECONDS_PER_DAY, SECONDS_PER_DAY, clock_microseconds, clock_microseconds_array, day_numbers_array, epoch_from_date
+from ingest import SourceAdapter, calculate_avg_response_time_per_period, fetch_source, load_source, set_up_database
+from ingest import insert_data_to_fires_table as insert_source_data
+from pipeline import BATCH_SIZE, transform_batch
+from results import export_calculations_txt
 
-def main():
-    try:
-        cur, conn = set_up_database("fire_data.db")  
-        create_first_table(cur, conn)
-        
-        get_fire_dep_data()
+LA_STORE = "LA_data.ndjson"  # end the name in .gz or .zst to compress the raw store
 
-        with open("LA_data.json", "r") as json_file:
-            LA_data = json.load(json_file)
+# each incident has one row per responding unit, so the unit's dispatch sequence is part of the ID
+def la_incident_id(data):
+    if "randomized_incident_number" not in data:
+        return None
+    return f"{data['randomized_incident_number']}:{data.get('dispatch_sequence', '')}"
 
-        insert_data_to_fires_table(cur, conn, LA_data) 
-        calculate_avg_response_time_per_period(cur, conn)
+# LAFD unit responses, only the ones that made it on scene
+class LASource(SourceAdapter):
+    city = "LA"
+    base_url = "https://data.lacity.org/resource/n44u-wxe4.json"
+    store = LA_STORE
+    date_field = "incident_date"
+    skip_reasons = {"ValueError": "Likely incorrect time format."}
+    filtered_reason = "missing on scene time"
+
+    def params(self):
+        return {"$where": "on_scene_time_gmt IS NOT NULL"}
+
+    def incident_id(self, data):
+        return la_incident_id(data)
+
+    # response time is on scene time minus the time the incident was created
+    # an on scene time earlier in the day than the creation time was after midnight, on the next day
+    def times(self, data):
+        if "on_scene_time_gmt" not in data or "incident_creation_time_gmt" not in data:
+            return None
+
+        incident_creation_time = clock_microseconds(data["incident_creation_time_gmt"])
+        on_scene_time = clock_microseconds(data["on_scene_time_gmt"])
+
+        seconds_of_day = incident_creation_time // 1000000
+        Epoch = epoch_from_date(data["incident_date"], seconds_of_day) if "incident_date" in data else None
+        Minute_of_day = seconds_of_day // 60
+        Response_time = (on_scene_time - incident_creation_time) % MICROSECONDS_PER_DAY / 60000000
+        return Epoch, Minute_of_day, Response_time
+
+    # same rows as transform, but the times of the whole batch are parsed at once with NumPy
+    # records the fast parser can't read go through transform one by one
+    def transform_batch(self, batch, skipped):
+        records = [data for data in batch if "on_scene_time_gmt" in data and "incident_creation_time_gmt" in data]
+        if len(records) < len(batch):
+            skipped[self.filtered_reason] = skipped.get(self.filtered_reason, 0) + len(batch) - len(records)
+        if not records:
+            return []
+        try:
+            created, created_ok = clock_microseconds_array([data["incident_creation_time_gmt"] for data in records])
+            on_scene, on_scene_ok = clock_microseconds_array([data["on_scene_time_gmt"] for data in records])
+            days, days_ok = day_numbers_array([data.get("incident_date", "") for data in records])
+        except UnicodeEncodeError:
+            return transform_batch(records, self.transform, skipped, self.filtered_reason)
+
+        has_date = np.array(["incident_date" in data for data in records], dtype=bool)
+        fast = (created_ok & on_scene_ok & (days_ok | ~has_date)).tolist()
+        seconds_of_day = created // 1000000
+        epochs = (days * SECONDS_PER_DAY + seconds_of_day).tolist()
+        minutes = (seconds_of_day // 60).tolist()
+        response_times = ((on_scene - created) % MICROSECONDS_PER_DAY / 60000000).tolist()
+        has_date = has_date.tolist()
+
+        rows = []
+        for i, data in enumerate(records):
+            if not fast[i]:
+                rows.extend(transform_batch([data], self.transform, skipped, self.filtered_reason))
+                continue
+            rows.append({
+                "City": self.city,
+                "Incident_id": la_incident_id(data),
+                "Epoch": epochs[i] if has_date[i] else None,
+                "Minute_of_day": minutes[i],
+                "Response_time": round(response_times[i], 2),
+                "Borough": None,
+            })
+        return rows
+
+# streams every record into Fire_Incidents as an LA fire, batch_size rows per transaction
+# an incident that is already in the table gets updated instead of added twice
+def insert_data_to_fires_table(cur, conn, json_data, batch_size=BATCH_SIZE):
+    return insert_source_data(LASource(), cur, conn, json_data, batch_size)
 
-        conn.close()
+def main():
+    try:
+        # every stage is recorded in metrics/<run_id>.json, see metrics.py
+        with metrics.run("LA") as run_id, metrics.labels(city="LA"):
+            source = LASource()
+            cur, conn = set_up_database("fire_data.db")
+
+            # loads every LOAD_EVERY rows while the rest downloads
+            fetch_source(source, cur, conn, lambda: load_source(source, cur, conn))
+            # what the fetch stored after its last load, skips what was already loaded by an earlier run
+            load_source(source, cur, conn)
+
+            calculate_avg_response_time_per_period(cur, conn, "LA", run_id)
+            with metrics.stage("export"):
+                export_calculations_txt(cur)
+            with metrics.stage("render"):
+                render_charts(cur, conn, city_charts(cur, "LA"))
+
+            conn.close()
     except Exception as e:
         print("An error has occurred:", e)
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
-
-
@@ -1,374 +1,198 @@
-import sqlite3
-import json
-import os
-import requests
-from datetime import datetime
-import matplotlib.pyplot as plt
+import sys
 
+import metrics
+from cache import bump_data_version
+from charts import city_charts, render_charts
+from fire_time import parse_timestamp
+from ingest import SourceAdapter, calculate_avg_response_time_per_period, fetch_source, load_source, set_up_database
+from ingest import insert_data_to_fires_table as insert_source_data
+from pipeline import BATCH_SIZE, batched, transform_batch
+from results import FIRES_PER_BOROUGH, export_calculations_txt, save_results
+from rollups import rollup_fires_per_borough
 
-'''In this File we will get the data from one of our API's and save it into a Json and then a shared data base.
+
+'''In this File we will get the data from one of our API's and save it into a raw store and then a shared data base.
     we want to see how the response times for fire between the LAFD and NYCFD differ during similar times in the day.
     How does the time of day influence the response time for these fire departments?
     Additionally we want to see if certain neighborhoods in NYC have more fires on average.
-    It's important to note that the data set is only 100 points and any correlations should be evaluated with caution. 
-
-    we want to create three tables. One table will be for Structural fires in NYC, another will assign ID numbers to neighborhoods in New York and the third assigns these neighborhood ID's to Fire ID's in NYC. 
-    Each table will have 100 entries
+    There is no cap on the number of fires: the API is read page by page into the NYC_data.ndjson raw store and the
+    new records are streamed from there into the data base a batch at a time, so we use every fire the API has.
+
+    The fires go into the Fire_Incidents table shared with LA (City is 'NYC'). Each row has the incident ID, the time
+    the call was made (Epoch and Minute_of_day) and a response time in minutes (resonse time is how long it took for
+    first responders to arrive to the scene from when the call was made).
+    The neighborhood_ID table assigns ID numbers to neighborhoods in New York and Fire_Neighborhood_Relationship
+    assigns these neighborhood ID's to the fires.
     We will not be including forest fires in our data set.
-    The NYC_Fires table will have an ID for the fire, a response time in minutes (resonse time is how long it took for first responders to arrive
-    to the scene from when the call was made), and the time that the call was made. 
 '''
 
-#pulls from APi and creats a Json with all the data about structural fires
-def get_fire_data(classification_group):
-    '''
-    creates API request
-    creates json with all the data from request 
-    '''
-    base_url = "https://data.cityofnewyork.us/resource/8m42-w767.json"
-    response = requests.get(base_url, params= {"incident_classification_group": classification_group})
-
-    if response.status_code == 200:
-        data = response.json()
- 
-        try:
-            with open("NYC_data.json", "r") as json_file:
-                existing_data = json.load(json_file)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            existing_data = []
- 
-        existing_data.append(data)
- 
-        with open("NYC_data.json", "w") as json_file:
-            json.dump(existing_data, json_file, indent=4)
-            print("Data appended to NYC_data.json file.")
-    else:
-        print("Failed to retrieve data from the API. Status code:", response.status_code)
-
-
-#create Database
-#pulls data from APi and puts it into database
-#using code from Discussion 12
-def set_up_database(db_name):
-    path = os.path.dirname(os.path.abspath(__file__))
-    conn = sqlite3.connect(path + "/" + db_name)
-    cur = conn.cursor()
-
-    # Drop existing tables if they exist
-    cur.execute("DROP TABLE IF EXISTS NYC_Fires")
-    cur.execute("DROP TABLE IF EXISTS neighborhood_ID")
-    cur.execute("DROP TABLE IF EXISTS Fire_Neighborhood_Relationship")
-    conn.commit()
-
-    return cur, conn
-
-#create table for structural fires in NYC 
-#calculate response time based on first on scene and incident time 
-#save processed table 
-def create_first_nyc_table(cur, conn):
-    cur.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS "NYC_Fires" (
-            "Fire_id" INTEGER PRIMARY KEY, 
-            "Date" TEXT,
-            "Time" TEXT, 
-            "Response_time" FLOAT
-        )
-        '''
-    )
-    conn.commit()
+NYC_STORE = "NYC_data.ndjson"  # end the name in .gz or .zst to compress the raw store
 
-def create_neighborhood_table(cur, conn):
-    cur.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS "neighborhood_ID" (
-            "Neighborhood_ID" INTEGER PRIMARY KEY AUTOINCREMENT, 
-            "Neighborhood" TEXT
-        )
-        '''
-    )
-    conn.commit()
 
-def create_fire_neighborhood_relationship_table(cur, conn):
-    cur.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS Fire_Neighborhood_Relationship (
-            Fire_ID INTEGER,
-            Neighborhood_ID INTEGER,
-            FOREIGN KEY(Fire_ID) REFERENCES NYC_Fires(Fire_ID),
-            FOREIGN KEY(Neighborhood_ID) REFERENCES Neighborhoods(Neighborhood_ID)
-        )
-        '''
-    )
-    conn.commit()
+#the incident ID is what we dedupe the raw store on
+def nyc_incident_id(data):
+    return data.get("starfire_incident_id")
 
 
-def insert_data_to_fires_table(cur, conn, json_data):
-    batch_size = 25
-    total_entries = 0  # initializes total entries processed
+#pulls from APi: FDNY incidents of one classification group (structural fires for us)
+#the fetching and loading itself is done by ingest.py, the same way for every city
+class NYCSource(SourceAdapter):
+    city = "NYC"
+    base_url = "https://data.cityofnewyork.us/resource/8m42-w767.json"
+    store = NYC_STORE
+    date_field = "first_activation_datetime"
+    filtered_reason = "invalid response indicator"
 
-    for i in range(0, 101, batch_size):
-        batch = json_data[i:i + batch_size]  # slices data into batches of 25 or less
+    def __init__(self, classification_group="Structural Fires"):
+        self.classification_group = classification_group
 
-        processed_data = []  # stores batch data
+    def params(self):
+        return {"incident_classification_group": self.classification_group}
 
-        for inner_list in batch:
-            for data in inner_list:
-                try:
-                    if data.get("valid_incident_rspns_time_indc") == "Y":
-                        Date = data["first_activation_datetime"].split("T")[0]
-                        Time = data["first_activation_datetime"].split("T")[1][:5]
-                        Response_time = round(float(data["incident_response_seconds_qy"]) / 60, 2)
+    def incident_id(self, data):
+        return nyc_incident_id(data)
 
-                        processed_data.append((Date, Time, Response_time))
-                        total_entries += 1
-                        #print(total_entries)
+    #None if the incident has no valid response time
+    def times(self, data):
+        if data.get("valid_incident_rspns_time_indc") != "Y":
+            return None
 
-                        if total_entries >= 100:
-                            break  # Break the loop if 100 entries have been processed
+        Epoch, Minute_of_day = parse_timestamp(data["first_activation_datetime"])
+        Response_time = float(data["incident_response_seconds_qy"]) / 60
+        return Epoch, Minute_of_day, Response_time
 
-            
-                except KeyError as e:
-                    print("Key Error:", e, "Skipping this data entry.")
-        
-            if total_entries >= 100:
-                break  # Break the loop if 100 entries have been processed
-        
-        cur.executemany(
-            '''
-            INSERT INTO NYC_Fires (Date, Time, Response_time) 
-            VALUES (?, ?, ?)
-            ''',
-            processed_data
-        )
-
-        conn.commit()  # Commit the transaction
+    def borough(self, data):
+        return data.get("incident_borough")
 
-        if total_entries >= 100:
-                break  # Break the loop if 100 entries have been processed
+    #links the new fires to their neighborhood
+    def after_load(self, cur, conn, records, batch_size):
+        insert_data_to_neighborhood_table(cur, conn, records, batch_size)
 
-    
-#insert into Neighborhood table and relationship table
-def insert_data_to_neighborhood_table(cur, conn, json_data):
-    batch_size = 25
-    total_entries = 0  # initializes total entries processed
-    fire_id = 1  # initialize fire ID
-
-    neighborhoods_set = set()  # store unique neighborhoods
-
-    for i in range(4):  # Loop 4 times
-        print("Loading batch of 25 entries...")  # Print batch loading message
-
-        # Process each entry in the JSON data
-        for inner_list in json_data:
-            for data in inner_list:
-                try:
-                    if data.get("valid_incident_rspns_time_indc") == "Y":
-                        neighborhood = data["incident_borough"]
-
-                        # Check if the neighborhood already exists in the neighborhood_ID table
-                        cur.execute(
-                            '''
-                            SELECT Neighborhood_ID FROM neighborhood_ID WHERE Neighborhood = ?
-                            ''',
-                            (neighborhood,)
-                        )
-                        existing_neighborhood = cur.fetchone()
-
-                        if existing_neighborhood is None:
-                            # Insert neighborhoods into the neighborhood_ID table
-                            cur.execute(
-                                '''
-                                INSERT INTO neighborhood_ID (Neighborhood) 
-                                VALUES (?)
-                                ''',
-                                (neighborhood,)
-                            )
-
-                        # retrieve the Neighborhood_ID of the inserted neighborhood
-                        cur.execute(
-                            '''
-                            SELECT Neighborhood_ID FROM neighborhood_ID WHERE Neighborhood = ?                                
-                            ''',
-                            (neighborhood,)
-                        )
-                        neighborhood_id = cur.fetchone()[0]
-
-                        # Insert the relationship into the Fire_Neighborhood_Relationship table
-                        cur.execute(
-                            '''
-                            INSERT INTO Fire_Neighborhood_Relationship (Fire_ID, Neighborhood_ID) 
-                            VALUES (?, ?)
-                            ''',
-                            (fire_id, neighborhood_id)
-                        )
-
-                    total_entries += 1
-                    fire_id += 1
-
-                    if total_entries  >= 100:
-                        break  # Break the loop if 25 entries have been processed
-
-                except KeyError as e:
-                    print("Key Error:", e, "Skipping this data entry.")
-                except Exception as ex:
-                    print("Error occurred:", ex)  # Log any other exceptions
-
-        conn.commit()  # Commit the transaction
 
-        if total_entries >= 100:
-            break  # Break the loop if 100 entries have been processed
+#streams every record into Fire_Incidents as an NYC fire, batch_size rows per transaction
+#an incident that is already in the table gets updated instead of added twice
+def insert_data_to_fires_table(cur, conn, json_data, batch_size=BATCH_SIZE):
+    return insert_source_data(NYCSource(), cur, conn, json_data, batch_size)
 
+    
+#pairs a raw NYC record with its borough, None if it never made it into Fire_Incidents
+def nyc_fire_borough(data):
+    if data.get("valid_incident_rspns_time_indc") != "Y":
+        return None
 
+    incident_id = nyc_incident_id(data)
+    if incident_id is None:
+        return None  # can't be matched to its NYC_Fires row
+    return (incident_id, data["incident_borough"])
 
-#step 2 Calculate something from the data
-def calculate_avg_fires_per_neighborhood(cur, conn):
-    try:
-        cur.execute('''
-            SELECT neighborhood_ID.Neighborhood, COUNT(NYC_Fires.Fire_id) AS num_fires
-            FROM neighborhood_ID
-            LEFT JOIN Fire_Neighborhood_Relationship ON neighborhood_ID.Neighborhood_ID = Fire_Neighborhood_Relationship.Neighborhood_ID
-            LEFT JOIN NYC_Fires ON Fire_Neighborhood_Relationship.Fire_ID = NYC_Fires.Fire_id
-            GROUP BY neighborhood_ID.Neighborhood
-        ''')
-
-        avg_fires_per_neighborhood = cur.fetchall()
-
-        with open("calculations.txt", 'w') as f:
-            f.write("Average number of fires per neighborhood:\n")
-            for neighborhood, num_fires in avg_fires_per_neighborhood:
-                f.write(f"{neighborhood}: {num_fires}\n")
-
-        print("Average number of fires per neighborhood calculated and written to calculations.txt.")
-    except Exception as e:
-        print("An error occurred while calculating the average number of fires per neighborhood:", e)
 
+#looks up the Neighborhood_ID of every borough, adding the ones we have not seen yet
+def get_neighborhood_ids(cur, boroughs, neighborhood_ids):
+    '''
+    neighborhood_ids is the borough -> Neighborhood_ID cache, only boroughs missing from it hit the database
+    '''
+    missing = sorted(set(boroughs) - neighborhood_ids.keys())
+    if not missing:
+        return
 
-#function that calculates average response time for 2 hour time periods for fires in NYC 
-def calculate_avg_response_time_per_period(cur, conn):
-    try:
-        sql_query = '''
-            SELECT 
-                CASE 
-                    WHEN Time BETWEEN '00:00' AND '01:59' THEN '00:00 - 01:59'
-                    WHEN Time BETWEEN '02:00' AND '03:59' THEN '02:00 - 03:59'
-                    WHEN Time BETWEEN '04:00' AND '05:59' THEN '04:00 - 05:59'
-                    WHEN Time BETWEEN '06:00' AND '07:59' THEN '06:00 - 07:59'
-                    WHEN Time BETWEEN '08:00' AND '09:59' THEN '08:00 - 09:59'
-                    WHEN Time BETWEEN '10:00' AND '11:59' THEN '10:00 - 11:59'
-                    WHEN Time BETWEEN '12:00' AND '13:59' THEN '12:00 - 13:59'
-                    WHEN Time BETWEEN '14:00' AND '15:59' THEN '14:00 - 15:59'
-                    WHEN Time BETWEEN '16:00' AND '17:59' THEN '16:00 - 17:59'
-                    WHEN Time BETWEEN '18:00' AND '19:59' THEN '18:00 - 19:59'
-                    WHEN Time BETWEEN '20:00' AND '21:59' THEN '20:00 - 21:59'
-                    WHEN Time BETWEEN '22:00' AND '23:59' THEN '22:00 - 23:59'
-                    ELSE 'Unknown'
-                END AS period,
-                AVG(Response_time) AS avg_response_time
-            FROM NYC_Fires
-            GROUP BY period;
+    cur.executemany(
         '''
-        cur.execute(sql_query)
-
-        avg_response_times_per_period = cur.fetchall()
+        INSERT OR IGNORE INTO neighborhood_ID (Neighborhood) 
+        VALUES (?)
+        ''',
+        [(borough,) for borough in missing]
+    )
+    cur.execute(
+        f'''
+        SELECT Neighborhood, Neighborhood_ID FROM neighborhood_ID
+        WHERE Neighborhood IN ({",".join("?" * len(missing))})
+        ''',
+        missing
+    )
+    neighborhood_ids.update(cur.fetchall())
 
-        #create lists to make creating the vizualization more straight forward
-        periods = []
-        avg_response_times = []
 
-        with open("calculations.txt", 'a') as f:  # Append to the file
-            f.write("\nAverage response time per 2-hour period in NYC:\n")
-            for row in avg_response_times_per_period:
-                period, avg_response_time = row
-                periods.append(period)
-                avg_response_times.append(avg_response_time)
-                f.write(f"{period}: {avg_response_time:.2f} minutes\n")
+#insert into Neighborhood table and relationship table
+#one pass over the data and a fixed number of queries per batch
+def insert_data_to_neighborhood_table(cur, conn, json_data, batch_size=BATCH_SIZE):
+    neighborhood_ids = {}  # borough -> Neighborhood_ID
+    skipped = {}
+    total_entries = 0
 
-        print("Average response time per 2-hour period calculated and written to calculations.txt.")
-        return periods, avg_response_times
-    except Exception as e:
-        print("An error occurred while calculating the average response time per period:", e)
-        return None, None
-    
+    for batch in batched(json_data, batch_size):
+        pairs = transform_batch(batch, nyc_fire_borough, skipped)
+        if not pairs:
+            continue
 
+        get_neighborhood_ids(cur, (borough for _, borough in pairs), neighborhood_ids)
 
-#Step 3 create vizualizations from the calculated data
-#creates plot for avg fires in each NYC neighborhood
-def create_neighborhood_viz(file_path):
-    neighborhoods = []
-    num_fires = []
-    section_found = False
-    
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-        for line in lines:
-            if not section_found:
-                if "Average number of fires per neighborhood" in line:
-                    section_found = True
-                continue
-            
-            if "Average response time per 2-hour period" in line:
-                break
-            
-            if ':' not in line:
-                continue
-                
-            neighborhood, num_fire = line.strip().split(': ')
-            neighborhoods.append(neighborhood)
-            num_fires.append(int(num_fire))
-    
-    plt.figure(figsize=(10, 6))
-    plt.bar(neighborhoods, num_fires, color='deeppink')
-    plt.title('Average Number of Fires per Neighborhood')
-    plt.xlabel('Neighborhood')
-    plt.ylabel('Number of Fires')
-    plt.xticks(rotation=0)
-    plt.tight_layout()
-    plt.show()
-
-
-#creates plot for average response time for each two hour period in the day
-def create_NYC_response_time_viz(periods, avg_response_times):
-    plt.figure(figsize=(10, 6))
-    plt.plot(periods, avg_response_times, marker='o', color='blue')
-    plt.title('Average Response Time per 2-hour Period in NYC')
-    plt.xlabel('Time Period (military time)')
-    plt.ylabel('Average Response Time (minutes)')
-    plt.xticks(rotation=45)
-    plt.grid(True)
-    plt.tight_layout()
-    plt.show()
+        # Fire_ID comes from the Fire_Incidents row with the same incident ID
+        cur.executemany(
+            '''
+            INSERT INTO Fire_Neighborhood_Relationship (Fire_ID, Neighborhood_ID) 
+            SELECT Fire_id, ? FROM Fire_Incidents WHERE City = 'NYC' AND Incident_id = ?
+            ON CONFLICT(Fire_ID) DO UPDATE SET Neighborhood_ID = excluded.Neighborhood_ID
+            ''',
+            [(neighborhood_ids[borough], incident_id) for incident_id, borough in pairs]
+        )
+        bump_data_version(cur, "NYC")  # the per borough results change with the links
+        conn.commit()  # Commit the transaction
+        total_entries += len(pairs)
 
+    for error, count in skipped.items():
+        print(f"{error}: skipped {count} data entries.")
+    print(f"Linked {total_entries} fires to their neighborhood.")
 
 
-def main():
-    get_fire_data("Structural Fires")
 
+#step 2 Calculate something from the data
+#the counts come from the rollup tables, so this reads a few rows per borough and day instead of every fire
+#results go to the Calculation_Results table under run_id
+def calculate_avg_fires_per_neighborhood(cur, conn, run_id):
     try:
-        #set up the database
-        cur, conn = set_up_database("fire_data.db")
-        create_first_nyc_table(cur, conn)
-        create_neighborhood_table(cur, conn)
-        create_fire_neighborhood_relationship_table(cur, conn)
-        with open("NYC_data.json", "r") as json_file:
-            NYC_data = json.load(json_file)
+        with metrics.stage("calculate_avg_fires_per_neighborhood", city="NYC"):
+            avg_fires_per_neighborhood = rollup_fires_per_borough(cur, "NYC")
+        save_results(cur, conn, run_id, "NYC", FIRES_PER_BOROUGH, avg_fires_per_neighborhood)
 
-        insert_data_to_fires_table(cur, conn, NYC_data)
-        insert_data_to_neighborhood_table(cur, conn, NYC_data)
+        print("Average number of fires per neighborhood calculated and saved to Calculation_Results.")
+    except Exception as e:
+        print("An error occurred while calculating the average number of fires per neighborhood:", e)
+        metrics.log_error("calculation_failed", e, city="NYC")
 
-        calculate_avg_fires_per_neighborhood(cur, conn)
-        periods, avg_response_times = calculate_avg_response_time_per_period(cur, conn)
 
-        if periods and avg_response_times:
-            create_NYC_response_time_viz(periods, avg_response_times)
+#Step 3 create vizualizations from the calculated data
+#draws the NYC charts (per borough and bucket width) into the charts folder, see charts.py
+def create_NYC_charts(cur, conn):
+    return render_charts(cur, conn, city_charts(cur, "NYC"))
 
-        conn.close()  # Close the database connection after insertion
 
-        create_neighborhood_viz("calculations.txt")
-        create_NYC_response_time_viz("calculations.txt")
+
+def main():
+    try:
+        # every stage is recorded in metrics/<run_id>.json, see metrics.py
+        with metrics.run("NYC") as run_id, metrics.labels(city="NYC"):
+            source = NYCSource("Structural Fires")
+            #set up the database
+            cur, conn = set_up_database("fire_data.db")
+            # loads every LOAD_EVERY rows while the rest downloads
+            fetch_source(source, cur, conn, lambda: load_source(source, cur, conn))
+            # what the fetch stored after its last load, skips what was already loaded by an earlier run
+            load_source(source, cur, conn)
+
+            calculate_avg_fires_per_neighborhood(cur, conn, run_id)
+            calculate_avg_response_time_per_period(cur, conn, "NYC", run_id)
+            with metrics.stage("export"):
+                export_calculations_txt(cur)
+
+            with metrics.stage("render"):
+                create_NYC_charts(cur, conn)
+
+            conn.close()  # Close the database connection after insertion
 
     except Exception as e:
+        # already logged with its traceback, the exit code tells a scheduler the run failed
         print("An error has occured:", e)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
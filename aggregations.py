@@ -0,0 +1,166 @@
+import numpy as np
+
+from cache import cached_query
+from fire_time import DAY_NAMES, MONTH_NAMES
+from rollups import ROLLUP_BUCKETS, rollup_response_stats
+
+
+'''Response time statistics per time bucket, shared by the NYC and LA scripts so both cities are measured
+    the same way.
+    Buckets are worked out in SQL from the integer time columns of Fire_Incidents (no string comparisons).
+    Counts and means come straight from grouped SQL; hour based buckets are first grouped on Hour_bucket so
+    SQLite can answer from the (City, Hour_bucket, Response_time) index. Median, p90 and p99 need every
+    response time, so those rows are pulled into NumPy and all buckets are computed at once: rows are sorted
+    by bucket and response time, then every bucket is a slice of that array.
+    Hour aligned buckets are answered from the rollup tables unless exact=True, see rollups.py.
+    Results are cached until the city's data changes, see cache.py.
+'''
+
+FETCH_SIZE = 100000
+
+
+def _clock(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def _minutes_label(width):
+    return lambda bucket: f"{_clock(bucket * width)} - {_clock(bucket * width + width - 1)}"
+
+
+# bucket width -> (SQL for a fine bucket b, SQL turning b into the bucket number, names a bucket number, needs a date)
+BUCKETS = {
+    "15min": ("Minute_of_day / 15", "b", _minutes_label(15), False),
+    "1h": ("Hour_bucket", "b", _minutes_label(60), False),
+    "2h": ("Hour_bucket", "b / 2", _minutes_label(120), False),
+    "dow": ("CAST(strftime('%w', Epoch, 'unixepoch') AS INTEGER)", "b", lambda bucket: DAY_NAMES[bucket], True),
+    "month": ("CAST(strftime('%m', Epoch, 'unixepoch') AS INTEGER)", "b", lambda bucket: MONTH_NAMES[bucket - 1], True),
+}
+
+
+#FROM/WHERE part shared by both queries
+def _source(city, bucket, borough):
+    sql = "FROM Fire_Incidents"
+    conditions = ["Fire_Incidents.City = ?", "Fire_Incidents.Response_time IS NOT NULL"]
+    params = [city]
+    if borough is not None:
+        sql += '''
+            JOIN Fire_Neighborhood_Relationship ON Fire_Neighborhood_Relationship.Fire_ID = Fire_Incidents.Fire_id
+            JOIN neighborhood_ID ON neighborhood_ID.Neighborhood_ID = Fire_Neighborhood_Relationship.Neighborhood_ID
+        '''
+        conditions.append("neighborhood_ID.Neighborhood = ?")
+        params.append(borough)
+    if BUCKETS[bucket][3]:
+        conditions.append("Fire_Incidents.Epoch IS NOT NULL")  # rows loaded before dates were stored
+    return sql + " WHERE " + " AND ".join(conditions), params
+
+
+#bucket number, count and mean per bucket from grouped SQL
+def _grouped_means(cur, city, bucket, borough):
+    inner, outer = BUCKETS[bucket][:2]
+    source, params = _source(city, bucket, borough)
+    cur.execute(
+        f'''
+        SELECT {outer} AS bucket, SUM(n), SUM(total) / SUM(n)
+        FROM (
+            SELECT {inner} AS b, COUNT(Fire_Incidents.Response_time) AS n, SUM(Fire_Incidents.Response_time) AS total
+            {source}
+            GROUP BY b
+        )
+        GROUP BY bucket
+        ORDER BY bucket
+        ''',
+        params
+    )
+    return cur.fetchall()
+
+
+#bucket number and response time of every matching fire as two NumPy arrays
+def _fetch_bucketed(cur, city, bucket, borough):
+    inner, outer = BUCKETS[bucket][:2]
+    source, params = _source(city, bucket, borough)
+    cur.execute(
+        f'''
+        SELECT {outer} AS bucket, Response_time
+        FROM (SELECT {inner} AS b, Fire_Incidents.Response_time AS Response_time {source})
+        ''',
+        params
+    )
+    chunks = []
+    while True:
+        rows = cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.float64))
+
+    if not chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    data = np.concatenate(chunks)
+    return data[:, 0].astype(np.int64), data[:, 1]
+
+
+#count, mean, median, p90 and p99 response time for every bucket that has fires
+@cached_query
+def response_time_stats(cur, city, bucket="2h", borough=None, quantiles=True, exact=False):
+    '''
+    bucket is one of "15min", "1h", "2h", "dow" (day of week) or "month"
+    borough limits the fires to one NYC borough
+    quantiles=False skips median/p90/p99 (left as None) and answers from grouped SQL alone
+    unless exact=True, every bucket but 15min is read from the rollups; counts and means are the same,
+    median/p90/p99 are then the nearest-rank value to within 1% instead of interpolated exactly
+    returns a list of dicts with label, bucket, count, mean, median, p90 and p99 in bucket order
+    '''
+    if bucket not in BUCKETS:
+        raise ValueError(f"unknown bucket {bucket!r}, expected one of {', '.join(BUCKETS)}")
+    label = BUCKETS[bucket][2]
+
+    if not exact and bucket in ROLLUP_BUCKETS:
+        stats = rollup_response_stats(cur, city, bucket, borough)
+        if not quantiles:
+            for row in stats:
+                row["median"] = row["p90"] = row["p99"] = None
+        return stats
+
+    if not quantiles:
+        return [
+            {"label": label(number), "bucket": number, "count": count, "mean": mean,
+             "median": None, "p90": None, "p99": None}
+            for number, count, mean in _grouped_means(cur, city, bucket, borough)
+        ]
+
+    buckets, response_times = _fetch_bucketed(cur, city, bucket, borough)
+    if not len(buckets):
+        return []
+
+    # sort by bucket then response time, so every bucket is a sorted slice
+    order = np.lexsort((response_times, buckets))
+    buckets = buckets[order]
+    response_times = response_times[order]
+
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(buckets)]
+    counts = ends - starts
+    means = np.add.reduceat(response_times, starts) / counts
+
+    def quantile(q):
+        # linear interpolation between the two closest ranks, like np.percentile
+        position = starts + (counts - 1) * q
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, ends - 1)
+        weight = position - lower
+        return response_times[lower] * (1 - weight) + response_times[upper] * weight
+
+    medians, p90s, p99s = quantile(0.5), quantile(0.9), quantile(0.99)
+
+    stats = []
+    for i, start in enumerate(starts):
+        number = int(buckets[start])
+        stats.append({
+            "label": label(number),
+            "bucket": number,
+            "count": int(counts[i]),
+            "mean": float(means[i]),
+            "median": float(medians[i]),
+            "p90": float(p90s[i]),
+            "p99": float(p99s[i]),
+        })
+    return stats
@@ -0,0 +1,239 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import NYCfire_response
+import LA_firenew
+from charts import city_charts, render_charts
+from fire_db import connect, migrate
+from fire_time import MICROSECONDS_PER_DAY, clock_microseconds_array
+from ingest import calculate_avg_response_time_per_period
+from raw_store import append_records, read_records
+from results import new_run_id
+
+
+'''Benchmarks for the whole pipeline: raw store -> insert -> aggregate -> render.
+    Generates synthetic NYC and LA records shaped like the SODA responses and times every stage against a
+    throwaway database, so the real fire_data.db is never touched. Each city and size runs in its own
+    process so the peak RSS of one run doesn't carry over to the next; records are generated and stored
+    page by page, so 10M rows don't have to fit in memory.
+    The results (seconds, rows per second and peak RSS per stage) are written to a JSON file; pass an older
+    one with --compare to see which stages got slower. Every run's insert_data_to_fires_table stage also has
+    to load at least --min-rows-per-sec (100k by default, 0 turns it off), or the benchmark exits with 1.
+    Also compares the vectorized LA time parsing with the per-row strptime it replaced.
+    run with: python benchmark.py --rows 10000 100000 1000000 --output bench_baseline.json
+'''
+
+BOROUGHS = ["BRONX", "BROOKLYN", "MANHATTAN", "QUEENS", "RICHMOND / STATEN ISLAND"]
+PAGE_SIZE = 50000  # records per append to the raw store
+REGRESSION_THRESHOLD = 0.2  # a stage this much slower than the baseline is reported
+MIN_ROWS_PER_SEC = 100000  # insert_data_to_fires_table throughput every run has to reach
+
+
+#fake NYC incident shaped like a row from the 8m42-w767 dataset
+def synthetic_nyc_record(i, rng):
+    minute = rng.randrange(1440)
+    return {
+        "starfire_incident_id": str(2100000000 + i),
+        "incident_borough": rng.choice(BOROUGHS),
+        "first_activation_datetime": f"2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{minute // 60:02d}:{minute % 60:02d}:00.000",
+        "incident_response_seconds_qy": str(rng.randint(60, 900)),
+        "valid_incident_rspns_time_indc": "Y" if rng.random() < 0.95 else "N",
+    }
+
+
+#fake LA unit response shaped like a row from the n44u-wxe4 dataset
+def synthetic_la_record(i, rng):
+    created = rng.randrange(86400)
+    on_scene = (created + rng.randint(60, 900)) % 86400
+    return {
+        "randomized_incident_number": str(900000 + i),
+        "dispatch_sequence": "1",
+        "incident_date": f"2021-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00.000",
+        "incident_creation_time_gmt": f"{created // 3600:02d}:{created // 60 % 60:02d}:{created % 60:02d}.000",
+        "on_scene_time_gmt": f"{on_scene // 3600:02d}:{on_scene // 60 % 60:02d}:{on_scene % 60:02d}.000",
+    }
+
+
+#generates the records one at a time, the same ones for the same seed
+def synthetic_records(make_record, rows, seed=206):
+    rng = random.Random(seed)
+    return (make_record(i, rng) for i in range(rows))
+
+
+#LA response time the way it used to be computed, two strptime calls per row
+def strptime_response_seconds(data):
+    incident_creation_time = datetime.strptime(data["incident_creation_time_gmt"], "%H:%M:%S.%f")
+    on_scene_time = datetime.strptime(data["on_scene_time_gmt"], "%H:%M:%S.%f")
+    return (on_scene_time - incident_creation_time).total_seconds()
+
+
+#times per-row strptime against the vectorized parser on the same LA records, returns the speedup
+def bench_la_time_parsing(rows):
+    records = list(synthetic_records(synthetic_la_record, rows))
+
+    start = time.perf_counter()
+    expected = [strptime_response_seconds(data) for data in records]
+    strptime_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    created, _ = clock_microseconds_array([data["incident_creation_time_gmt"] for data in records])
+    on_scene, _ = clock_microseconds_array([data["on_scene_time_gmt"] for data in records])
+    response = (on_scene - created) % MICROSECONDS_PER_DAY
+    vectorized_elapsed = time.perf_counter() - start
+
+    # the old way went negative across midnight, the new one adds the day
+    mismatches = sum(1 for old, new in zip(expected, response.tolist()) if old % 86400 != new / 1000000)
+    speedup = strptime_elapsed / vectorized_elapsed
+    print(f"LA time parsing: {rows} records, strptime {strptime_elapsed:.2f}s, vectorized {vectorized_elapsed:.2f}s "
+          f"-> {speedup:.1f}x faster ({sum(1 for old in expected if old < 0)} crossed midnight, {mismatches} mismatches)")
+    return speedup
+
+
+#highest resident memory of this process and the ones it started so far, in MB
+def peak_rss_mb():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024 if sys.platform != "darwin" else peak / (1024 * 1024)  # kB on Linux, bytes on macOS
+
+
+#runs one stage and records its time, throughput and the peak RSS so far
+def timed(stages, name, rows, stage):
+    start = time.perf_counter()
+    stage()
+    elapsed = time.perf_counter() - start
+    stages[name] = {"seconds": round(elapsed, 4), "rows_per_sec": round(rows / elapsed, 1), "peak_rss_mb": round(peak_rss_mb(), 1)}
+    print(f"  {name}: {elapsed:.2f}s, {rows / elapsed:,.0f} rows/sec, peak RSS {stages[name]['peak_rss_mb']:.0f} MB")
+
+
+# city -> (script module, its source adapter, record generator)
+CITIES = {
+    "NYC": (NYCfire_response, NYCfire_response.NYCSource, synthetic_nyc_record),
+    "LA": (LA_firenew, LA_firenew.LASource, synthetic_la_record),
+}
+
+
+#every stage of one city on a fresh database, runs in its own process
+def bench_city(city, rows, batch_size):
+    module, source_class, make_record = CITIES[city]
+    source = source_class()
+    stages = {}
+    print(f"{city}, {rows} rows:")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = connect(os.path.join(tmp, "bench.db"))  # same journaling and pragmas as fire_data.db
+        cur = conn.cursor()
+        migrate(cur, conn)
+        store = os.path.join(tmp, os.path.basename(source.store))
+
+        # what get_fire_data/get_fire_dep_data used to do with each page of the API
+        def write_store():
+            records = synthetic_records(make_record, rows)
+            while True:
+                page = list(islice(records, PAGE_SIZE))
+                if not page:
+                    return
+                append_records(store, page, source.incident_id, cur, conn)
+
+        def calculate():
+            run_id = new_run_id()
+            if city == "NYC":
+                NYCfire_response.calculate_avg_fires_per_neighborhood(cur, conn, run_id)
+            calculate_avg_response_time_per_period(cur, conn, city, run_id)
+
+        timed(stages, "raw_store", rows, write_store)
+        timed(stages, "insert_data_to_fires_table", rows, lambda: module.insert_data_to_fires_table(cur, conn, read_records(store), batch_size))
+        if city == "NYC":
+            timed(stages, "insert_data_to_neighborhood_table", rows,
+                  lambda: NYCfire_response.insert_data_to_neighborhood_table(cur, conn, read_records(store), batch_size))
+        timed(stages, "calculate", rows, calculate)
+        timed(stages, "render", rows, lambda: render_charts(cur, conn, city_charts(cur, city), directory=os.path.join(tmp, "charts")))
+        conn.close()
+
+    return {"city": city, "rows": rows, "batch_size": batch_size, "stages": stages}
+
+
+#prints every stage next to its baseline time, returns how many got slower by more than threshold
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    old_runs = {(run["city"], run["rows"]): run["stages"] for run in baseline["runs"]}
+    regressions = 0
+    for run in results["runs"]:
+        old_stages = old_runs.get((run["city"], run["rows"]), {})
+        for name, stage in run["stages"].items():
+            if name not in old_stages:
+                continue
+            old, new = old_stages[name]["seconds"], stage["seconds"]
+            change = (new - old) / old
+            flag = ""
+            if change > threshold:
+                flag = "  <- REGRESSION"
+                regressions += 1
+            print(f"{run['city']} {run['rows']} {name}: {old:.2f}s -> {new:.2f}s ({change:+.0%}){flag}")
+    return regressions
+
+
+#prints the runs whose insert stage loaded fewer than min_rows_per_sec rows a second, returns how many
+def check_throughput(results, min_rows_per_sec=MIN_ROWS_PER_SEC):
+    too_slow = 0
+    for run in results["runs"]:
+        rows_per_sec = run["stages"]["insert_data_to_fires_table"]["rows_per_sec"]
+        if rows_per_sec < min_rows_per_sec:
+            print(f"{run['city']} {run['rows']} insert_data_to_fires_table: {rows_per_sec:,.0f} rows/sec, "
+                  f"below {min_rows_per_sec:,} rows/sec")
+            too_slow += 1
+    return too_slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fire data pipeline")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--cities", nargs="+", default=list(CITIES), choices=list(CITIES))
+    parser.add_argument("--batch-size", type=int, default=NYCfire_response.BATCH_SIZE)
+    parser.add_argument("--parse-rows", type=int, default=1000000, help="rows for the LA time parsing comparison, 0 skips it")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results with, exits with 1 on a regression")
+    parser.add_argument("--min-rows-per-sec", type=int, default=MIN_ROWS_PER_SEC,
+                        help="exits with 1 if a run inserts fewer rows per second than this, 0 skips the check")
+    args = parser.parse_args()
+
+    results = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "runs": [],
+    }
+    if args.parse_rows:
+        results["la_time_parsing_speedup"] = round(bench_la_time_parsing(args.parse_rows), 1)
+
+    for rows in args.rows:
+        for city in args.cities:
+            # a fresh process per run, so peak RSS is that run's own
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                results["runs"].append(pool.submit(bench_city, city, rows, args.batch_size).result())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}.")
+
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        failed = compare(results, baseline) > 0
+    if args.min_rows_per_sec and check_throughput(results, args.min_rows_per_sec):
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import metrics
+from fire_files import project_path, write_atomic
+
+
+'''Memoized results of the aggregate queries, so repeated reports don't rescan the tables.
+    Every city has a data version in the Data_Versions table that the loaders bump inside each batch they
+    write (bump_data_version), in the same transaction as the rows. A cached result is keyed on the query,
+    its parameters and the city's data version at the time, so as soon as a batch commits the old entries
+    stop matching and the next call runs the query again; nothing stale is ever served, even to another
+    process sharing fire_data.db.
+    Results are kept pickled in memory with least-recently-used eviction, and also written to files in a
+    folder if configure(directory=...) is given, so a fresh process starts warm.
+    Decorate a function taking (cur, city, ...) with @cached_query to cache it.
+'''
+
+MAX_ENTRIES = 256  # results kept in memory
+MAX_FILES = 1024  # results kept on disk, the oldest files are removed past this
+
+
+def data_version(cur, city):
+    cur.execute("SELECT Version FROM Data_Versions WHERE City = ?", (city,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+#marks the city's data as changed, call it inside the transaction that changes it
+def bump_data_version(cur, city):
+    cur.execute(
+        '''
+        INSERT INTO Data_Versions (City, Version) VALUES (?, 1)
+        ON CONFLICT(City) DO UPDATE SET Version = Version + 1
+        ''',
+        (city,)
+    )
+
+
+class QueryCache:
+    '''
+    values are stored pickled, so a caller changing the list it got back can't change the cached copy
+    threads missing on the same key at the same time wait for the first one's query instead of all running it
+    '''
+
+    def __init__(self, max_entries=MAX_ENTRIES, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> pickled value, least recently used first
+        self.pending = {}  # key -> Future of the pickled value, while one thread computes it
+        self.lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + ".pickle")
+
+    #the cached value for key, or compute() stored under key
+    def get(self, key, compute):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            pending = self.pending.get(key) if data is None else None
+            if data is None and pending is None:
+                future = self.pending[key] = Future()
+        if data is not None:
+            metrics.count("query_cache", result="hit")
+            return pickle.loads(data)
+        if pending is not None:
+            metrics.count("query_cache", result="wait")
+            return pickle.loads(pending.result())
+
+        try:
+            data = self._load(key, compute)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(data)
+        finally:
+            with self.lock:
+                del self.pending[key]
+        return pickle.loads(data)
+
+    #pickled value of key from the disk tier, or from compute()
+    def _load(self, key, compute):
+        if self.directory is not None:
+            try:
+                with open(self._file(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                metrics.count("query_cache", result="disk_hit")
+                self._remember(key, data)
+                return data
+
+        metrics.count("query_cache", result="miss")
+        data = pickle.dumps(compute())
+        self._remember(key, data)
+        if self.directory is not None:
+            self._save(key, data)
+        return data
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _save(self, key, data):
+        write_atomic(self._file(key), data)  # another process never reads half a file
+
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".pickle")]
+        if len(files) > MAX_FILES:
+            files.sort(key=os.path.getmtime)
+            for path in files[:len(files) - MAX_FILES]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # another process got there first
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+QUERY_CACHE = QueryCache()
+
+
+#sets the size of the memory tier and the folder of the disk tier (None turns it off)
+def configure(max_entries=MAX_ENTRIES, directory=None):
+    QUERY_CACHE.max_entries = max_entries
+    QUERY_CACHE.directory = project_path(directory) if directory is not None else None
+    QUERY_CACHE.clear()
+
+
+#which database cur is on, so two databases never share entries
+def _database(cur):
+    cur.execute("PRAGMA database_list")
+    path = cur.fetchone()[2]
+    if not path:
+        return ("memory", id(cur.connection))
+    return (path, os.stat(path).st_ino)  # a file copied over fire_data.db starts its versions over
+
+
+#caches fn(cur, city, ...) under its arguments and the city's data version
+def cached_query(fn):
+    signature = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        cur, city = arguments.arguments["cur"], arguments.arguments["city"]
+        parameters = tuple((name, value) for name, value in arguments.arguments.items() if name != "cur")
+        key = (_database(cur), fn.__module__, fn.__qualname__, parameters, data_version(cur, city))
+        return QUERY_CACHE.get(key, lambda: fn(*args, **kwargs))
+
+    return wrapper
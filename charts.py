@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import columnar
+from aggregations import response_time_stats
+from fire_files import project_path
+from rollups import ROLLUP_BUCKETS, rollup_fires_per_borough
+
+
+'''Render stage for the charts: writes them to image files instead of opening windows with plt.show().
+    The data of every chart is read from the rollups (or a columnar.IncidentColumns) in the main process,
+    then the charts are drawn in a process pool (matplotlib is only imported there, with the Agg backend, so
+    runs that only load data never pay for it). A hash of every chart's data is kept in the Chart_Renders table of our database, and a chart
+    whose data has not changed since it was last drawn is skipped.
+'''
+
+CHART_DIR = "charts"
+CHART_FORMATS = ("png", "svg")
+
+BUCKET_TITLES = {
+    "1h": ("1-hour Period", "Time Period (military time)"),
+    "2h": ("2-hour Period", "Time Period (military time)"),
+    "dow": ("Day of the Week", "Day of the Week"),
+    "month": ("Month", "Month"),
+}
+
+
+def _file_name(*parts):
+    return "_".join(part.lower().replace(" / ", "_").replace(" ", "_") for part in parts if part)
+
+
+def _fires_per_borough_spec(city, rows):
+    return {
+        "name": _file_name(city, "fires_per_borough"),
+        "kind": "bar",
+        "x": [borough for borough, _ in rows],
+        "y": [num_fires for _, num_fires in rows],
+        "color": "deeppink",
+        "title": "Average Number of Fires per Neighborhood",
+        "xlabel": "Neighborhood",
+        "ylabel": "Number of Fires",
+        "rotation": 0,
+        "grid": False,
+    }
+
+
+def _response_time_spec(city, bucket, borough, rows):
+    period, xlabel = BUCKET_TITLES[bucket]
+    return {
+        "name": _file_name(city, borough, "response_time", bucket),
+        "kind": "line",
+        "x": [row["label"] for row in rows],
+        "y": [row["mean"] for row in rows],
+        "color": "blue",
+        "title": f"Average Response Time per {period} in {borough.title() if borough else city}",
+        "xlabel": xlabel,
+        "ylabel": "Average Response Time (minutes)",
+        "rotation": 45,
+        "grid": True,
+    }
+
+
+#bar chart of the number of fires in every borough
+def fires_per_borough_chart(cur, city="NYC"):
+    return _fires_per_borough_spec(city, rollup_fires_per_borough(cur, city))
+
+
+#line chart of the average response time per bucket, for a whole city or one borough
+def response_time_chart(cur, city, bucket="2h", borough=None):
+    return _response_time_spec(city, bucket, borough, response_time_stats(cur, city, bucket, borough, quantiles=False))
+
+
+#every chart we draw for one city: each bucket width for the city and for each of its boroughs
+def city_charts(cur, city, incidents=None):
+    '''
+    incidents, a columnar.IncidentColumns, gives the same charts from the fires in it instead of the rollups
+    '''
+    if incidents is None:
+        borough_rows = rollup_fires_per_borough(cur, city)
+        stats = lambda bucket, borough: response_time_stats(cur, city, bucket, borough, quantiles=False)
+    else:
+        borough_rows = columnar.fires_per_borough(city, incidents=incidents)
+        stats = lambda bucket, borough: columnar.response_time_stats(city, bucket, borough, incidents=incidents)
+
+    boroughs = [borough for borough, _ in borough_rows]
+    charts = []
+    if boroughs:
+        charts.append(_fires_per_borough_spec(city, borough_rows))
+    for bucket in ROLLUP_BUCKETS:
+        charts.append(_response_time_spec(city, bucket, None, stats(bucket, None)))
+        for borough in boroughs:
+            charts.append(_response_time_spec(city, bucket, borough, stats(bucket, borough)))
+    return [chart for chart in charts if chart["x"]]
+
+
+def _fingerprint(chart, formats):
+    text = json.dumps([chart, list(formats)], sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+#draws one chart and saves it in every format, runs in a worker process
+def draw_chart(chart, directory, formats):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(10, 6))
+    if chart["kind"] == "bar":
+        plt.bar(chart["x"], chart["y"], color=chart["color"])
+    else:
+        plt.plot(chart["x"], chart["y"], marker='o', color=chart["color"])
+    plt.title(chart["title"])
+    plt.xlabel(chart["xlabel"])
+    plt.ylabel(chart["ylabel"])
+    plt.xticks(rotation=chart["rotation"])
+    if chart["grid"]:
+        plt.grid(True)
+    plt.tight_layout()
+
+    paths = []
+    for file_format in formats:
+        path = os.path.join(directory, f"{chart['name']}.{file_format}")
+        fig.savefig(path, format=file_format)
+        paths.append(path)
+    plt.close(fig)
+    return paths
+
+
+#draws every chart whose data changed since the last render, returns the paths written
+def render_charts(cur, conn, charts, directory=CHART_DIR, formats=CHART_FORMATS, workers=None):
+    '''
+    charts are the dicts made by fires_per_borough_chart, response_time_chart or city_charts
+    workers is the size of the process pool, by default one per CPU; with one worker (or one chart)
+    the charts are drawn in this process
+    '''
+    directory = project_path(directory)  # next to the scripts, like fire_data.db
+    os.makedirs(directory, exist_ok=True)
+
+    cur.execute("SELECT Chart, Fingerprint FROM Chart_Renders")
+    rendered = dict(cur.fetchall())
+
+    pending = []
+    for chart in charts:
+        fingerprint = _fingerprint(chart, formats)
+        files_exist = all(os.path.exists(os.path.join(directory, f"{chart['name']}.{file_format}")) for file_format in formats)
+        if rendered.get(chart["name"]) != fingerprint or not files_exist:
+            pending.append((chart, fingerprint))
+
+    workers = min(workers or os.cpu_count() or 1, len(pending))
+    paths = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(draw_chart, chart, directory, formats) for chart, _ in pending]
+            for future in futures:
+                paths.extend(future.result())
+    else:
+        for chart, _ in pending:
+            paths.extend(draw_chart(chart, directory, formats))
+
+    cur.executemany(
+        "INSERT OR REPLACE INTO Chart_Renders (Chart, Fingerprint) VALUES (?, ?)",
+        [(chart["name"], fingerprint) for chart, fingerprint in pending]
+    )
+    conn.commit()
+
+    print(f"Rendered {len(pending)} charts to {directory}, {len(charts) - len(pending)} unchanged.")
+    return paths
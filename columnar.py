@@ -0,0 +1,337 @@
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+
+from aggregations import BUCKETS
+from fire_db import connect
+from fire_files import project_path
+
+
+'''Columnar export of Fire_Incidents for analysis outside SQLite.
+    Every city/year/month partition is a folder (city=NYC/year=2021/month=01, plus city=LA/undated for the
+    fires loaded before dates were stored) with one .npy file per column; the fire's borough from the
+    neighborhood tables is stored as a small integer code. _meta.json at the top lists the partitions, the
+    column types and the borough names.
+    .npy files can be memory-mapped, so open_partitions hands back NumPy arrays that read straight from the
+    files without copying them into memory, and the calculations below go one partition at a time, so years
+    of data never have to fit in memory at once.
+    IncidentColumns holds fires in memory in the same columns, filled with the rows a load writes as they
+    are parsed, and the calculations below take it in place of an export.
+    run with: python columnar.py
+'''
+
+EXPORT_DIR = "fire_columns"
+NO_BOROUGH = -1
+FETCH_SIZE = 100000
+PART_ROWS = 1 << 20  # rows per part of an IncidentColumns
+NAT = np.iinfo(np.int64).min  # NaT as an integer
+
+# column -> dtype, Epoch is NaT for undated fires and Response_time is NaN when there is none
+COLUMNS = {
+    "Fire_id": "int64",
+    "Epoch": "datetime64[s]",
+    "Minute_of_day": "int16",
+    "Response_time": "float64",
+    "Borough": "int8",
+}
+
+
+def _partition_path(city, year, month):
+    if year is None:
+        return os.path.join(f"city={city}", "undated")
+    return os.path.join(f"city={city}", f"year={year}", f"month={month:02d}")
+
+
+#rows of one city from a single scan of Fire_Incidents, as one float64 array per chunk
+def _city_chunks(cur, city):
+    '''
+    columns are Fire_id, Epoch (NaN when unknown), Minute_of_day, Response_time (NaN when unknown)
+    and Neighborhood_ID (0 when the fire has no borough); float64 holds all of them exactly
+    '''
+    # +City keeps SQLite on a straight scan of the table, going through an index is several times slower here
+    cur.execute(
+        '''
+        SELECT Fire_Incidents.Fire_id, Fire_Incidents.Epoch, Fire_Incidents.Minute_of_day, Fire_Incidents.Response_time,
+            IFNULL(Fire_Neighborhood_Relationship.Neighborhood_ID, 0)
+        FROM Fire_Incidents
+        LEFT JOIN Fire_Neighborhood_Relationship ON Fire_Neighborhood_Relationship.Fire_ID = Fire_Incidents.Fire_id
+        WHERE +Fire_Incidents.City = ?
+        ''',
+        (city,)
+    )
+    while True:
+        rows = cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield np.array(rows, dtype=np.float64)
+
+
+#month number since year 0 of every row, -1 for undated ones
+def _month_keys(epochs):
+    keys = np.full(len(epochs), -1, dtype=np.int64)
+    dated = ~np.isnan(epochs)
+    keys[dated] = epochs[dated].astype(np.int64).astype("datetime64[s]").astype("datetime64[M]").astype(np.int64) + 1970 * 12
+    return keys
+
+
+#exports every fire with its borough, one partition per city and month, returns the number of rows written
+def export_columns(cur, directory=EXPORT_DIR):
+    '''
+    each city is read in one pass over Fire_Incidents and held as NumPy columns (about 30 bytes a fire)
+    until its partitions are written; rows in a partition are in Fire_id order
+    the export is written next to directory and swapped in at the end, so readers never see half of one
+    '''
+    directory = project_path(directory)
+    cur.execute("SELECT Neighborhood_ID, Neighborhood FROM neighborhood_ID ORDER BY Neighborhood")
+    neighborhoods = cur.fetchall()
+    boroughs = [name for _, name in neighborhoods]
+    # Neighborhood_ID -> borough code, 0 stands for no borough
+    borough_codes = np.full(max([neighborhood_id for neighborhood_id, _ in neighborhoods], default=0) + 1, NO_BOROUGH, dtype=np.int8)
+    for code, (neighborhood_id, _) in enumerate(neighborhoods):
+        borough_codes[neighborhood_id] = code
+
+    cur.execute("SELECT DISTINCT City FROM Fire_Incidents ORDER BY City")
+    cities = [row[0] for row in cur.fetchall()]
+
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    meta = {"columns": COLUMNS, "boroughs": boroughs, "partitions": [], "exported_at": datetime.now().isoformat(timespec="seconds")}
+    total = 0
+    for city in cities:
+        parts = {}  # month key -> list of row chunks
+        for chunk in _city_chunks(cur, city):
+            keys = _month_keys(chunk[:, 1])
+            for key in np.unique(keys).tolist():
+                parts.setdefault(key, []).append(chunk[keys == key])
+
+        for key in sorted(parts):
+            data = np.concatenate(parts.pop(key))
+            year, month = (None, None) if key < 0 else (key // 12, key % 12 + 1)
+            path = _partition_path(city, year, month)
+            columns = {
+                "Fire_id": data[:, 0].astype(np.int64),
+                "Epoch": np.where(np.isnan(data[:, 1]), np.datetime64("NaT", "s").astype(np.int64), data[:, 1]).astype(np.int64).view("datetime64[s]"),
+                "Minute_of_day": data[:, 2].astype(np.int16),
+                "Response_time": data[:, 3],
+                "Borough": borough_codes[data[:, 4].astype(np.int64)],
+            }
+            os.makedirs(os.path.join(temp_directory, path))
+            for name, values in columns.items():
+                np.save(os.path.join(temp_directory, path, name + ".npy"), values)
+            meta["partitions"].append({"city": city, "year": year, "month": month, "rows": len(data), "path": path})
+            total += len(data)
+
+    with open(os.path.join(temp_directory, "_meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # swap the new export in for the old one
+    old_directory = directory + ".old"
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_directory)
+    os.replace(temp_directory, directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+    print(f"Exported {total} fires in {len(meta['partitions'])} partitions to {directory}.")
+    return total
+
+
+def load_meta(directory=EXPORT_DIR):
+    with open(os.path.join(project_path(directory), "_meta.json")) as f:
+        return json.load(f)
+
+
+#memory-mapped columns of every matching partition, one dict of column name -> array per partition
+def open_partitions(directory=EXPORT_DIR, city=None, year=None, month=None, columns=None, meta=None):
+    '''
+    city, year and month narrow down the partitions (None matches all, undated partitions only match year=None)
+    columns picks the columns to open, by default all of them
+    meta is the export's _meta.json if the caller already read it
+    the arrays are read-only and read from disk as they are used, nothing is copied up front
+    '''
+    directory = project_path(directory)
+    if meta is None:
+        meta = load_meta(directory)
+    for partition in meta["partitions"]:
+        if city is not None and partition["city"] != city:
+            continue
+        if year is not None and partition["year"] != year:
+            continue
+        if month is not None and partition["month"] != month:
+            continue
+        path = os.path.join(directory, partition["path"])
+        yield {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in (columns or COLUMNS)}
+
+
+#bucket numbers of one partition, same numbering as aggregations.BUCKETS
+def _bucket_numbers(columns, bucket):
+    if bucket == "15min":
+        return columns["Minute_of_day"] // 15
+    if bucket == "1h":
+        return columns["Minute_of_day"] // 60
+    if bucket == "2h":
+        return columns["Minute_of_day"] // 120
+    if bucket == "dow":
+        return (columns["Epoch"].astype("datetime64[D]").astype(np.int64) + 4) % 7  # 1970-01-01 was a Thursday
+    return columns["Epoch"].astype("datetime64[M]").astype(np.int64) % 12 + 1
+
+
+#count and mean response time per bucket over parts (dicts of column name -> array)
+def _response_time_stats(parts, boroughs, bucket, borough):
+    if bucket not in BUCKETS:
+        raise ValueError(f"unknown bucket {bucket!r}, expected one of {', '.join(BUCKETS)}")
+    label, needs_date = BUCKETS[bucket][2], BUCKETS[bucket][3]
+    borough_code = None
+    if borough is not None:
+        if borough not in boroughs:
+            return []  # no fire in it, like the SQL version
+        borough_code = boroughs.index(borough)
+
+    counts = np.zeros(0, dtype=np.int64)
+    totals = np.zeros(0, dtype=np.float64)
+    for columns in parts:
+        keep = ~np.isnan(columns["Response_time"])
+        if needs_date:
+            keep &= ~np.isnat(columns["Epoch"])
+        if borough_code is not None:
+            keep &= columns["Borough"] == borough_code
+        if not keep.any():
+            continue
+
+        numbers = _bucket_numbers(columns, bucket)[keep].astype(np.int64)
+        partition_counts = np.bincount(numbers)
+        partition_totals = np.bincount(numbers, weights=columns["Response_time"][keep])
+        size = max(len(counts), len(partition_counts))
+        counts = np.pad(counts, (0, size - len(counts))) + np.pad(partition_counts, (0, size - len(partition_counts)))
+        totals = np.pad(totals, (0, size - len(totals))) + np.pad(partition_totals, (0, size - len(partition_totals)))
+
+    return [
+        {"label": label(number), "bucket": number, "count": int(counts[number]), "mean": float(totals[number] / counts[number])}
+        for number in np.flatnonzero(counts).tolist()
+    ]
+
+
+#number of fires with a response time per borough over parts, in borough order
+def _fires_per_borough(parts, boroughs):
+    counts = np.zeros(len(boroughs), dtype=np.int64)
+    for columns in parts:
+        codes = columns["Borough"][(columns["Borough"] != NO_BOROUGH) & ~np.isnan(columns["Response_time"])]
+        counts += np.bincount(codes, minlength=len(boroughs))
+    return sorted((borough, int(count)) for borough, count in zip(boroughs, counts) if count)
+
+
+#the parts and borough names to read, from incidents if given, else from the export in directory
+def _parts(city, directory, incidents, columns):
+    if incidents is not None:
+        return (incidents.parts() if incidents.city == city else []), incidents.boroughs
+    meta = load_meta(directory)
+    return open_partitions(directory, city, columns=columns, meta=meta), meta["boroughs"]
+
+
+#count and mean response time per bucket over the exported files, like response_time_stats(quantiles=False)
+def response_time_stats(city, bucket="2h", borough=None, directory=EXPORT_DIR, incidents=None):
+    '''
+    bucket is one of "15min", "1h", "2h", "dow" or "month"
+    incidents, an IncidentColumns, is read instead of the export
+    returns a list of dicts with label, bucket, count and mean in bucket order, no rows for a borough the
+    export has no fires in (like the SQL version)
+    '''
+    parts, boroughs = _parts(city, directory, incidents, ["Epoch", "Minute_of_day", "Response_time", "Borough"])
+    return _response_time_stats(parts, boroughs, bucket, borough)
+
+
+#number of fires per borough over the exported files, like rollups.rollup_fires_per_borough
+def fires_per_borough(city="NYC", directory=EXPORT_DIR, incidents=None):
+    return _fires_per_borough(*_parts(city, directory, incidents, ["Response_time", "Borough"]))
+
+
+#the fires of one city in memory as typed columns, the same ones (but Fire_id) as an exported partition
+class IncidentColumns:
+    '''
+    filled with the Fire_Incidents rows a load writes, see ingest.load_source, about 19 bytes a fire
+    instead of a dict of strings; response_time_stats, fires_per_borough and charts.city_charts read it
+    rows are kept in parts of PART_ROWS preallocated rows, so adding rows never copies the ones already in
+    the borough is an int8 code, its name is boroughs[code] (NO_BOROUGH when the fire has none)
+    '''
+    COLUMNS = {name: COLUMNS[name] for name in ("Epoch", "Minute_of_day", "Response_time", "Borough")}
+
+    def __init__(self, city):
+        self.city = city
+        self.boroughs = []
+        self.codes = {}
+        self.full_parts = []
+        self.part = None  # the part being filled
+        self.used = 0  # rows of self.part filled so far
+
+    def _borough_code(self, borough):
+        if not borough:
+            return NO_BOROUGH  # like the rollups, which leave out the fires without one
+        code = self.codes.get(borough)
+        if code is None:
+            if len(self.boroughs) == np.iinfo(np.int8).max:
+                raise ValueError(f"too many boroughs for an int8 code, can't add {borough!r}")
+            code = self.codes[borough] = len(self.boroughs)
+            self.boroughs.append(borough)
+        return code
+
+    #adds Fire_Incidents rows as made by SourceAdapter.transform_batch
+    def append_rows(self, rows):
+        count = len(rows)
+        if not count:
+            return
+        values = {
+            "Epoch": np.fromiter((NAT if row["Epoch"] is None else row["Epoch"] for row in rows), np.int64, count).view("datetime64[s]"),
+            "Minute_of_day": np.fromiter((row["Minute_of_day"] for row in rows), np.int16, count),
+            "Response_time": np.fromiter((np.nan if row["Response_time"] is None else row["Response_time"] for row in rows), np.float64, count),
+            "Borough": np.fromiter((self._borough_code(row["Borough"]) for row in rows), np.int8, count),
+        }
+
+        position = 0
+        while position < count:
+            if self.part is None:
+                self.part = {name: np.empty(PART_ROWS, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+                self.used = 0
+            take = min(count - position, PART_ROWS - self.used)
+            for name, column in values.items():
+                self.part[name][self.used:self.used + take] = column[position:position + take]
+            self.used += take
+            position += take
+            if self.used == PART_ROWS:
+                self.full_parts.append(self.part)
+                self.part = None
+
+    #every part as a dict of column name -> array, the one being filled cut to its rows
+    def parts(self):
+        parts = list(self.full_parts)
+        if self.part is not None and self.used:
+            parts.append({name: column[:self.used] for name, column in self.part.items()})
+        return parts
+
+    def __len__(self):
+        return sum(len(part["Borough"]) for part in self.parts())
+
+    #bytes the columns take, including the unfilled end of the last part
+    def nbytes(self):
+        parts = self.full_parts + ([self.part] if self.part is not None else [])
+        return sum(column.nbytes for part in parts for column in part.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export fire_data.db to memory-mappable column files")
+    parser.add_argument("--directory", default=EXPORT_DIR)
+    args = parser.parse_args()
+
+    # read-only, so the export can run while a load is writing to fire_data.db
+    conn = connect(read_only=True)
+    export_columns(conn.cursor(), args.directory)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
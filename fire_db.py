@@ -0,0 +1,546 @@
+'''Schema of fire_data.db, shared by NYCfire_response.py and LA_firenew.py.
+    The database keeps its data between runs. PRAGMA user_version records which migrations have been
+    applied and migrate() runs the missing ones in order, so an existing fire_data.db (including the one
+    built by the first versions of the scripts) gets upgraded in place instead of being dropped. The only
+    rows version 1 deletes are the fires stored without an incident ID, the next fetch loads them again.
+    Fire rows are keyed on the incident ID from the source data so loading the same incident twice updates
+    it instead of adding a duplicate, and Ingest_State keeps a high-water mark per source (so each run only
+    fetches what is new) and the offset its raw store has been loaded up to (so each run only reads that).
+    Version 1 also adds the fetch checkpoints of soda_client.py and the raw store tables of raw_store.py.
+    From version 2 the fires of every city live in one Fire_Incidents table with integer time columns
+    (Epoch, Minute_of_day and the generated Hour_bucket) and a covering index on
+    (City, Hour_bucket, Response_time), so time of day aggregates never touch the table itself.
+    NYC_Fires and LA_Fires are kept as read-only views with the old columns.
+    Version 3 adds the rollup table described in rollups.py and version 4 the Calculation_Results and
+    Chart_Renders tables described in results.py and charts.py. Version 5 fixes LA response times that crossed midnight. Version 6 adds the
+    per-city data versions the query cache in cache.py is keyed on.
+
+    Every script opens the database through connect(), so they all use the same file next to the scripts
+    (whatever directory they are run from) with the same settings: WAL journaling, so readers never wait for
+    a writer and a writer never waits for readers, plus the pragmas in PRAGMAS. Writes from several threads
+    go through one WriteQueue, which runs them one after another on its own connection instead of letting
+    the threads fight over the write lock; reading stages borrow read-only connections from a ReaderPool.
+'''
+
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from fire_files import project_path
+from rollups import rebuild_rollups
+
+DB_NAME = "fire_data.db"
+DB_TIMEOUT = 60  # seconds a connection waits for another process's transaction to finish
+READERS = 4  # read-only connections a ReaderPool keeps open at most
+
+# applied to every connection, journal_mode is stored in the file and only set by writers
+PRAGMAS = {
+    "synchronous": "NORMAL",  # with WAL a crash can't corrupt the file, only the last commits may be lost on power loss
+    "cache_size": -65536,  # 64 MB of page cache (negative means KiB)
+    "mmap_size": 268435456,  # read the first 256 MB of the file through a memory map
+    "temp_store": "MEMORY",  # sorts and temporary indexes for GROUP BY stay in memory
+}
+
+
+def _columns(cur, table):
+    cur.execute(f'PRAGMA table_info("{table}")')
+    return [row[1] for row in cur.fetchall()]
+
+
+#version 1: keep data between runs, key fires on the source incident ID
+#rows from before incident IDs were stored can never be matched to the incident they came from, so they are
+#deleted with their neighborhood links and the next fetch loads those incidents again with their IDs
+def migrate_1(cur):
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "NYC_Fires" (
+            "Fire_id" INTEGER PRIMARY KEY,
+            "Incident_id" TEXT,
+            "Date" TEXT,
+            "Time" TEXT,
+            "Response_time" FLOAT
+        )
+        '''
+    )
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "LA_Fires" (
+            "Fire_id" INTEGER PRIMARY KEY,
+            "Incident_id" TEXT,
+            "Time" TEXT,
+            "Response_time" FLOAT
+        )
+        '''
+    )
+    for table in ("NYC_Fires", "LA_Fires"):
+        if "Incident_id" not in _columns(cur, table):
+            cur.execute(f'ALTER TABLE "{table}" ADD COLUMN "Incident_id" TEXT')
+        cur.execute(f'DELETE FROM "{table}" WHERE Incident_id IS NULL')
+        cur.execute(
+            f'''
+            DELETE FROM "{table}" WHERE Incident_id IS NOT NULL AND Fire_id NOT IN (
+                SELECT MAX(Fire_id) FROM "{table}" WHERE Incident_id IS NOT NULL GROUP BY Incident_id
+            )
+            '''
+        )
+        cur.execute(f'DROP INDEX IF EXISTS "{table}_Incident_id"')
+        cur.execute(f'CREATE UNIQUE INDEX "{table}_Incident_id" ON "{table}" (Incident_id)')
+
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS "neighborhood_ID" (
+            "Neighborhood_ID" INTEGER PRIMARY KEY AUTOINCREMENT,
+            "Neighborhood" TEXT
+        )
+        '''
+    )
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS Fire_Neighborhood_Relationship (
+            Fire_ID INTEGER,
+            Neighborhood_ID INTEGER,
+            FOREIGN KEY(Fire_ID) REFERENCES NYC_Fires(Fire_ID),
+            FOREIGN KEY(Neighborhood_ID) REFERENCES Neighborhoods(Neighborhood_ID)
+        )
+        '''
+    )
+    # older databases were created without the UNIQUE constraints, so they are added as indexes
+    cur.execute(
+        '''
+        DELETE FROM neighborhood_ID WHERE Neighborhood_ID NOT IN (
+            SELECT MIN(Neighborhood_ID) FROM neighborhood_ID GROUP BY Neighborhood
+        )
+        '''
+    )
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS neighborhood_ID_Neighborhood ON neighborhood_ID (Neighborhood)')
+    cur.execute(
+        '''
+        DELETE FROM Fire_Neighborhood_Relationship WHERE rowid NOT IN (
+            SELECT MAX(rowid) FROM Fire_Neighborhood_Relationship GROUP BY Fire_ID
+        ) OR Fire_ID NOT IN (SELECT Fire_id FROM NYC_Fires)
+        '''
+    )
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS Fire_Neighborhood_Relationship_Fire_ID ON Fire_Neighborhood_Relationship (Fire_ID)')
+
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS Ingest_State (
+            Source TEXT PRIMARY KEY,
+            High_water_mark TEXT,
+            Store TEXT,
+            Store_offset INTEGER
+        )
+        '''
+    )
+    # how far each paginated fetch got, see soda_client.py
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS Ingest_Checkpoints (
+            Source TEXT PRIMARY KEY,
+            Query TEXT,
+            Next_offset INTEGER,
+            Updated_at TEXT
+        )
+        '''
+    )
+    # IDs of the records in each raw store, see raw_store.py
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS Raw_Store_IDs (
+            Store TEXT,
+            Source_id TEXT,
+            PRIMARY KEY (Store, Source_id)
+        ) WITHOUT ROWID
+        '''
+    )
+    # size of each raw store after its last finished append, see raw_store.py
+    cur.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS Raw_Stores (
+            Store TEXT PRIMARY KEY,
+            Size INTEGER
+        )
+        '''
+    )
+
+
+#version 2: one typed Fire_Incidents table for every city, indexed on the time bucket
+def migrate_2(cur):
+    cur.execute(
+        '''
+        CREATE TABLE Fire_Incidents (
+            Fire_id INTEGER PRIMARY KEY,
+            City TEXT NOT NULL,
+            Incident_id TEXT,
+            Epoch INTEGER,
+            Minute_of_day INTEGER NOT NULL,
+            Hour_bucket INTEGER GENERATED ALWAYS AS (Minute_of_day / 60) STORED,
+            Response_time FLOAT
+        )
+        '''
+    )
+
+    # NYC rows keep their Fire_id so Fire_Neighborhood_Relationship stays valid
+    cur.execute(
+        '''
+        INSERT INTO Fire_Incidents (Fire_id, City, Incident_id, Epoch, Minute_of_day, Response_time)
+        SELECT Fire_id, 'NYC', Incident_id,
+            CAST(strftime('%s', Date || ' ' || Time) AS INTEGER),
+            CAST(substr(Time, 1, 2) AS INTEGER) * 60 + CAST(substr(Time, 4, 2) AS INTEGER),
+            Response_time
+        FROM NYC_Fires
+        WHERE Time IS NOT NULL
+        ORDER BY Fire_id
+        '''
+    )
+    # LA_Fires never stored the date, so those rows have no Epoch
+    cur.execute(
+        '''
+        INSERT INTO Fire_Incidents (City, Incident_id, Epoch, Minute_of_day, Response_time)
+        SELECT 'LA', Incident_id, NULL,
+            CAST(substr(Time, 1, 2) AS INTEGER) * 60 + CAST(substr(Time, 4, 2) AS INTEGER),
+            Response_time
+        FROM LA_Fires
+        WHERE Time IS NOT NULL
+        ORDER BY Fire_id
+        '''
+    )
+    cur.execute('DROP TABLE NYC_Fires')
+    cur.execute('DROP TABLE LA_Fires')
+
+    cur.execute('CREATE UNIQUE INDEX Fire_Incidents_Incident_id ON Fire_Incidents (City, Incident_id)')
+    cur.execute('CREATE INDEX Fire_Incidents_Bucket ON Fire_Incidents (City, Hour_bucket, Response_time)')
+    cur.execute('CREATE INDEX Fire_Incidents_Epoch ON Fire_Incidents (City, Epoch)')
+
+    # the old names stay readable for anyone querying fire_data.db by hand
+    cur.execute(
+        '''
+        CREATE VIEW NYC_Fires AS
+        SELECT Fire_id, Incident_id, date(Epoch, 'unixepoch') AS Date,
+            printf('%02d:%02d', Minute_of_day / 60, Minute_of_day % 60) AS Time, Response_time
+        FROM Fire_Incidents WHERE City = 'NYC'
+        '''
+    )
+    cur.execute(
+        '''
+        CREATE VIEW LA_Fires AS
+        SELECT Fire_id, Incident_id,
+            printf('%02d:%02d', Minute_of_day / 60, Minute_of_day % 60) AS Time, Response_time
+        FROM Fire_Incidents WHERE City = 'LA'
+        '''
+    )
+
+    # point the relationship table at Fire_Incidents
+    cur.execute(
+        '''
+        CREATE TABLE Fire_Neighborhood_Relationship_v2 (
+            Fire_ID INTEGER UNIQUE,
+            Neighborhood_ID INTEGER,
+            FOREIGN KEY(Fire_ID) REFERENCES Fire_Incidents(Fire_id),
+            FOREIGN KEY(Neighborhood_ID) REFERENCES neighborhood_ID(Neighborhood_ID)
+        )
+        '''
+    )
+    # links to fires that were never copied would now point at LA fires, so only NYC ones are kept
+    cur.execute(
+        '''
+        INSERT INTO Fire_Neighborhood_Relationship_v2 (Fire_ID, Neighborhood_ID)
+        SELECT Fire_ID, Neighborhood_ID FROM Fire_Neighborhood_Relationship
+        WHERE Fire_ID IN (SELECT Fire_id FROM Fire_Incidents WHERE City = 'NYC')
+        '''
+    )
+    cur.execute('DROP TABLE Fire_Neighborhood_Relationship')
+    cur.execute('ALTER TABLE Fire_Neighborhood_Relationship_v2 RENAME TO Fire_Neighborhood_Relationship')
+
+
+#version 3: rollup table kept up to date by the loaders, filled from what is already loaded
+def migrate_3(cur):
+    cur.execute(
+        '''
+        CREATE TABLE Fire_Rollups (
+            City TEXT,
+            Borough TEXT,
+            Day TEXT,
+            Hour INTEGER,
+            N INTEGER,
+            Total FLOAT,
+            Total_sq FLOAT,
+            Sketch BLOB NOT NULL DEFAULT x'',
+            PRIMARY KEY (City, Borough, Day, Hour)
+        ) WITHOUT ROWID
+        '''
+    )
+    rebuild_rollups(cur)
+
+
+#version 4: calculation results per run, see results.py, and the fingerprints of the charts drawn from them, see charts.py
+def migrate_4(cur):
+    cur.execute(
+        '''
+        CREATE TABLE Calculation_Results (
+            Run_id TEXT,
+            City TEXT,
+            Metric TEXT,
+            Bucket TEXT,
+            Position INTEGER,
+            Value FLOAT,
+            Created_at TEXT,
+            PRIMARY KEY (Run_id, City, Metric, Bucket)
+        )
+        '''
+    )
+    cur.execute('CREATE INDEX Calculation_Results_Latest ON Calculation_Results (City, Metric, Created_at)')
+    cur.execute(
+        '''
+        CREATE TABLE Chart_Renders (
+            Chart TEXT PRIMARY KEY,
+            Fingerprint TEXT
+        )
+        '''
+    )
+
+
+#version 5: LA response times that crossed midnight were stored negative, they ended on the next day
+def migrate_5(cur):
+    cur.execute("UPDATE Fire_Incidents SET Response_time = Response_time + 1440 WHERE City = 'LA' AND Response_time < 0")
+    rebuild_rollups(cur)
+
+
+#version 6: a counter per city bumped by every batch that changes its fires, see cache.py
+def migrate_6(cur):
+    cur.execute(
+        '''
+        CREATE TABLE Data_Versions (
+            City TEXT PRIMARY KEY,
+            Version INTEGER NOT NULL
+        )
+        '''
+    )
+
+
+MIGRATIONS = [migrate_1, migrate_2, migrate_3, migrate_4, migrate_5, migrate_6]
+
+
+def _schema_version(cur):
+    cur.execute("PRAGMA user_version")
+    return cur.fetchone()[0]
+
+
+#brings the schema up to the latest version
+def migrate(cur, conn):
+    '''
+    each step takes the write lock before it reads the version, so when two scripts (or a WriteQueue and a
+    script) start on an old fire_data.db at the same time, the second one waits and then sees the steps
+    the first one already applied instead of running them again
+    '''
+    conn.commit()
+    if _schema_version(cur) >= len(MIGRATIONS):
+        return  # up to date, no need to wait for the write lock
+
+    while True:
+        conn.commit()
+        cur.execute("BEGIN IMMEDIATE")  # so a migration that fails half way leaves nothing behind
+        try:
+            version = _schema_version(cur)
+            if version >= len(MIGRATIONS):
+                conn.commit()
+                return
+            MIGRATIONS[version](cur)
+            cur.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Migrated fire_data.db to schema version {version + 1}.")
+
+
+#newest source timestamp that has been loaded, None before the first load
+def load_high_water_mark(cur, source):
+    cur.execute(
+        '''
+        SELECT High_water_mark FROM Ingest_State WHERE Source = ?
+        ''',
+        (source,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def save_high_water_mark(cur, conn, source, high_water_mark):
+    if high_water_mark is None:
+        return  # nothing new was loaded
+    cur.execute(
+        '''
+        INSERT INTO Ingest_State (Source, High_water_mark) VALUES (?, ?)
+        ON CONFLICT(Source) DO UPDATE SET High_water_mark = MAX(High_water_mark, excluded.High_water_mark)
+        ''',
+        (source, high_water_mark)
+    )
+    conn.commit()
+
+
+#byte offset in store up to which source has been loaded, None if it never was (or from another store)
+def load_store_offset(cur, source, store):
+    cur.execute(
+        '''
+        SELECT Store, Store_offset FROM Ingest_State WHERE Source = ?
+        ''',
+        (source,)
+    )
+    row = cur.fetchone()
+    if row is None or row[0] != store:
+        return None
+    return row[1]
+
+
+def save_store_offset(cur, conn, source, store, offset):
+    cur.execute(
+        '''
+        INSERT INTO Ingest_State (Source, Store, Store_offset) VALUES (?, ?, ?)
+        ON CONFLICT(Source) DO UPDATE SET Store = excluded.Store, Store_offset = excluded.Store_offset
+        ''',
+        (source, store, offset)
+    )
+    conn.commit()
+
+
+#the one place fire_data.db lives: next to the scripts, not the directory they were started from
+def database_path(db_name=DB_NAME):
+    return project_path(db_name)
+
+
+#opens the database with WAL and the tuned pragmas
+def connect(db_name=DB_NAME, read_only=False):
+    '''
+    read_only connections can't write (mode=ro) and can be handed from one thread to another
+    '''
+    path = database_path(db_name)
+    if read_only:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_TIMEOUT, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(path, timeout=DB_TIMEOUT)
+        conn.execute("PRAGMA journal_mode = WAL")
+    for name, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+#runs every write job on one connection in its own thread, in the order they were submitted
+class WriteQueue:
+    '''
+    a job is fn(cur, conn, *args) and commits its own transactions like the loaders already do,
+    a job that raises is rolled back and its exception comes out of the caller's result()
+    the schema is migrated before the first job runs
+    '''
+
+    def __init__(self, db_name=DB_NAME):
+        self.db_name = db_name
+        self.jobs = queue.Queue()
+        self.ready = Future()
+        self.thread = threading.Thread(target=self._work, name="fire_db-writer", daemon=True)
+        self.thread.start()
+        self.ready.result()  # raises here if the database can't be opened or migrated
+
+    def _work(self):
+        try:
+            conn = connect(self.db_name)
+            cur = conn.cursor()
+            migrate(cur, conn)
+        except Exception as e:
+            self.ready.set_exception(e)
+            return
+        self.ready.set_result(None)
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            future, fn, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(cur, conn, *args))
+            except BaseException as e:
+                conn.rollback()
+                future.set_exception(e)
+
+        # fold the WAL back into the database file, so fire_data.db is complete on its own again
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.jobs.put((future, fn, args))
+        return future
+
+    #submits fn and waits for its result
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    #finishes the jobs already submitted, then closes the connection
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+#read-only connections shared by the reading stages (aggregations, charts, exports)
+class ReaderPool:
+    '''
+    connections are opened when first needed, up to size of them, and reused after that
+    a thread asking for one while all are lent out waits for one to come back
+    '''
+
+    def __init__(self, db_name=DB_NAME, size=READERS):
+        self.db_name = db_name
+        self.size = size
+        self.opened = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    #lends out a cursor for the with block
+    @contextmanager
+    def cursor(self):
+        conn = self._take()
+        try:
+            yield conn.cursor()
+        finally:
+            conn.rollback()  # ends the read transaction so the next reader sees new commits
+            self.idle.put(conn)
+
+    def _take(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if not can_open:
+            return self.idle.get()
+        try:
+            return connect(self.db_name, read_only=True)
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def close(self):
+        with self.lock:
+            while self.opened:
+                self.idle.get().close()
+                self.opened -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+
+'''Where the files of the project live and how they are written.
+    Every file the scripts read or write (fire_data.db, the raw stores, calculations.txt, the charts, run
+    metrics, column exports) is found through project_path, so a relative name always means the same file
+    next to the scripts, whatever directory a script is started from.
+'''
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+#absolute path of a project file, relative names are next to the scripts instead of the working directory
+def project_path(name):
+    if name == ":memory:" or os.path.isabs(name):
+        return name
+    return os.path.join(SCRIPT_DIR, name)
+
+
+#writes data (str or bytes) to path in one step, creating its folder if needed
+def write_atomic(path, data):
+    '''
+    data goes to a temporary file next to path that is then moved over it, so a reader (even one in
+    another process) sees either the old file or the new one, never half of one
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        if isinstance(data, bytes):
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        else:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+        os.chmod(temp_path, 0o644)  # mkstemp makes the file readable by us only
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,102 @@
+from datetime import date, datetime
+
+import numpy as np
+
+
+'''Helpers for turning the SODA timestamp strings into the integer time columns of Fire_Incidents.
+    Times stay in the wall clock time the datasets give us: Epoch is that wall clock time counted as if it
+    were UTC, so date(Epoch, 'unixepoch') in SQLite gives back the date printed in the source data and
+    Minute_of_day is the hour and minute of the call.
+    The LA clock times ("HH:MM:SS.fff") and dates also have vectorized parsers that work on a whole batch
+    of strings at once, reading the digits straight out of a fixed-width byte array.
+'''
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+DAY_NAMES = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]  # strftime('%w') order
+MONTH_NAMES = ["January", "February", "March", "April", "May", "June", "July",
+               "August", "September", "October", "November", "December"]
+
+
+#"2021-01-04T00:21:00.000" -> (epoch seconds, minute of the day)
+def parse_timestamp(text):
+    moment = datetime.fromisoformat(text)
+    minute_of_day = moment.hour * 60 + moment.minute
+    epoch = (moment.toordinal() - EPOCH_ORDINAL) * 86400 + minute_of_day * 60 + moment.second
+    return epoch, minute_of_day
+
+
+#epoch seconds for a date ("2021-01-04" or a floating timestamp at midnight) plus seconds into that day
+def epoch_from_date(date_text, seconds_of_day):
+    day = date.fromisoformat(date_text[:10])
+    return (day.toordinal() - EPOCH_ORDINAL) * 86400 + seconds_of_day
+
+
+SECONDS_PER_DAY = 86400
+MICROSECONDS_PER_DAY = SECONDS_PER_DAY * 1000000
+CLOCK_WIDTH = 16  # "HH:MM:SS." plus up to 6 fraction digits, one more byte to catch longer strings
+_FRACTION_PLACES = np.array([100000, 10000, 1000, 100, 10, 1], dtype=np.int64)
+
+
+#microseconds into the day of a "HH:MM:SS.fff" clock time, raises ValueError on anything else
+def clock_microseconds(text):
+    moment = datetime.strptime(text, "%H:%M:%S.%f")
+    return ((moment.hour * 60 + moment.minute) * 60 + moment.second) * 1000000 + moment.microsecond
+
+
+#clock_microseconds for a whole list of strings at once
+def clock_microseconds_array(texts):
+    '''
+    returns (microseconds into the day as int64, bool mask of the strings that parsed)
+    only the zero padded form is accepted (two digit fields, 1 to 6 fraction digits), strings outside the
+    mask may still be valid for strptime, so callers parse those with clock_microseconds
+    raises UnicodeEncodeError for non-ASCII text
+    '''
+    raw = np.array(texts, dtype=f"S{CLOCK_WIDTH}").view(np.uint8).reshape(-1, CLOCK_WIDTH)
+    digits = raw - np.uint8(ord("0"))  # stays uint8, anything but a digit wraps around to more than 9
+    is_digit = digits <= 9
+
+    # HH:MM:SS
+    ok = (raw[:, 2] == ord(":")) & (raw[:, 5] == ord(":")) & (raw[:, 8] == ord("."))
+    ok &= is_digit[:, [0, 1, 3, 4, 6, 7]].all(axis=1)
+    hours = digits[:, 0] * np.int64(10) + digits[:, 1]
+    minutes = digits[:, 3] * np.int64(10) + digits[:, 4]
+    seconds = digits[:, 6] * np.int64(10) + digits[:, 7]
+    ok &= (hours < 24) & (minutes < 60) & (seconds < 60)
+
+    # fraction: digits until the padding, at least one of them
+    tail = slice(9, 9 + len(_FRACTION_PLACES))
+    is_pad = raw[:, tail] == 0
+    ok &= is_digit[:, 9] & (raw[:, CLOCK_WIDTH - 1] == 0)
+    ok &= (is_digit[:, tail] | is_pad).all(axis=1) & ~(is_pad[:, :-1] & ~is_pad[:, 1:]).any(axis=1)
+    fraction = (digits[:, tail] * is_digit[:, tail]) @ _FRACTION_PLACES
+
+    microseconds = ((hours * 60 + minutes) * 60 + seconds) * 1000000 + fraction
+    return np.where(ok, microseconds, 0), ok
+
+
+#days since 1970-01-01 of a list of dates ("2021-01-04" or a floating timestamp), like epoch_from_date
+def day_numbers_array(texts):
+    '''
+    returns (days as int64, bool mask of the dates that parsed)
+    works on the digits directly (casting strings to datetime64 is slower and can't report bad dates per row)
+    '''
+    raw = np.array(texts, dtype="S10").view(np.uint8).reshape(-1, 10)
+    digits = raw - np.uint8(ord("0"))
+    ok = (raw[:, 4] == ord("-")) & (raw[:, 7] == ord("-"))
+    ok &= (digits <= 9)[:, [0, 1, 2, 3, 5, 6, 8, 9]].all(axis=1)
+
+    year = digits[:, 0] * np.int64(1000) + digits[:, 1] * np.int64(100) + digits[:, 2] * np.int64(10) + digits[:, 3]
+    month = digits[:, 5] * np.int64(10) + digits[:, 6]
+    day = digits[:, 8] * np.int64(10) + digits[:, 9]
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_length = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(month, 0, 12)] + (leap & (month == 2))
+    ok &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_length)
+
+    # days from the civil calendar, counting years from March so the leap day comes last
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    return np.where(ok, days, 0), ok
@@ -0,0 +1,313 @@
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+import requests
+
+import metrics
+from aggregations import response_time_stats
+from cache import bump_data_version
+from charts import city_charts, render_charts
+from fire_db import DB_NAME, ReaderPool, WriteQueue, connect, load_high_water_mark, load_store_offset, migrate
+from fire_db import save_high_water_mark, save_store_offset
+from fire_files import project_path
+from pipeline import BATCH_SIZE, records_since, run_pipeline, transform_batch
+from raw_store import append_records, read_records
+from results import AVG_RESPONSE_TIME_2H, export_calculations_txt, save_results
+from rollups import update_rollups
+from soda_client import fetch_pages
+
+
+'''Ingestion engine shared by every city.
+    A city is described by a SourceAdapter: where its SODA endpoint is, which fields hold the incident ID and
+    the date, and how a raw record turns into the time columns and response time of Fire_Incidents.
+    The engine does the rest the same way for every city: fetch the pages into the city's raw store, stream
+    the records appended since the last load into Fire_Incidents (keeping the rollups, the high-water mark
+    and the store offset up to date) and compute the per-period results. Loading doesn't wait for the whole
+    download: every LOAD_EVERY rows stored, the fetch loads what is in the store so far while the next pages
+    keep downloading. NYCfire_response.py and LA_firenew.py hold the NYC and LA adapters, adding a city
+    means writing one more adapter.
+    ingest_all loads several cities at once: each city fetches its pages in its own thread, and the loads
+    into Fire_Incidents go through one fire_db.WriteQueue so only one city writes at a time.
+    Every stage is timed and counted in metrics.py under the city's label.
+'''
+
+MISSING_ID = "missing incident ID"  # skip reason of rows without one
+LOAD_EVERY = BATCH_SIZE  # rows a fetch appends to the raw store between loads
+
+
+class SourceAdapter:
+    '''
+    one city's data source, subclasses fill in the attributes and override the methods they need
+    city is the City value in Fire_Incidents and the source name for checkpoints and the high-water mark
+    '''
+    city = None
+    base_url = None
+    store = None  # raw store file, end the name in .gz or .zst to compress it
+    date_field = None  # field the high-water mark is kept on, ISO dates compare as text
+    skip_reasons = {}  # error name -> extra note printed with the skipped count
+    filtered_reason = None  # name records that times() leaves out are counted under, None to not count them
+
+    #filters for the SODA request, without the high-water mark
+    def params(self):
+        return {}
+
+    #the ID the raw store and Fire_Incidents dedupe on, None if the record has none
+    def incident_id(self, data):
+        raise NotImplementedError
+
+    #(Epoch, Minute_of_day, Response_time in minutes) of a record, None if it can't be used
+    def times(self, data):
+        raise NotImplementedError
+
+    def borough(self, data):
+        return None
+
+    #turns one raw record into a Fire_Incidents row, None if it has no usable response time
+    def transform(self, data):
+        times = self.times(data)
+        if times is None:
+            return None
+        Epoch, Minute_of_day, Response_time = times
+        return {
+            "City": self.city,
+            "Incident_id": self.incident_id(data),
+            "Epoch": Epoch,
+            "Minute_of_day": Minute_of_day,
+            "Response_time": round(Response_time, 2),
+            "Borough": self.borough(data),  # only used for the rollups
+        }
+
+    #turns a whole batch into rows, adapters with a faster way than one record at a time override this
+    def transform_batch(self, batch, skipped):
+        return transform_batch(batch, self.transform, skipped, self.filtered_reason)
+
+    #runs after the new records are in Fire_Incidents, for tables of one city only
+    def after_load(self, cur, conn, records, batch_size):
+        pass
+
+
+#creates or upgrades fire_data.db next to the scripts
+def set_up_database(db_name=DB_NAME):
+    conn = connect(db_name)  # WAL and the pragmas from fire_db.PRAGMAS
+    cur = conn.cursor()
+    migrate(cur, conn)  # creates or upgrades the tables, existing rows are kept
+    return cur, conn
+
+
+#pulls the source's new records from its API into its raw store, a chunk at a time as they download
+def fetch_source(source, cur, conn, load=None):
+    '''
+    progress is checkpointed in the database so an interrupted run resumes where it stopped
+    records older than the source's high-water mark are not requested again
+    load(), if given, is called every LOAD_EVERY rows stored to load them while fetch_pages downloads the
+    next pages in its threads; what is stored after the last call is left for the caller to load
+    '''
+    params = source.params()
+    high_water_mark = load_high_water_mark(cur, source.city)
+    if high_water_mark is not None:
+        where = f"{source.date_field} >= '{high_water_mark}'"
+        params["$where"] = f"({params['$where']}) AND {where}" if "$where" in params else where
+
+    with metrics.stage("fetch"):
+        try:
+            received = 0
+            unloaded = 0
+            for page in fetch_pages(source.base_url, params, source.city, cur, conn):
+                received += len(page)
+                # save the chunk before the checkpoint moves past it
+                added = append_records(source.store, page, source.incident_id, cur, conn)
+                metrics.count("rows_stored", added)
+                print(f"{added} new rows out of {len(page)} appended to {source.store}.")
+                unloaded += added
+                if load is not None and unloaded >= LOAD_EVERY:
+                    load()
+                    unloaded = 0
+            if not received:
+                print(f"No {source.city} data received from the API.")
+        except requests.exceptions.HTTPError as err:
+            print(f"Failed to retrieve {source.city} data from the API:", err)
+            metrics.log_error("fetch_failed", err)
+        except json.decoder.JSONDecodeError as err:
+            print(f"Error decoding {source.city} JSON response:", err)
+            metrics.log_error("fetch_failed", err)
+
+
+#source.transform_batch, leaving out the rows without an incident ID
+#they can't be matched to the row they made before, so every load of them would add another one
+def _rows_with_ids(source, batch, skipped, incidents=None):
+    rows = source.transform_batch(batch, skipped)
+    kept = [row for row in rows if row["Incident_id"] is not None]
+    if len(kept) < len(rows):
+        skipped[MISSING_ID] = skipped.get(MISSING_ID, 0) + len(rows) - len(kept)
+    if incidents is not None:
+        incidents.append_rows(kept)
+    return kept
+
+
+#streams records into Fire_Incidents as fires of the source's city, batch_size rows per transaction
+#an incident that is already in the table gets updated instead of added twice
+#incidents, a columnar.IncidentColumns, also gets every row written (an incident loaded twice is in it twice)
+def insert_data_to_fires_table(source, cur, conn, json_data, batch_size=BATCH_SIZE, incidents=None):
+    inserted, skipped = run_pipeline(
+        cur, conn, json_data, source.transform,
+        '''
+        INSERT INTO Fire_Incidents (City, Incident_id, Epoch, Minute_of_day, Response_time)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(City, Incident_id) DO UPDATE SET
+            Epoch = excluded.Epoch,
+            Minute_of_day = excluded.Minute_of_day,
+            Response_time = excluded.Response_time
+        ''',
+        batch_size,
+        params=itemgetter("City", "Incident_id", "Epoch", "Minute_of_day", "Response_time"),
+        # keeps the rollups and the cached results in step with each batch, inside the batch's transaction
+        before_insert=lambda cur, rows: (update_rollups(cur, source.city, rows), bump_data_version(cur, source.city)),
+        batch_transform=lambda batch, skipped: _rows_with_ids(source, batch, skipped, incidents)
+    )
+
+    for error, count in skipped.items():
+        print(f"{error}: skipped {count} {source.city} data entries. {source.skip_reasons.get(error, '')}".rstrip())
+        metrics.count("rows_rejected", count, reason=error)
+    metrics.count("rows_inserted", inserted)
+    print(f"Inserted {inserted} {source.city} rows into Fire_Incidents.")
+    return inserted
+
+
+#loads what was appended to the raw store since the last load, then moves the high-water mark forward
+def load_source(source, cur, conn, batch_size=BATCH_SIZE, incidents=None):
+    '''
+    reading starts at the store offset the last load stopped at, so a refresh reads and parses only the new
+    records (including ones a run fetched but stopped before loading) however long the history is
+    a store that has no offset yet (loaded before offsets were kept) is read whole once, leaving out the
+    records older than the high-water mark
+    incidents, a columnar.IncidentColumns, is filled with the rows as they are parsed, so the loaded fires
+    can be analysed without reading them back from the database
+    returns the number of rows inserted
+    '''
+    store = project_path(source.store)
+    offset = load_store_offset(cur, source.city, store)
+    high_water_mark = load_high_water_mark(cur, source.city) if offset is None else None
+    latest = {}
+    position = {}
+    # each stage streams the new part of the raw store instead of loading it all at once
+    with metrics.stage("insert"):
+        records = records_since(read_records(store, offset or 0, position), source.date_field, high_water_mark, latest)
+        inserted = insert_data_to_fires_table(source, cur, conn, records, batch_size, incidents)
+    with metrics.stage("after_load"):
+        source.after_load(cur, conn, records_since(read_records(store, offset or 0), source.date_field, high_water_mark), batch_size)
+    save_high_water_mark(cur, conn, source.city, latest.get("value"))
+    save_store_offset(cur, conn, source.city, store, position["offset"])
+    return inserted
+
+
+#load_source as a WriteQueue job, on the writer's thread but still counted under the city
+def _load_job(cur, conn, source, batch_size):
+    with metrics.labels(city=source.city):
+        load_source(source, cur, conn, batch_size)
+
+
+#fetches one city on its own connection, queueing its loads on writer as it goes, runs in ingest_all's threads
+def ingest_city(source, writer, batch_size=BATCH_SIZE):
+    '''
+    the fetch only writes checkpoints and raw store IDs, a few rows per page, so it keeps its own connection
+    and the pages of every city download at the same time
+    every LOAD_EVERY rows stored a load is queued and the fetch goes on without waiting for it; while one is
+    still queued or running no other is, the next one picks up everything stored since
+    '''
+    with metrics.labels(city=source.city):
+        loads = []
+
+        def load():
+            if loads and not loads[-1].done():
+                return
+            loads.append(writer.submit(_load_job, source, batch_size))
+
+        conn = connect(writer.db_name)
+        try:
+            fetch_source(source, conn.cursor(), conn, load)
+        finally:
+            conn.close()
+        with metrics.timer("write_queue_seconds"):
+            for future in loads:
+                future.result()  # raises what went wrong with a load during the fetch
+            writer.run(_load_job, source, batch_size)
+
+
+#ingests every source at the same time into Fire_Incidents, returns the cities that failed
+def ingest_all(sources, db_name=DB_NAME, batch_size=BATCH_SIZE):
+    failed = []
+    # the writer migrates before taking jobs, so the threads never race on the schema
+    with WriteQueue(db_name) as writer, ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = {pool.submit(ingest_city, source, writer, batch_size): source for source in sources}
+        for future, source in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"An error occurred while ingesting {source.city}:", e)
+                metrics.log_error("ingest_failed", e, city=source.city)
+                failed.append(source.city)
+    return failed
+
+
+#average response time per 2-hour period of one city, saved to Calculation_Results under run_id
+def calculate_avg_response_time_per_period(cur, conn, city, run_id):
+    try:
+        # same bucketing code for every city so they stay comparable
+        with metrics.stage("calculate_avg_response_time", city=city):
+            avg_response_times_per_period = response_time_stats(cur, city, "2h", quantiles=False)
+
+        #create lists to make creating the vizualization more straight forward
+        periods = [row["label"] for row in avg_response_times_per_period]
+        avg_response_times = [row["mean"] for row in avg_response_times_per_period]
+        save_results(cur, conn, run_id, city, AVG_RESPONSE_TIME_2H, zip(periods, avg_response_times))
+
+        print(f"Average response time per 2-hour period in {city} calculated and saved to Calculation_Results.")
+        return periods, avg_response_times
+    except Exception as e:
+        print("An error occurred while calculating the average response time per period:", e)
+        metrics.log_error("calculation_failed", e, city=city)
+        return None, None
+
+
+#loads NYC and LA together, then writes the results and charts of both
+def main():
+    # the adapters live in the city scripts, which import this module themselves
+    from LA_firenew import LASource
+    from NYCfire_response import NYCSource, calculate_avg_fires_per_neighborhood
+
+    try:
+        # the metrics file is named after run_id, the same Run_id the results are saved under
+        with metrics.run("ingest") as run_id:
+            sources = [NYCSource("Structural Fires"), LASource()]
+            failed = ingest_all(sources)
+
+            cur, conn = set_up_database()
+            calculate_avg_fires_per_neighborhood(cur, conn, run_id)
+            for source in sources:
+                calculate_avg_response_time_per_period(cur, conn, source.city, run_id)
+
+            # the reports only read, so they don't hold up a load running in another process
+            with ReaderPool() as readers, readers.cursor() as read_cur:
+                charts = []
+                for source in sources:
+                    charts += city_charts(read_cur, source.city)
+                with metrics.stage("export"):
+                    export_calculations_txt(read_cur)
+            with metrics.stage("render"):
+                render_charts(cur, conn, charts)
+
+            conn.close()
+    except Exception as e:
+        # already logged with its traceback, the exit code tells a scheduler the run failed
+        print("An error has occurred:", e)
+        sys.exit(1)
+    if failed:
+        # the other cities are still reported, but the run did not load everything
+        print(f"Failed to ingest {', '.join(failed)}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
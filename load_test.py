@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+'''Load test for service.py.
+    Opens --concurrency keep-alive connections and has each of them send requests back to back for
+    --duration seconds, picking paths at random from --paths (by default a mix of the endpoints a dashboard
+    calls). Prints requests per second, latency percentiles and the count of every status code, and exits
+    with 1 if any request failed or the rate is under --min-rps.
+    run with: python service.py & python load_test.py --concurrency 50 --duration 10
+'''
+
+PATHS = [
+    "/response-time?city=NYC&bucket=1h",
+    "/response-time?city=NYC&bucket=2h&borough=BROOKLYN",
+    "/response-time?city=LA&bucket=15min&quantiles=0",
+    "/response-time?city=NYC&bucket=dow",
+    "/fires-by-borough?city=NYC",
+    "/health",
+]
+
+
+#reads one response off the connection, returns (status, body size)
+async def read_response(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+
+    if headers.get("transfer-encoding") == "chunked":
+        size = 0
+        while True:
+            chunk_size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+            if chunk_size == 0:
+                return status, size
+    size = int(headers.get("content-length", 0))
+    await reader.readexactly(size)
+    return status, size
+
+
+#one keep-alive connection sending requests until deadline
+async def client(host, port, paths, deadline, latencies, statuses, rng):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            path = rng.choice(paths)
+            start = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            try:
+                status, _ = await read_response(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                statuses["connection error"] = statuses.get("connection error", 0) + 1
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(url, concurrency, duration, paths, seed=206):
+    parts = urlsplit(url)
+    latencies = []
+    statuses = {}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client(parts.hostname, parts.port or 80, paths, deadline, latencies, statuses, random.Random(seed + i))
+        for i in range(concurrency)
+    ))
+    return latencies, statuses, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the fire data HTTP service")
+    parser.add_argument("--url", default="http://127.0.0.1:8206")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--paths", nargs="+", default=PATHS)
+    parser.add_argument("--min-rps", type=float, default=0, help="exit with 1 below this many requests per second")
+    args = parser.parse_args()
+
+    latencies, statuses, elapsed = asyncio.run(run(args.url, args.concurrency, args.duration, args.paths))
+    if not latencies:
+        print("No request got an answer.")
+        sys.exit(1)
+
+    rps = len(latencies) / elapsed
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    print(f"{len(latencies)} requests in {elapsed:.1f}s over {args.concurrency} connections: {rps:,.0f} requests/sec")
+    print(f"latency p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms, max {max(latencies) * 1000:.2f} ms")
+    print("status codes:", ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items(), key=str)))
+
+    failed = sum(count for status, count in statuses.items() if status != 200)
+    if failed or rps < args.min_rps:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
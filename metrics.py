@@ -0,0 +1,239 @@
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+
+from fire_files import project_path, write_atomic
+from results import new_run_id
+
+
+'''Instrumentation of a run: counters, latency histograms and structured logs.
+    A script wraps its work in `with metrics.run("NYC") as run_id:` and the stages inside record what they
+    did: rows fetched, stored, inserted and rejected (by reason), bytes downloaded, and how long every page
+    fetch, batch, SQLite commit and calculation took. Every record carries the labels of the thread that made
+    it, so when ingest_all loads several cities at once each thread tags its numbers with its own city (a
+    pool working for one of them takes them over with current_labels).
+    Events (stage started/finished, errors with their traceback) are written as one JSON object per line to
+    stderr while the run goes. When the run ends, everything is written to metrics/<run_id>.json next to the
+    scripts, with a summary per city (rows in and out, reject ratio, errors) to alert on slow or lossy runs.
+    Outside of a run (for example in benchmark.py) recording does nothing.
+'''
+
+METRICS_DIR = "metrics"
+LOG_STREAM = sys.stderr
+# upper bounds of the latency histogram buckets in seconds, anything slower goes in the last one
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+_lock = threading.Lock()
+_local = threading.local()
+_run = None  # the run being recorded, see start_run
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+#labels of the current thread merged with the ones passed in
+def _labels(labels):
+    merged = dict(getattr(_local, "labels", {}))
+    merged.update(labels)
+    return merged
+
+
+#labels of the current thread, for handing on to the worker threads it starts
+def current_labels():
+    return _labels({})
+
+
+#adds labels to everything this thread records inside the with block
+@contextmanager
+def labels(**new_labels):
+    old = getattr(_local, "labels", {})
+    _local.labels = {**old, **new_labels}
+    try:
+        yield
+    finally:
+        _local.labels = old
+
+
+def count(name, value=1, **labels):
+    if _run is None:
+        return
+    key = _key(name, _labels(labels))
+    with _lock:
+        _run["counters"][key] = _run["counters"].get(key, 0) + value
+
+
+#adds one latency (in seconds) to the name histogram
+def observe(name, seconds, **labels):
+    if _run is None:
+        return
+    key = _key(name, _labels(labels))
+    with _lock:
+        histogram = _run["histograms"].get(key)
+        if histogram is None:
+            histogram = _run["histograms"][key] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(LATENCY_BUCKETS)}
+        histogram["count"] += 1
+        histogram["sum"] += seconds
+        histogram["max"] = max(histogram["max"], seconds)
+        histogram["buckets"][next(i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound)] += 1
+
+
+#times the with block into the name histogram
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+#writes one event as a JSON line to LOG_STREAM
+def log(event, **fields):
+    if _run is None:
+        return
+    record = {"time": datetime.now().isoformat(timespec="milliseconds"), "run_id": _run["run_id"], "event": event}
+    record.update(_labels(fields))
+    line = json.dumps(record, default=str)
+    with _lock:
+        LOG_STREAM.write(line + "\n")
+        LOG_STREAM.flush()
+
+
+#logs an exception with its traceback and counts it under errors
+def log_error(event, error, **fields):
+    error.metrics_logged = True  # so the stages and the run it goes up through don't log it again
+    count("errors", event=event, **fields)
+    log(
+        event,
+        error=str(error),
+        error_type=type(error).__name__,
+        traceback="".join(traceback.format_exception(type(error), error, error.__traceback__)),
+        **fields
+    )
+
+
+#times one stage of the run into stage_seconds and logs when it starts and ends
+@contextmanager
+def stage(name, **labels):
+    log("stage_started", stage=name, **labels)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        if not getattr(e, "metrics_logged", False):
+            log_error("stage_failed", e, stage=name, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("stage_seconds", elapsed, stage=name, **labels)
+    log("stage_finished", stage=name, seconds=round(elapsed, 4), **labels)
+
+
+#rough quantile of a histogram, the upper bound of the bucket it falls in
+def _quantile(histogram, q):
+    seen = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+        seen += bucket_count
+        if seen >= q * histogram["count"]:
+            return bound if bound != float("inf") else histogram["max"]
+    return histogram["max"]
+
+
+#rows in and out and errors per city, what an alert would look at
+def _summary(counters):
+    cities = {}
+    for (name, labels), value in counters.items():
+        if name not in ("rows_fetched", "rows_inserted", "rows_rejected", "errors"):
+            continue
+        city = cities.setdefault(dict(labels).get("city", ""), {"rows_fetched": 0, "rows_inserted": 0, "rows_rejected": 0, "errors": 0})
+        city[name] += value
+    for city in cities.values():
+        handled = city["rows_inserted"] + city["rows_rejected"]
+        city["reject_ratio"] = round(city["rows_rejected"] / handled, 4) if handled else 0.0
+    return cities
+
+
+def start_run(name, run_id=None):
+    global _run
+    _run = {
+        "run_id": run_id or new_run_id(),
+        "name": name,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "start": time.perf_counter(),
+        "counters": {},
+        "histograms": {},
+    }
+    log("run_started", name=name)
+    return _run["run_id"]
+
+
+#ends the run and writes its metrics file, returns the file's path
+def finish_run(status=None, directory=METRICS_DIR):
+    '''
+    status is "failed" if the run raised, otherwise "partial" if any error was counted and "ok" if not
+    '''
+    global _run
+    if _run is None:
+        return None
+    errors = sum(value for (name, _), value in _run["counters"].items() if name == "errors")
+    status = status or ("partial" if errors else "ok")
+    seconds = round(time.perf_counter() - _run["start"], 4)
+    log("run_finished", status=status, seconds=seconds, errors=errors)
+
+    with _lock:
+        metrics = {
+            "run_id": _run["run_id"],
+            "name": _run["name"],
+            "status": status,
+            "started_at": _run["started_at"],
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+            "seconds": seconds,
+            "summary": _summary(_run["counters"]),
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(_run["counters"].items())
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum": round(histogram["sum"], 6),
+                    "mean": round(histogram["sum"] / histogram["count"], 6),
+                    "p50": _quantile(histogram, 0.5),
+                    "p95": _quantile(histogram, 0.95),
+                    "max": round(histogram["max"], 6),
+                    "buckets": {str(bound): bucket_count for bound, bucket_count in zip(LATENCY_BUCKETS, histogram["buckets"]) if bucket_count},
+                }
+                for (name, labels), histogram in sorted(_run["histograms"].items())
+            ],
+        }
+        _run = None
+
+    path = os.path.join(project_path(directory), metrics["run_id"] + ".json")
+    write_atomic(path, json.dumps(metrics, indent=2))
+    print(f"Run metrics written to {path}.")
+    return path
+
+
+#records everything inside the with block as one run, yields its run_id
+@contextmanager
+def run(name, directory=METRICS_DIR):
+    '''
+    an exception is logged with its traceback and the metrics file is written as failed before it is raised again
+    '''
+    run_id = start_run(name)
+    try:
+        yield run_id
+    except BaseException as e:
+        if not getattr(e, "metrics_logged", False):
+            log_error("run_failed", e)
+        finish_run("failed", directory)
+        raise
+    finish_run(directory=directory)
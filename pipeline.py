@@ -0,0 +1,107 @@
+import time
+from itertools import islice
+
+import metrics
+
+
+'''Streaming pipeline that takes raw API records into our SQLite tables.
+    parse -> validate -> transform -> batch executemany
+    Records come in as an iterator (for example raw_store.read_records), so nothing is held in memory except
+    the current batch and there is no upper limit on the number of rows. Each batch is written with one
+    executemany inside a single transaction. How long each step of a batch takes is recorded in metrics.py.
+'''
+
+BATCH_SIZE = 100000  # rows per transaction, each rollup key and index page a batch touches is written once per batch
+
+
+#cuts any iterable into lists of batch_size items
+def batched(records, batch_size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+#only lets through records at or after the high-water mark
+def records_since(records, field, high_water_mark, latest=None):
+    '''
+    records missing field are let through since we can't tell how old they are
+    if latest is a dict, latest["value"] ends up as the newest field value seen
+    '''
+    newest = None
+    for record in records:
+        value = record.get(field)
+        if value is not None:
+            if high_water_mark is not None and value < high_water_mark:
+                continue
+            if newest is None or value > newest:
+                newest = value
+        yield record
+
+    if latest is not None and newest is not None:
+        latest["value"] = newest
+
+
+#turns records into rows, dropping the ones transform rejects
+def transform_batch(batch, transform, skipped, filtered=None):
+    '''
+    transform(record) returns a row tuple, or None if the record should be left out
+    records that raise KeyError/ValueError are counted in skipped by error name
+    if filtered is given, the records left out are counted in skipped under that name too
+    '''
+    rows = []
+    for record in batch:
+        try:
+            row = transform(record)
+        except (KeyError, ValueError) as e:
+            name = type(e).__name__
+            skipped[name] = skipped.get(name, 0) + 1
+            continue
+        if row is not None:
+            rows.append(row)
+        elif filtered is not None:
+            skipped[filtered] = skipped.get(filtered, 0) + 1
+    return rows
+
+
+def run_pipeline(cur, conn, records, transform, insert_sql, batch_size=BATCH_SIZE, before_insert=None, batch_transform=None, params=None):
+    '''
+    streams records through transform and inserts the rows with insert_sql, one transaction per batch
+    batch_transform(batch, skipped), if given, turns a whole batch into rows at once instead of calling
+    transform per record (same contract as transform_batch)
+    before_insert(cur, rows) runs in the same transaction just before each batch is written
+    params(row), if given, turns a row into the parameters of insert_sql, so rows can stay dicts while the
+    insert binds plain tuples to ? placeholders (cheaper than binding by name)
+    returns (rows inserted, dict of skipped record counts by error name)
+    '''
+    inserted = 0
+    skipped = {}
+
+    for batch in batched(records, batch_size):
+        start = time.perf_counter()
+        with metrics.timer("transform_seconds"):
+            if batch_transform is not None:
+                rows = batch_transform(batch, skipped)
+            else:
+                rows = transform_batch(batch, transform, skipped)
+        if not rows:
+            continue
+
+        try:
+            if before_insert is not None:
+                with metrics.timer("before_insert_seconds"):
+                    before_insert(cur, rows)
+            with metrics.timer("insert_seconds"):
+                # opens the batch's transaction if before_insert did not
+                cur.executemany(insert_sql, rows if params is None else map(params, rows))
+            with metrics.timer("commit_seconds"):
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        inserted += len(rows)
+        metrics.observe("batch_seconds", time.perf_counter() - start)
+
+    return inserted, skipped
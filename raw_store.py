@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from fire_files import project_path
+
+
+'''Append-only store for the raw records we pull from the APIs.
+    Every record is written as one JSON line (newline-delimited JSON), so a run only writes the new rows
+    instead of loading and re-dumping the whole history. Files ending in .gz are gzip compressed and files
+    ending in .zst are zstd compressed (needs the zstandard package); both formats allow appending new
+    compressed blocks to the end of the file.
+    The IDs of the records already stored are kept in the Raw_Store_IDs table of our database, which is how
+    duplicate rows (overlapping pages, re-runs) get dropped without reading the store back. Reading can start
+    at an offset, so a load only goes over the lines appended since the last one (see ingest.load_source).
+    Stores are named there by their full path (see fire_files.project_path), so a run started from another
+    directory still finds the IDs of its store.
+    Raw_Stores keeps the size of every store after its last finished append. A crash mid-append leaves a half
+    line (or half a compressed block) after that size, which the next append cuts off before it writes, so
+    the records after it never get glued onto a broken line.
+'''
+
+READ_LINES = 1000  # lines parsed per json.loads call
+
+
+#mode is "a" to append text or "rb" to read bytes, offsets are counted in uncompressed bytes
+def _open(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode) if "b" in mode else gzip.open(path, mode + "t", encoding="utf-8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError("the zstandard package is needed to use " + path)
+        if "b" in mode:
+            return io.BufferedReader(zstandard.open(path, mode))  # the bare reader can't read lines
+        return zstandard.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode) if "b" in mode else open(path, mode, encoding="utf-8")
+
+
+def _record_id(record, id_func):
+    record_id = id_func(record)
+    if record_id is None:
+        # no usable ID, fall back to the content so exact repeats still get caught
+        record_id = hashlib.sha1(json.dumps(record, sort_keys=True).encode("utf-8")).hexdigest()
+    return str(record_id)
+
+
+def _known_ids(cur, store, ids, chunk_size=500):
+    known = set()
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        cur.execute(
+            f'''
+            SELECT Source_id FROM Raw_Store_IDs
+            WHERE Store = ? AND Source_id IN ({",".join("?" * len(chunk))})
+            ''',
+            [store] + chunk
+        )
+        known.update(row[0] for row in cur.fetchall())
+    return known
+
+
+#cuts off whatever an append that never committed left after the store's last finished append
+def _cut_unfinished_append(cur, path):
+    '''
+    the IDs of that append were never committed, so its records are fetched and appended again anyway
+    '''
+    cur.execute("SELECT Size FROM Raw_Stores WHERE Store = ?", (path,))
+    row = cur.fetchone()
+    if row is None or not os.path.exists(path):
+        return
+    if os.path.getsize(path) > row[0]:
+        with open(path, "r+b") as store_file:
+            store_file.truncate(row[0])
+
+
+#appends the records we have not seen before to the end of the store
+def append_records(path, records, id_func, cur, conn):
+    '''
+    id_func(record) returns the incident ID used to drop duplicates
+    returns the number of records written
+    '''
+    path = project_path(path)
+
+    keyed = {}
+    for record in records:
+        keyed.setdefault(_record_id(record, id_func), record)  # also drops repeats inside one page
+
+    ids = list(keyed)
+    known = _known_ids(cur, path, ids)
+    new_ids = [record_id for record_id in ids if record_id not in known]
+    if not new_ids:
+        return 0
+
+    # the insert takes the write lock, so no other append to this database can be half way through the store
+    cur.executemany(
+        '''
+        INSERT INTO Raw_Store_IDs (Store, Source_id) VALUES (?, ?)
+        ''',
+        [(path, record_id) for record_id in new_ids]
+    )
+    _cut_unfinished_append(cur, path)
+    with _open(path, "a") as store_file:
+        for record_id in new_ids:
+            store_file.write(json.dumps(keyed[record_id], separators=(",", ":")) + "\n")
+    cur.execute(
+        '''
+        INSERT INTO Raw_Stores (Store, Size) VALUES (?, ?)
+        ON CONFLICT(Store) DO UPDATE SET Size = excluded.Size
+        ''',
+        (path, os.path.getsize(path))
+    )
+    conn.commit()  # only remember the IDs once the lines are on disk
+
+    return len(new_ids)
+
+
+#the next count whole lines of store_file, and whether the store ends after them
+def _next_lines(store_file, count):
+    lines = []
+    try:
+        for line in store_file:
+            if not line.endswith(b"\n"):
+                return lines, True  # unfinished append
+            lines.append(line)
+            if len(lines) == count:
+                return lines, False
+    except EOFError:
+        pass  # compressed block cut off by a crash
+    return lines, True
+
+
+#the records of whole lines, parsed as one JSON array, or line by line (None for a broken line) if that fails
+def _parse_lines(lines):
+    try:
+        records = json.loads(b"[" + b",".join(lines) + b"]")
+        if len(records) == len(lines):
+            return records
+    except ValueError:
+        pass
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            records.append(None)
+    return records
+
+
+#streams the store back one record at a time, from offset bytes in
+def read_records(path, offset=0, position=None):
+    '''
+    yields each stored record as a dict
+    if position is a dict, position["offset"] is kept at the end of the last record yielded, which is
+    where the next read should start to get only what was appended after it
+    compressed stores can't jump to an offset, they get there by decompressing (but not parsing) what is before
+    a missing store yields nothing, a half written last line (crash mid-append) is skipped
+    lines are parsed READ_LINES at a time as one JSON array, a single json.loads call is about 3x faster
+    than one per line; a block with a broken line in it is parsed line by line and the broken line skipped
+    '''
+    if position is not None:
+        position["offset"] = offset
+    try:
+        store_file = _open(project_path(path), "rb")
+    except FileNotFoundError:
+        return
+
+    with store_file:
+        try:
+            if offset:
+                store_file.seek(offset)
+        except EOFError:
+            return  # compressed block cut off by a crash
+        ended = False
+        broken = 0
+        while not ended:
+            lines, ended = _next_lines(store_file, READ_LINES)
+            if not lines:
+                break
+            for line, record in zip(lines, _parse_lines(lines)):
+                offset += len(line)
+                if position is not None:
+                    position["offset"] = offset
+                if record is None:
+                    broken += 1
+                    continue
+                yield record
+        if broken:
+            print(f"Skipped {broken} lines of {path} that are not valid JSON.")
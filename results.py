@@ -0,0 +1,92 @@
+import uuid
+from datetime import datetime
+
+from fire_files import project_path, write_atomic
+
+
+'''Results of the calculations, stored in the Calculation_Results table of fire_data.db.
+    Every run of a script gets its own Run_id and writes one row per (City, Metric, Bucket), so the NYC and LA
+    scripts can run at the same time without overwriting each other, and nothing has to parse calculations.txt
+    to get the numbers back.
+    calculations.txt is still produced for people to read, but it is rebuilt from the table as a whole and
+    swapped in atomically by export_calculations_txt.
+'''
+
+FIRES_PER_BOROUGH = "fires_per_borough"
+AVG_RESPONSE_TIME_2H = "avg_response_time_2h"
+
+# metric -> (section title in calculations.txt, how one value is written)
+REPORT_SECTIONS = {
+    FIRES_PER_BOROUGH: ("Average number of fires per neighborhood:", lambda value: f"{value:.0f}"),
+    AVG_RESPONSE_TIME_2H: ("Average response time per 2-hour period in {city}:", lambda value: f"{value:.2f} minutes"),
+}
+
+
+def new_run_id():
+    return datetime.now().strftime("%Y%m%dT%H%M%S-") + uuid.uuid4().hex[:8]
+
+
+#stores one metric for one city, rows are (bucket, value) in the order they should be shown
+def save_results(cur, conn, run_id, city, metric, rows):
+    created_at = datetime.now().isoformat(timespec="seconds")
+    cur.executemany(
+        '''
+        INSERT OR REPLACE INTO Calculation_Results (Run_id, City, Metric, Bucket, Position, Value, Created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''',
+        [(run_id, city, metric, str(bucket), position, value, created_at) for position, (bucket, value) in enumerate(rows)]
+    )
+    conn.commit()
+
+
+#run ID of the newest run that stored this metric for this city, None if there is none
+def latest_run_id(cur, city, metric):
+    cur.execute(
+        '''
+        SELECT Run_id FROM Calculation_Results
+        WHERE City = ? AND Metric = ?
+        ORDER BY Created_at DESC, Run_id DESC
+        LIMIT 1
+        ''',
+        (city, metric)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+#(bucket, value) rows of the newest run, or of run_id if given
+def load_results(cur, city, metric, run_id=None):
+    if run_id is None:
+        run_id = latest_run_id(cur, city, metric)
+        if run_id is None:
+            return []
+    cur.execute(
+        '''
+        SELECT Bucket, Value FROM Calculation_Results
+        WHERE Run_id = ? AND City = ? AND Metric = ?
+        ORDER BY Position
+        ''',
+        (run_id, city, metric)
+    )
+    return cur.fetchall()
+
+
+#rewrites calculations.txt from the latest results of every city and metric
+def export_calculations_txt(cur, path="calculations.txt"):
+    cur.execute(
+        '''
+        SELECT DISTINCT Metric, City FROM Calculation_Results
+        ORDER BY Metric = ?, City = 'LA', City
+        ''',
+        (AVG_RESPONSE_TIME_2H,)
+    )
+    sections = []
+    for metric, city in cur.fetchall():
+        if metric not in REPORT_SECTIONS:
+            continue
+        title, write_value = REPORT_SECTIONS[metric]
+        lines = [title.format(city=city)]
+        lines += [f"{bucket}: {write_value(value)}" for bucket, value in load_results(cur, city, metric)]
+        sections.append("\n".join(lines) + "\n")
+
+    write_atomic(project_path(path), "\n".join(sections))
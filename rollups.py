@@ -0,0 +1,267 @@
+import json
+import math
+from datetime import date, timedelta
+from functools import lru_cache
+from operator import itemgetter
+
+import numpy as np
+
+from cache import cached_query
+from fire_time import DAY_NAMES, MONTH_NAMES
+
+
+'''Pre-aggregated response times, kept up to date by the loaders.
+    Fire_Rollups holds one row per (City, Borough, Day, Hour) with the count, sum and sum of squares of the
+    response times and a Sketch of them: a log-bucketed histogram (every bin is within 1% of the values it
+    counts) packed as int32 (bin, count) pairs. All of it is plain sums, so merging two keys, or a new batch
+    into an old key, is just adding the numbers up and appending the pairs (a bin may show up more than once
+    in a Sketch, readers add its counts together); quantiles are read off the merged histogram.
+    update_rollups runs inside each insert batch's transaction, so the rollups always match Fire_Incidents and
+    report queries only read O(buckets) rows instead of every incident. The batch is summed per key with
+    numpy and written as one upsert per key, which keeps the loaders above 100k rows/sec (see benchmark.py).
+'''
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_VALUE = 0.01  # response times at or below this (in minutes) share the ZERO_BIN
+ZERO_BIN = -10000
+SKETCH_DTYPE = np.dtype("<i4")  # a Sketch is pairs of (bin, count) in this type
+FIRE_FIELDS = itemgetter("Borough", "Epoch", "Minute_of_day", "Response_time")  # a row as the fire _deltas takes
+
+
+#histogram bin of every response time in an array
+def sketch_bins(values):
+    bins = np.full(len(values), ZERO_BIN, dtype=np.int64)
+    above = values > MIN_VALUE
+    bins[above] = np.ceil(np.log(values[above]) / LOG_GAMMA)
+    return bins
+
+
+#value a bin stands for, at most RELATIVE_ACCURACY away from anything counted in it
+def bin_value(bin_number):
+    if bin_number == ZERO_BIN:
+        return 0.0
+    return 2 * GAMMA ** bin_number / (GAMMA + 1)
+
+
+#(bins, counts) of a Sketch, or of several joined together, sorted by bin and leaving out the empty bins
+def merge_sketches(sketch):
+    pairs = np.frombuffer(sketch, dtype=SKETCH_DTYPE).reshape(-1, 2)
+    bins, index = np.unique(pairs[:, 0], return_inverse=True)
+    counts = np.bincount(index.ravel(), weights=pairs[:, 1], minlength=len(bins)).astype(np.int64)
+    kept = counts > 0
+    return bins[kept], counts[kept]
+
+
+@lru_cache(maxsize=4096)
+def _day_text(day_number):
+    return (date(1970, 1, 1) + timedelta(days=day_number)).isoformat()
+
+
+#Fire_Rollups rows that add a batch of fires to the rollups of city
+def _deltas(city, fires, signs):
+    '''
+    fires are (Borough, Epoch, Minute_of_day, Response_time) tuples, signs is 1 for a fire to add and -1
+    for one to take back out; fires without a response time are not counted
+    the (City, Borough, Day, Hour) key is grouped with numpy, so the rows come out summed per key and
+    sorted like the primary key, which is the cheapest order to upsert them in
+    '''
+    if not fires:
+        return []
+    boroughs, epochs, minutes, response_times = zip(*fires)
+    values = np.array(response_times, dtype=float)  # None becomes NaN
+    counted = ~np.isnan(values)
+    values = values[counted]
+    signs = np.asarray(signs, dtype=np.int64)[counted]
+
+    boroughs = [borough or "" for borough in boroughs]
+    names = sorted(set(boroughs))
+    codes = {name: code for code, name in enumerate(names)}
+    borough_codes = np.fromiter((codes[borough] for borough in boroughs), dtype=np.int64, count=len(boroughs))[counted]
+    epochs = np.array(epochs, dtype=float)[counted]
+    dated = ~np.isnan(epochs)
+    days = np.zeros(len(values), dtype=np.int64)
+    days[dated] = epochs[dated] // 86400
+    hours = np.array(minutes, dtype=np.int64)[counted] // 60
+
+    # one int64 per key that sorts like (Borough, Day, Hour), so grouping is a single np.unique
+    first_day = int(days[dated].min()) if dated.any() else 0
+    day_codes = np.where(dated, days - first_day + 1, 0)  # 0 is no date, Day '' sorts first
+    day_span = int(day_codes.max()) + 1 if len(day_codes) else 1
+    keys, key_index = np.unique((borough_codes * day_span + day_codes) * 24 + hours, return_inverse=True)
+    key_index = key_index.ravel()
+    counts = np.bincount(key_index, weights=signs, minlength=len(keys)).astype(np.int64)
+    totals = np.bincount(key_index, weights=signs * values, minlength=len(keys))
+    squares = np.bincount(key_index, weights=signs * values * values, minlength=len(keys))
+
+    # the same for (key, bin), then each key's pairs are a slice of one packed buffer
+    bins = sketch_bins(values) - ZERO_BIN
+    bin_span = int(bins.max()) + 1 if len(bins) else 1
+    bin_keys, bin_index = np.unique(key_index * bin_span + bins, return_inverse=True)
+    bin_counts = np.bincount(bin_index.ravel(), weights=signs, minlength=len(bin_keys)).astype(np.int64)
+    kept = bin_counts != 0
+    bin_keys, bin_counts = bin_keys[kept], bin_counts[kept]
+    pairs = np.stack([bin_keys % bin_span + ZERO_BIN, bin_counts], axis=1).astype(SKETCH_DTYPE).tobytes()
+    bounds = np.searchsorted(bin_keys // bin_span, np.arange(len(keys) + 1)) * 2 * SKETCH_DTYPE.itemsize
+
+    # an incident that moves within its key leaves the count alone but still changes the sums
+    changed = (counts != 0) | (totals != 0) | (squares != 0) | (bounds[1:] != bounds[:-1])
+    key_numbers = keys[changed]
+    day_of_key = (key_numbers // 24 % day_span).tolist()
+    day_texts = {code: "" if code == 0 else _day_text(first_day + code - 1) for code in set(day_of_key)}
+    return [
+        (city, names[borough], day_texts[day], hour, count, total, square, pairs[start:end])
+        for borough, day, hour, count, total, square, start, end in zip(
+            (key_numbers // 24 // day_span).tolist(), day_of_key, (key_numbers % 24).tolist(),
+            counts[changed].tolist(), totals[changed].tolist(), squares[changed].tolist(),
+            bounds[:-1][changed].tolist(), bounds[1:][changed].tolist()
+        )
+    ]
+
+
+def _write(cur, rows):
+    cur.executemany(
+        '''
+        INSERT INTO Fire_Rollups (City, Borough, Day, Hour, N, Total, Total_sq, Sketch)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(City, Borough, Day, Hour) DO UPDATE SET
+            N = N + excluded.N,
+            Total = Total + excluded.Total,
+            Total_sq = Total_sq + excluded.Total_sq,
+            Sketch = CAST(Sketch || excluded.Sketch AS BLOB)
+        ''',
+        rows
+    )
+
+
+#folds one batch of fires into the rollups, call it before the batch is written to Fire_Incidents
+def update_rollups(cur, city, rows):
+    '''
+    rows are dicts with Incident_id, Epoch, Minute_of_day, Response_time and Borough
+    incidents that are already in Fire_Incidents are about to be overwritten by the upsert,
+    so their old numbers are taken back out first; an incident that is not linked to its borough yet
+    (NYC links are made after the fires are inserted) was counted under the borough it comes with now
+    '''
+    # an incident repeated in the batch ends up as one row, the last one
+    latest = {row["Incident_id"]: row for row in rows if row["Incident_id"] is not None}
+    if len(latest) < len(rows):
+        rows = list(latest.values()) + [row for row in rows if row["Incident_id"] is None]
+
+    # the IDs go in as one JSON array, so a single query finds the old rows of the whole batch
+    cur.execute(
+        '''
+        SELECT Fire_Incidents.Incident_id, Fire_Incidents.Epoch, Fire_Incidents.Minute_of_day,
+            Fire_Incidents.Response_time, neighborhood_ID.Neighborhood
+        FROM json_each(?) AS Batch
+        CROSS JOIN Fire_Incidents ON Fire_Incidents.City = ? AND Fire_Incidents.Incident_id = Batch.value
+        LEFT JOIN Fire_Neighborhood_Relationship ON Fire_Neighborhood_Relationship.Fire_ID = Fire_Incidents.Fire_id
+        LEFT JOIN neighborhood_ID ON neighborhood_ID.Neighborhood_ID = Fire_Neighborhood_Relationship.Neighborhood_ID
+        ''',
+        (json.dumps(list(latest)), city)
+    )
+    old_fires = [(borough or latest[incident_id]["Borough"], epoch, minute_of_day, response_time)
+                 for incident_id, epoch, minute_of_day, response_time, borough in cur.fetchall()]
+
+    fires = old_fires + list(map(FIRE_FIELDS, rows))
+    signs = np.concatenate([np.full(len(old_fires), -1), np.ones(len(rows), dtype=np.int64)])
+    _write(cur, _deltas(city, fires, signs))
+
+
+#fills the rollups from everything already in Fire_Incidents, chunk_size fires at a time
+def rebuild_rollups(cur, chunk_size=100000):
+    cur.execute("DELETE FROM Fire_Rollups")
+    cur.execute("SELECT DISTINCT City FROM Fire_Incidents")
+    reader = cur.connection.cursor()  # stays on the SELECT while cur writes
+    for (city,) in cur.fetchall():
+        reader.execute(
+            '''
+            SELECT neighborhood_ID.Neighborhood, Fire_Incidents.Epoch, Fire_Incidents.Minute_of_day,
+                Fire_Incidents.Response_time
+            FROM Fire_Incidents
+            LEFT JOIN Fire_Neighborhood_Relationship ON Fire_Neighborhood_Relationship.Fire_ID = Fire_Incidents.Fire_id
+            LEFT JOIN neighborhood_ID ON neighborhood_ID.Neighborhood_ID = Fire_Neighborhood_Relationship.Neighborhood_ID
+            WHERE Fire_Incidents.City = ? AND Fire_Incidents.Response_time IS NOT NULL
+            ''',
+            (city,)
+        )
+        while True:
+            fires = reader.fetchmany(chunk_size)
+            if not fires:
+                break
+            _write(cur, _deltas(city, fires, np.ones(len(fires), dtype=np.int64)))
+    reader.close()
+
+
+# bucket width -> (SQL for the bucket number from the rollup key, names a bucket number, needs a date)
+ROLLUP_BUCKETS = {
+    "1h": ("Hour", lambda bucket: f"{bucket:02d}:00 - {bucket:02d}:59", False),
+    "2h": ("Hour / 2", lambda bucket: f"{bucket * 2:02d}:00 - {bucket * 2 + 1:02d}:59", False),
+    "dow": ("CAST(strftime('%w', Day) AS INTEGER)", lambda bucket: DAY_NAMES[bucket], True),
+    "month": ("CAST(strftime('%m', Day) AS INTEGER)", lambda bucket: MONTH_NAMES[bucket - 1], True),
+}
+
+
+def _where(city, bucket, borough):
+    conditions = ["City = ?"]
+    params = [city]
+    if borough is not None:
+        conditions.append("Borough = ?")
+        params.append(borough)
+    if ROLLUP_BUCKETS[bucket][2]:
+        conditions.append("Day != ''")
+    return " AND ".join(conditions), params
+
+
+#quantile q of a histogram given as sorted bins and their counts
+def _sketch_quantile(bins, counts, total, q):
+    position = np.searchsorted(np.cumsum(counts), q * (total - 1), side="right")
+    return bin_value(int(bins[min(position, len(bins) - 1)]))
+
+
+#same output as aggregations.response_time_stats, read from the rollups
+def rollup_response_stats(cur, city, bucket="2h", borough=None):
+    '''
+    bucket is one of "1h", "2h", "dow" or "month" (the rollups are kept per hour)
+    count and mean are exact, median/p90/p99 come from the sketch
+    '''
+    expression, label, _ = ROLLUP_BUCKETS[bucket]
+    where, params = _where(city, bucket, borough)
+
+    # group_concat keeps the bytes of the Sketches, so a bucket's pairs come back as one buffer
+    cur.execute(
+        f'''
+        SELECT {expression} AS bucket, SUM(N), SUM(Total) / SUM(N), CAST(group_concat(Sketch, '') AS BLOB)
+        FROM Fire_Rollups WHERE {where}
+        GROUP BY bucket HAVING SUM(N) > 0 ORDER BY bucket
+        ''',
+        params
+    )
+
+    stats = []
+    for number, count, mean, sketch in cur.fetchall():
+        bins, counts = merge_sketches(sketch or b"")
+        stats.append({
+            "label": label(number),
+            "bucket": number,
+            "count": count,
+            "mean": mean,
+            "median": _sketch_quantile(bins, counts, count, 0.5) if len(bins) else None,
+            "p90": _sketch_quantile(bins, counts, count, 0.9) if len(bins) else None,
+            "p99": _sketch_quantile(bins, counts, count, 0.99) if len(bins) else None,
+        })
+    return stats
+
+
+#number of fires per borough straight from the rollups
+@cached_query
+def rollup_fires_per_borough(cur, city="NYC"):
+    cur.execute(
+        '''
+        SELECT Borough, SUM(N) FROM Fire_Rollups
+        WHERE City = ? AND Borough != ''
+        GROUP BY Borough ORDER BY Borough
+        ''',
+        (city,)
+    )
+    return cur.fetchall()
@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import cache
+from aggregations import BUCKETS, response_time_stats
+from fire_db import DB_NAME, READERS, ReaderPool, connect
+from rollups import rollup_fires_per_borough
+
+
+'''Small HTTP service answering questions about fire_data.db without rerunning the scripts.
+    GET /response-time?city=NYC&bucket=1h&borough=BROOKLYN   response time stats per bucket (aggregations.py)
+        also takes quantiles=0 and exact=1 like response_time_stats
+    GET /fires-by-borough?city=NYC                            number of fires per borough (rollups.py)
+    GET /incidents?city=LA&since=1609459200&until=...&limit=  the fires themselves, streamed as NDJSON
+    GET /health                                              data version of every city
+    Add format=ndjson to get a list back one JSON object per line instead of one JSON document.
+    Built on asyncio streams with keep-alive, so one process holds many connections. Queries run on a few
+    threads with read-only connections from a ReaderPool (so loads can keep writing meanwhile) and go
+    through the query cache in cache.py, so repeated requests don't touch the tables until the data changes.
+    run with: python service.py --port 8206, and load_test.py to see how many requests per second it takes
+'''
+
+HOST = "127.0.0.1"
+PORT = 8206
+STREAM_SIZE = 5000  # incidents per chunk of a streamed response
+TRUE_VALUES = ("1", "true", "yes")
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+#one query string value, default if it is missing
+def _param(params, name, default=None):
+    values = params.get(name)
+    return values[-1] if values else default
+
+
+def _int_param(params, name, default=None):
+    value = _param(params, name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer, got {value!r}")
+
+
+def response_time(cur, params):
+    bucket = _param(params, "bucket", "2h")
+    if bucket not in BUCKETS:
+        raise BadRequest(f"unknown bucket {bucket!r}, expected one of {', '.join(BUCKETS)}")
+    return response_time_stats(
+        cur,
+        _param(params, "city", "NYC"),
+        bucket,
+        _param(params, "borough"),
+        quantiles=_param(params, "quantiles", "1").lower() in TRUE_VALUES,
+        exact=_param(params, "exact", "0").lower() in TRUE_VALUES,
+    )
+
+
+def fires_by_borough(cur, params):
+    return [{"borough": borough, "fires": fires} for borough, fires in rollup_fires_per_borough(cur, _param(params, "city", "NYC"))]
+
+
+def health(cur, params):
+    cur.execute("SELECT City, Version FROM Data_Versions ORDER BY City")
+    return {"status": "ok", "data_versions": dict(cur.fetchall())}
+
+
+#the fires of one city in Fire_id order, STREAM_SIZE at a time
+def incident_chunks(cur, params):
+    city = _param(params, "city", "NYC")
+    since, until, limit = _int_param(params, "since"), _int_param(params, "until"), _int_param(params, "limit", -1)
+    sql = "SELECT Fire_id, Incident_id, Epoch, Minute_of_day, Response_time FROM Fire_Incidents WHERE City = ?"
+    values = [city]
+    if since is not None:
+        sql += " AND Epoch >= ?"
+        values.append(since)
+    if until is not None:
+        sql += " AND Epoch < ?"
+        values.append(until)
+    cur.execute(sql + " ORDER BY Fire_id LIMIT ?", values + [limit])
+    columns = [column[0] for column in cur.description]
+    while True:
+        rows = cur.fetchmany(STREAM_SIZE)
+        if not rows:
+            return
+        yield [dict(zip(columns, row)) for row in rows]
+
+
+# path -> function(cur, params) returning the answer, and whether it yields chunks to stream
+ROUTES = {
+    "/response-time": (response_time, False),
+    "/fires-by-borough": (fires_by_borough, False),
+    "/incidents": (incident_chunks, True),
+    "/health": (health, False),
+}
+
+
+def _ndjson(rows):
+    return "".join(json.dumps(row) + "\n" for row in rows).encode()
+
+
+class Service:
+    def __init__(self, db_name=DB_NAME, readers=READERS):
+        self.db_name = db_name
+        self.readers = ReaderPool(db_name, readers)
+        self.executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="service-query")
+        # streams read and encode on threads of their own, so short queries never queue behind them
+        self.stream_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="service-stream")
+
+    #runs fn(cur, params) on a pooled read-only connection in the query threads
+    async def query(self, fn, params):
+        def run():
+            with self.readers.cursor() as cur:
+                return fn(cur, params)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    async def send(self, writer, status, body, content_type="application/json", keep_alive=True, head=False):
+        headers = (
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(headers.encode() + (b"" if head else body))
+        await writer.drain()
+
+    #sends each chunk the generator yields as soon as it is read, with chunked transfer encoding
+    async def stream(self, writer, fn, params, keep_alive, head):
+        '''
+        a stream gets a read-only connection of its own instead of one from the pool, since a slow client
+        could otherwise keep pooled connections away from the short queries for as long as it reads
+        '''
+        loop = asyncio.get_running_loop()
+        conn = await loop.run_in_executor(self.stream_executor, lambda: connect(self.db_name, read_only=True))
+        # the generator is resumed on the stream threads, one step at a time, so the connection is never shared
+        chunks = fn(conn.cursor(), params)
+
+        def next_data():
+            chunk = next(chunks, None)
+            return None if chunk is None else _ndjson(chunk)
+
+        try:
+            data = await loop.run_in_executor(self.stream_executor, next_data)  # bad parameters fail before the headers
+            writer.write(
+                "HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+            )
+            if head:
+                return await writer.drain()
+            while data is not None:
+                writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                await writer.drain()  # waits for a slow client instead of buffering the whole table
+                data = await loop.run_in_executor(self.stream_executor, next_data)
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            await loop.run_in_executor(self.stream_executor, lambda: (chunks.close(), conn.close()))
+
+    async def handle(self, writer, method, target, keep_alive):
+        url = urlsplit(target)
+        params = parse_qs(url.query)
+        if url.path not in ROUTES:
+            return await self.send(writer, 404, json.dumps({"error": f"no such endpoint {url.path}"}).encode(), keep_alive=keep_alive)
+        if method not in ("GET", "HEAD"):
+            return await self.send(writer, 405, json.dumps({"error": "only GET and HEAD are supported"}).encode(), keep_alive=keep_alive)
+
+        fn, streamed = ROUTES[url.path]
+        head = method == "HEAD"
+        try:
+            if streamed:
+                return await self.stream(writer, fn, params, keep_alive, head)
+            answer = await self.query(fn, params)
+        except BadRequest as e:
+            return await self.send(writer, 400, json.dumps({"error": str(e)}).encode(), keep_alive=keep_alive)
+
+        if _param(params, "format") == "ndjson" and isinstance(answer, list):
+            await self.send(writer, 200, _ndjson(answer), "application/x-ndjson", keep_alive, head)
+        else:
+            await self.send(writer, 200, json.dumps(answer).encode(), keep_alive=keep_alive, head=head)
+
+    #serves one client connection, request after request while it stays open
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split()
+                except ValueError:
+                    await self.send(writer, 400, b'{"error": "malformed request line"}', keep_alive=False)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip().lower()
+                if headers.get("content-length"):
+                    await reader.readexactly(int(headers["content-length"]))  # no endpoint takes a body
+
+                connection = headers.get("connection", "")
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                try:
+                    await self.handle(writer, method, target, keep_alive)
+                except ConnectionError:
+                    break
+                except Exception as e:
+                    traceback.print_exc()
+                    await self.send(writer, 500, json.dumps({"error": str(e)}).encode(), keep_alive=False)
+                    break
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown()
+        self.stream_executor.shutdown()
+        self.readers.close()
+
+
+async def serve(host=HOST, port=PORT, db_name=DB_NAME, readers=READERS):
+    service = Service(db_name, readers)
+    server = await asyncio.start_server(service.connection, host, port, backlog=1024)
+    print(f"Serving {db_name} on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve response time statistics from fire_data.db over HTTP")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--db", default=DB_NAME, help="database file, relative paths are next to the scripts")
+    parser.add_argument("--readers", type=int, default=READERS, help="query threads, each with a read-only connection")
+    parser.add_argument("--cache-dir", help="also keep cached results in this folder, shared with other processes")
+    args = parser.parse_args()
+
+    if args.cache_dir:
+        cache.configure(directory=args.cache_dir)
+    try:
+        asyncio.run(serve(args.host, args.port, args.db, args.readers))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
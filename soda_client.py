@@ -0,0 +1,284 @@
+import codecs
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from pipeline import batched
+
+
+'''Shared helpers for pulling data out of the Socrata (SODA) APIs used by NYCfire_response.py and LA_firenew.py.
+    Without $limit/$offset the API only hands back its default first page (about 1000 rows), so we walk the
+    dataset page by page. After every page the caller has handled we save a checkpoint (the next offset) into
+    the Ingest_Checkpoints table of our database, so a run that crashes half way picks up where it stopped
+    instead of refetching everything.
+    Several pages are requested at the same time over one pooled requests.Session, throttled to a
+    configurable request rate, and 429/5xx answers are retried with jittered exponential backoff.
+    Responses are parsed as they download (iter_json_array), so the records of a page reach the caller a
+    few hundred at a time while the rest of it is still coming in, and the memory used stays the same
+    however big the pages are.
+    Rows, bytes, page latencies and retries are recorded in metrics.py.
+'''
+
+PAGE_SIZE = 1000
+WORKERS = 4  # page requests in flight at once
+READ_SIZE = 65536  # bytes read from a response at a time
+CHUNK_RECORDS = 500  # records handed to the caller at a time
+QUEUE_CHUNKS = 4  # chunks a page downloading ahead of the one being handled may buffer before it waits
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds, doubled on every retry
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+#one pooled session shared by every fetch so connections get reused
+def get_session(pool_size=WORKERS * 2):
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+class RateLimiter:
+    '''
+    spaces requests out so we never go above requests_per_second
+    shared between threads, None means no limit
+    '''
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+#GET with retries on rate limiting, server errors and dropped connections
+def get_with_retries(session, url, params, rate_limiter=None, max_retries=MAX_RETRIES, backoff=BACKOFF_BASE, stream=False):
+    '''
+    returns the response once it is not a 429/5xx
+    waits backoff * 2^attempt seconds (with jitter) between tries, or the Retry-After header if the API sends one
+    raises requests.exceptions.HTTPError if it still fails after max_retries
+    with stream=True the body is left to be read (and the response closed) by the caller
+    '''
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            response = session.get(url, params=params, stream=stream)
+        except requests.exceptions.ConnectionError:
+            if attempt >= max_retries:
+                raise
+            response = None
+
+        if response is not None and response.status_code not in RETRY_STATUS_CODES:
+            response.raise_for_status()
+            return response
+        if attempt >= max_retries:
+            response.raise_for_status()
+        metrics.count("http_retries", reason=str(response.status_code) if response is not None else "ConnectionError")
+        if response is not None:
+            response.close()  # gives the connection back to the pool without reading the error body
+
+        delay = backoff * (2 ** attempt)
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(random.uniform(delay / 2, delay))  # jitter so workers don't retry in lockstep
+        attempt += 1
+
+
+#parses a JSON array of objects from an iterable of byte chunks, yielding each object once it has arrived
+def iter_json_array(chunks):
+    '''
+    only the part of the array that has not been yielded yet is kept, at most one object plus one chunk
+    raises json.decoder.JSONDecodeError if the body is not a JSON array or stops half way
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()  # a character can be split between two chunks
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        position = 0
+        while True:
+            # skip the whitespace and commas between values
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise json.decoder.JSONDecodeError("expected a JSON array", buffer, position)
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.decoder.JSONDecodeError:
+                break  # the rest of this object has not arrived yet
+            yield record
+        buffer = buffer[position:]
+
+    buffer += text.decode(b"", final=True)
+    if buffer.strip():
+        decoder.raw_decode(buffer.strip())  # raises the real error for what is left
+    raise json.decoder.JSONDecodeError("response ended before the array was closed", buffer, len(buffer))
+
+
+#puts item on out unless stop is set first, then raises _Stopped
+def _put(out, item, stop):
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+    raise _Stopped()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def load_checkpoint(cur, source, query):
+    '''
+    returns the offset to start from for this source
+    a checkpoint saved for a different query (other filters or page size) is ignored
+    '''
+    cur.execute(
+        '''
+        SELECT Query, Next_offset FROM Ingest_Checkpoints WHERE Source = ?
+        ''',
+        (source,)
+    )
+    row = cur.fetchone()
+    if row is None or row[0] != query:
+        return 0
+    return row[1]
+
+
+def save_checkpoint(cur, conn, source, query, next_offset):
+    cur.execute(
+        '''
+        INSERT INTO Ingest_Checkpoints (Source, Query, Next_offset, Updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(Source) DO UPDATE SET
+            Query = excluded.Query,
+            Next_offset = excluded.Next_offset,
+            Updated_at = excluded.Updated_at
+        ''',
+        (source, query, next_offset, datetime.now().isoformat(timespec="seconds"))
+    )
+    conn.commit()
+
+
+#walks the dataset with $limit/$offset and yields its records a chunk (list of up to CHUNK_RECORDS) at a time
+def fetch_pages(base_url, params, source, cur, conn, page_size=PAGE_SIZE, workers=WORKERS, requests_per_second=None):
+    '''
+    yields chunks in order starting from the saved checkpoint for source
+    up to workers page requests run at the same time, each parsed as it downloads, but the chunks still come
+    out in offset order; a page ahead of the one being handled stops reading once it has QUEUE_CHUNKS ready
+    the checkpoint only moves forward once the caller asks for the next chunk,
+    so a chunk that was not fully handled gets fetched again on the next run
+    raises requests.exceptions.HTTPError if the API keeps returning an error
+    '''
+    # order by the row id so the offsets stay stable between runs
+    params = dict(params)
+    params.setdefault("$order", ":id")
+    query = json.dumps({"url": base_url, "params": params, "page_size": page_size}, sort_keys=True)
+
+    offset = load_checkpoint(cur, source, query)
+    if offset:
+        print(f"Resuming {source} from offset {offset}.")
+
+    session = get_session()
+    rate_limiter = RateLimiter(requests_per_second)
+    stop = threading.Event()
+    caller_labels = metrics.current_labels()  # the pool's threads don't have the caller's city
+
+    # streams one page into out as chunks of records, then None
+    # returns the page's size in bytes and how long the request took, so they are recorded on the caller's thread
+    # retries are counted as they happen (under the caller's labels), so a page that fails still has its retries
+    def fetch(page_offset, out):
+        page_params = dict(params)
+        page_params["$limit"] = page_size
+        page_params["$offset"] = page_offset
+        size = 0
+        try:
+            start = time.perf_counter()
+            with metrics.labels(**caller_labels):
+                response = get_with_retries(session, base_url, page_params, rate_limiter, stream=True)
+            elapsed = time.perf_counter() - start
+            with response:
+                def body():
+                    nonlocal size
+                    for data in response.iter_content(READ_SIZE):
+                        size += len(data)
+                        yield data
+
+                for records in batched(iter_json_array(body()), CHUNK_RECORDS):
+                    _put(out, records, stop)
+            return size, elapsed
+        finally:
+            try:
+                _put(out, None, stop)
+            except _Stopped:
+                pass
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = []  # (future, chunk queue) in offset order
+        next_offset = offset
+        try:
+            while True:
+                while len(in_flight) < workers:
+                    out = queue.Queue(maxsize=QUEUE_CHUNKS)
+                    in_flight.append((pool.submit(fetch, next_offset, out), out))
+                    next_offset += page_size
+
+                future, out = in_flight.pop(0)
+                received = 0
+                while True:
+                    records = out.get()
+                    if records is None:
+                        break
+                    metrics.count("rows_fetched", len(records))
+                    yield records
+
+                    received += len(records)
+                    offset += len(records)
+                    save_checkpoint(cur, conn, source, query, offset)
+
+                size, elapsed = future.result()  # raises what went wrong with the page
+                metrics.observe("page_fetch_seconds", elapsed)
+                metrics.count("bytes_downloaded", size)
+                if received < page_size:
+                    break  # last page
+        finally:
+            stop.set()  # pages still downloading stop at their next chunk
+            for future, _ in in_flight:
+                future.cancel()
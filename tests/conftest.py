@@ -0,0 +1,112 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+# the modules live at the top of the repo, next to the scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fire_db import connect, migrate
+
+
+'''Shared fixtures: a migrated database in a temporary folder, raw NYC records and a stand-in SODA server.'''
+
+
+@pytest.fixture
+def db(tmp_path):
+    conn = connect(str(tmp_path / "fire_data.db"))
+    cur = conn.cursor()
+    migrate(cur, conn)
+    yield cur, conn
+    conn.close()
+
+
+def _nyc_record(incident_id, seconds=300, borough="QUEENS", day="2021-06-01", hour=10, valid="Y"):
+    record = {
+        "incident_borough": borough,
+        "first_activation_datetime": f"{day}T{hour:02d}:15:00.000",
+        "incident_response_seconds_qy": str(seconds),
+        "valid_incident_rspns_time_indc": valid,
+    }
+    if incident_id is not None:
+        record["starfire_incident_id"] = str(incident_id)
+    return record
+
+
+#makes raw NYC records shaped like rows of the 8m42-w767 dataset, an incident_id of None leaves the ID out
+@pytest.fixture
+def nyc_record():
+    return _nyc_record
+
+
+#serves records the way a SODA endpoint does: a JSON array per $limit/$offset page
+class SodaServer:
+    '''
+    failures maps an offset to the statuses its first requests get before it is served, like {1000: [503]}
+    write_size cuts every body into writes of that many bytes, so the client reads it in pieces
+    requests lists the (offset, status) of every request, in the order they came in
+    '''
+
+    def __init__(self, records, failures=None, write_size=None):
+        self.records = records
+        self.failures = {offset: list(statuses) for offset, statuses in (failures or {}).items()}
+        self.write_size = write_size
+        self.requests = []
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                params = parse_qs(urlsplit(self.path).query)
+                offset = int(params.get("$offset", ["0"])[0])
+                limit = int(params.get("$limit", ["1000"])[0])
+                with server.lock:
+                    statuses = server.failures.get(offset)
+                    status = statuses.pop(0) if statuses else 200
+                    server.requests.append((offset, status))
+
+                body = b"[]" if status != 200 else json.dumps(server.records[offset:offset + limit], ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                step = server.write_size or len(body) or 1
+                for start in range(0, len(body), step):
+                    self.wfile.write(body[start:start + step])
+                    self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/resource/test.json"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def offsets(self, status=200):
+        return sorted(offset for offset, seen in self.requests if seen == status)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def soda_server():
+    servers = []
+
+    def start(records, failures=None, write_size=None):
+        server = SodaServer(records, failures, write_size)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+
+import pytest
+
+import cache
+from cache import QueryCache, bump_data_version, cached_query, data_version
+from fire_db import connect, migrate
+from aggregations import response_time_stats
+from NYCfire_response import NYCSource
+from ingest import insert_data_to_fires_table
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    cache.configure()
+    yield
+    cache.configure()
+
+
+calls = []
+
+
+@cached_query
+def borough_count(cur, city, borough=None):
+    calls.append((city, borough))
+    return [city, borough, len(calls)]
+
+
+def test_cached_until_the_city_changes(db):
+    cur, conn = db
+    calls.clear()
+    assert borough_count(cur, "NYC") == borough_count(cur, "NYC") == ["NYC", None, 1]
+    assert borough_count(cur, "NYC", "BRONX") == ["NYC", "BRONX", 2]  # other arguments, other entry
+
+    bump_data_version(cur, "LA")
+    conn.commit()
+    assert borough_count(cur, "NYC") == ["NYC", None, 1]  # another city's load changes nothing here
+
+    bump_data_version(cur, "NYC")
+    conn.commit()
+    assert data_version(cur, "NYC") == 1
+    assert borough_count(cur, "NYC") == ["NYC", None, 3]
+    assert len(calls) == 3
+
+
+def test_callers_get_their_own_copy(db):
+    cur, _ = db
+    first = borough_count(cur, "NYC")
+    first.append("changed by the caller")
+    assert borough_count(cur, "NYC") == first[:3]
+
+
+def test_databases_do_not_share_entries(db, tmp_path):
+    cur, _ = db
+    other = connect(str(tmp_path / "other.db"))
+    migrate(other.cursor(), other)
+    calls.clear()
+    borough_count(cur, "NYC")
+    borough_count(other.cursor(), "NYC")
+    assert len(calls) == 2
+    other.close()
+
+
+def test_a_load_invalidates_the_stats(db, nyc_record):
+    cur, conn = db
+    insert_data_to_fires_table(NYCSource(), cur, conn, [nyc_record(1, 120), nyc_record(2, 240)])
+    before = response_time_stats(cur, "NYC", "1h", quantiles=False)
+    assert [(row["count"], row["mean"]) for row in before] == [(2, 3.0)]
+
+    insert_data_to_fires_table(NYCSource(), cur, conn, [nyc_record(3, 600), nyc_record(1, 60)])  # one new, one updated
+    after = response_time_stats(cur, "NYC", "1h", quantiles=False)
+    assert [(row["count"], row["mean"]) for row in after] == [(3, 5.0)]
+
+
+def test_least_recently_used_entry_is_evicted():
+    query_cache = QueryCache(max_entries=2)
+    computed = []
+
+    def get(key):
+        return query_cache.get(key, lambda: computed.append(key) or key)
+
+    get("a"), get("b"), get("a"), get("c")  # b is the least recently used when c comes in
+    get("a"), get("c"), get("b")
+    assert computed == ["a", "b", "c", "b"]
+
+
+def test_disk_tier_is_shared_between_caches(tmp_path):
+    directory = str(tmp_path / "query_cache")
+    computed = []
+    QueryCache(directory=directory).get(("key", 1), lambda: computed.append(1) or {"rows": [1, 2]})
+    # a fresh process with an empty memory tier
+    assert QueryCache(directory=directory).get(("key", 1), lambda: computed.append(2)) == {"rows": [1, 2]}
+    assert computed == [1]
+    assert [name for name in os.listdir(directory) if not name.endswith(".pickle")] == []
+
+
+def test_disk_tier_keeps_at_most_max_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "MAX_FILES", 3)
+    query_cache = QueryCache(directory=str(tmp_path))
+    for i in range(5):
+        query_cache.get(i, lambda: i)
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_concurrent_misses_compute_once():
+    query_cache = QueryCache()
+    computed = []
+    start = threading.Barrier(10)
+    results = []
+
+    def slow():
+        computed.append(1)
+        time.sleep(0.2)
+        return "answer"
+
+    def ask():
+        start.wait()
+        results.append(query_cache.get("key", slow))
+
+    threads = [threading.Thread(target=ask) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert computed == [1]
+    assert results == ["answer"] * 10
+
+
+def test_failed_compute_is_not_cached():
+    query_cache = QueryCache()
+
+    def fail():
+        raise ValueError("query failed")
+
+    with pytest.raises(ValueError):
+        query_cache.get("key", fail)
+    assert query_cache.get("key", lambda: "answer") == "answer"
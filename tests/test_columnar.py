@@ -0,0 +1,76 @@
+import pytest
+
+from aggregations import response_time_stats as sql_response_time_stats
+from charts import city_charts
+from columnar import IncidentColumns, export_columns, fires_per_borough, response_time_stats
+from ingest import insert_data_to_fires_table, load_source
+from NYCfire_response import NYCSource, insert_data_to_neighborhood_table
+from raw_store import append_records
+
+
+def nyc_records(nyc_record):
+    return [nyc_record(i, 60 + i * 7, ["BRONX", "QUEENS"][i % 2], day=f"2021-06-0{i % 3 + 1}", hour=i % 24) for i in range(200)]
+
+
+@pytest.fixture
+def export(db, tmp_path, nyc_record):
+    cur, conn = db
+    records = nyc_records(nyc_record)
+    insert_data_to_fires_table(NYCSource(), cur, conn, records)
+    insert_data_to_neighborhood_table(cur, conn, records)
+    directory = str(tmp_path / "fire_columns")
+    export_columns(cur, directory)
+    return cur, directory
+
+
+def test_export_stats_match_sql(export):
+    cur, directory = export
+    assert fires_per_borough("NYC", directory) == [("BRONX", 100), ("QUEENS", 100)]
+    for bucket in ("1h", "dow"):
+        for borough in (None, "QUEENS"):
+            expected = sql_response_time_stats(cur, "NYC", bucket, borough, quantiles=False, exact=True)
+            stats = response_time_stats("NYC", bucket, borough, directory)
+            assert [(row["bucket"], row["count"]) for row in stats] == [(row["bucket"], row["count"]) for row in expected]
+            assert [row["mean"] for row in stats] == pytest.approx([row["mean"] for row in expected])
+
+
+def test_borough_without_fires_in_the_export_has_no_rows(export):
+    _, directory = export
+    assert response_time_stats("NYC", "2h", "RICHMOND / STATEN ISLAND", directory) == []
+
+
+@pytest.fixture
+def loaded(db, tmp_path, nyc_record):
+    cur, conn = db
+    source = NYCSource()
+    source.store = str(tmp_path / "NYC_data.ndjson")
+    append_records(source.store, nyc_records(nyc_record) + [nyc_record(200, valid="N"), nyc_record(None)], source.incident_id, cur, conn)
+    incidents = IncidentColumns("NYC")
+    assert load_source(source, cur, conn, incidents=incidents) == 200
+    return cur, incidents
+
+
+def test_a_load_fills_incident_columns_with_the_rows_it_writes(loaded):
+    cur, incidents = loaded
+    assert len(incidents) == 200
+    assert incidents.boroughs == ["BRONX", "QUEENS"]
+    part = incidents.parts()[0]
+    assert part["Borough"].dtype == "int8" and part["Minute_of_day"].dtype == "int16"
+    assert fires_per_borough("NYC", incidents=incidents) == [("BRONX", 100), ("QUEENS", 100)]
+    for bucket in ("15min", "2h", "month"):
+        for borough in (None, "BRONX"):
+            expected = sql_response_time_stats(cur, "NYC", bucket, borough, quantiles=False, exact=True)
+            stats = response_time_stats("NYC", bucket, borough, incidents=incidents)
+            assert [(row["bucket"], row["count"]) for row in stats] == [(row["bucket"], row["count"]) for row in expected]
+            assert [row["mean"] for row in stats] == pytest.approx([row["mean"] for row in expected])
+    assert response_time_stats("LA", "2h", incidents=incidents) == []
+
+
+def test_city_charts_from_incident_columns_match_the_rollups(loaded):
+    cur, incidents = loaded
+    expected = city_charts(cur, "NYC")
+    charts = city_charts(cur, "NYC", incidents)
+    assert [chart["name"] for chart in charts] == [chart["name"] for chart in expected]
+    for chart, other in zip(charts, expected):
+        assert chart["x"] == other["x"]
+        assert chart["y"] == pytest.approx(other["y"])
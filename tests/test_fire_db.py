@@ -0,0 +1,84 @@
+import sqlite3
+import threading
+
+import fire_db
+from fire_db import MIGRATIONS, connect, migrate
+
+
+def test_concurrent_migrations_apply_every_step_once(tmp_path, monkeypatch):
+    applied = []
+    lock = threading.Lock()
+
+    def counted(number, migration):
+        def step(cur):
+            migration(cur)
+            with lock:
+                applied.append(number)
+        return step
+
+    monkeypatch.setattr(fire_db, "MIGRATIONS", [counted(number, migration) for number, migration in enumerate(MIGRATIONS, start=1)])
+    path = str(tmp_path / "fire_data.db")
+    start = threading.Barrier(3)
+    errors = []
+
+    # three scripts starting on a new fire_data.db at the same moment
+    def run():
+        conn = connect(path)
+        start.wait()
+        try:
+            migrate(conn.cursor(), conn)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(applied) == list(range(1, len(MIGRATIONS) + 1))
+    conn = connect(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    conn.close()
+
+
+def test_up_to_date_database_does_not_wait_for_the_write_lock(db, tmp_path):
+    writer = sqlite3.connect(str(tmp_path / "fire_data.db"))
+    writer.execute("BEGIN IMMEDIATE")  # a load holding the write lock in another process
+    try:
+        conn = sqlite3.connect(str(tmp_path / "fire_data.db"), timeout=0.1)
+        migrate(conn.cursor(), conn)  # would raise "database is locked" if it asked for the lock
+        conn.close()
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def test_fires_stored_without_an_incident_id_are_deleted_with_their_links(tmp_path):
+    path = str(tmp_path / "fire_data.db")
+    # the tables the first versions of the scripts made, which never stored incident IDs
+    old = sqlite3.connect(path)
+    old.executescript(
+        '''
+        CREATE TABLE NYC_Fires (Fire_id INTEGER PRIMARY KEY, Date TEXT, Time TEXT, Response_time FLOAT);
+        CREATE TABLE LA_Fires (Fire_id INTEGER PRIMARY KEY, Time TEXT, Response_time FLOAT);
+        CREATE TABLE neighborhood_ID (Neighborhood_ID INTEGER PRIMARY KEY AUTOINCREMENT, Neighborhood TEXT);
+        CREATE TABLE Fire_Neighborhood_Relationship (Fire_ID INTEGER, Neighborhood_ID INTEGER);
+        INSERT INTO NYC_Fires VALUES (1, '2021-06-01', '10:15', 5.0), (2, '2021-06-01', '11:15', 6.0);
+        INSERT INTO LA_Fires VALUES (1, '10:00', 4.0), (2, '10:00', 4.0);
+        INSERT INTO neighborhood_ID (Neighborhood) VALUES ('BRONX');
+        INSERT INTO Fire_Neighborhood_Relationship VALUES (1, 1), (2, 1), (2, 1);
+        '''
+    )
+    old.close()
+
+    conn = connect(path)
+    cur = conn.cursor()
+    migrate(cur, conn)
+    for table in ("Fire_Incidents", "Fire_Neighborhood_Relationship", "Fire_Rollups"):
+        assert cur.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0, table
+    assert cur.execute("SELECT Neighborhood FROM neighborhood_ID").fetchall() == [("BRONX",)]
+    conn.close()
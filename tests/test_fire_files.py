@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from fire_files import write_atomic
+
+
+def test_write_atomic_replaces_the_file(tmp_path):
+    path = tmp_path / "reports" / "calculations.txt"
+    write_atomic(str(path), "old")
+    write_atomic(str(path), "new – ok\n")
+    assert path.read_text(encoding="utf-8") == "new – ok\n"
+    write_atomic(str(path), b"\x00bytes")
+    assert path.read_bytes() == b"\x00bytes"
+    assert os.listdir(path.parent) == ["calculations.txt"]  # no temporary file left behind
+    assert path.stat().st_mode & 0o777 == 0o644
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    path = tmp_path / "calculations.txt"
+    write_atomic(str(path), "old")
+    with pytest.raises(TypeError):
+        write_atomic(str(path), None)
+    assert path.read_text() == "old"
+    assert os.listdir(tmp_path) == ["calculations.txt"]
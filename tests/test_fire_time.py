@@ -0,0 +1,116 @@
+import random
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from fire_time import EPOCH_ORDINAL, clock_microseconds, clock_microseconds_array, day_numbers_array, epoch_from_date, parse_timestamp
+from LA_firenew import LASource
+from pipeline import transform_batch
+
+
+def test_parse_timestamp():
+    assert parse_timestamp("1970-01-01T00:00:00.000") == (0, 0)
+    assert parse_timestamp("2021-01-04T00:21:00.000") == (1609719660, 21)
+    assert parse_timestamp("2020-02-29T23:59:59.000") == (1583020799, 1439)
+
+
+def test_clock_array_matches_strptime_on_valid_times():
+    rng = random.Random(13)
+    texts = ["00:00:00.0", "23:59:59.999999", "12:00:00.000", "07:05:09.1"]
+    for _ in range(2000):
+        fraction = str(rng.randrange(10 ** 6)).zfill(6)[:rng.randint(1, 6)]
+        texts.append(f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}.{fraction}")
+
+    microseconds, ok = clock_microseconds_array(texts)
+    assert ok.all()
+    assert microseconds.tolist() == [clock_microseconds(text) for text in texts]
+
+
+@pytest.mark.parametrize("text", [
+    "24:00:00.000",  # no hour 24
+    "12:60:00.000",
+    "12:00:60.000",
+    "12:00:00",  # no fraction
+    "12:00:00.",
+    "12:00:00.1234567",  # more than 6 fraction digits
+    "12:00:00.12a",
+    "1:00:00.000",  # not zero padded
+    "12-00-00.000",
+    "",
+    "12:00:00.000 extra text",
+])
+def test_clock_array_rejects_what_it_cannot_read(text):
+    microseconds, ok = clock_microseconds_array(["06:30:00.500", text])
+    assert ok.tolist() == [True, False]
+    assert microseconds[0] == clock_microseconds("06:30:00.500")
+    assert microseconds[1] == 0
+
+
+def test_clock_array_raises_on_non_ascii():
+    with pytest.raises(UnicodeEncodeError):
+        clock_microseconds_array(["12:00:00.000", "12:00:00.０００"])
+
+
+def test_day_numbers_match_the_calendar():
+    days = [date(1, 1, 1), date(1899, 12, 31), date(1900, 2, 28), date(1970, 1, 1), date(2000, 2, 29), date(2024, 12, 31)]
+    day = date(2019, 12, 1)
+    while day < date(2025, 3, 1):
+        days.append(day)
+        day += timedelta(days=1)
+
+    texts = [day.isoformat() for day in days]
+    numbers, ok = day_numbers_array(texts)
+    assert ok.all()
+    assert numbers.tolist() == [day.toordinal() - EPOCH_ORDINAL for day in days]
+    assert (numbers * 86400).tolist() == [epoch_from_date(text, 0) for text in texts]
+
+
+def test_day_numbers_read_floating_timestamps():
+    numbers, ok = day_numbers_array(["2021-01-04T00:00:00.000"])
+    assert ok.tolist() == [True]
+    assert numbers[0] * 86400 == epoch_from_date("2021-01-04T00:00:00.000", 0)
+
+
+@pytest.mark.parametrize("text", ["2021-02-29", "1900-02-29", "2021-13-01", "2021-00-10", "2021-04-31", "2021-1-04", "2021/01/04", ""])
+def test_day_numbers_reject_bad_dates(text):
+    numbers, ok = day_numbers_array([text])
+    assert ok.tolist() == [False]
+    assert numbers.tolist() == [0]
+
+
+def la_record(i, created, on_scene, incident_date="2021-03-14T00:00:00.000"):
+    record = {"randomized_incident_number": str(i), "dispatch_sequence": "1",
+              "incident_creation_time_gmt": created, "on_scene_time_gmt": on_scene}
+    if incident_date is not None:
+        record["incident_date"] = incident_date
+    return record
+
+
+def test_la_batch_matches_one_record_at_a_time():
+    source = LASource()
+    batch = [
+        la_record(1, "10:00:00.000", "10:07:30.500"),
+        la_record(2, "23:58:00.000", "00:03:00.000"),  # on scene after midnight
+        la_record(3, "12:00:00.000", "12:05:00.000", incident_date=None),
+        la_record(4, "9:00:00.000", "09:06:00.000"),  # not zero padded, read by strptime instead
+        la_record(5, "12:00:00.000", "12:05:00.000", incident_date="2021-02-30"),  # no such day
+        la_record(6, "noon", "12:05:00.000"),
+        {"randomized_incident_number": "7", "incident_creation_time_gmt": "12:00:00.000"},  # never on scene
+    ]
+
+    skipped = {}
+    rows = source.transform_batch(batch, skipped)
+
+    # the slow path: strptime on every record
+    expected_skipped = {}
+    expected = transform_batch(batch, source.transform, expected_skipped, source.filtered_reason)
+    assert rows == expected
+    assert skipped == expected_skipped == {"ValueError": 2, "missing on scene time": 1}
+
+    by_id = {row["Incident_id"]: row for row in rows}
+    assert by_id["2:1"]["Response_time"] == 5.0
+    assert by_id["1:1"]["Response_time"] == round(450.5 / 60, 2)
+    assert by_id["3:1"]["Epoch"] is None
+    assert by_id["4:1"]["Minute_of_day"] == 540
+    assert np.int64(by_id["1:1"]["Epoch"]) == epoch_from_date("2021-03-14", 36000)
@@ -0,0 +1,115 @@
+import pytest
+
+import ingest
+from fire_db import connect, save_high_water_mark
+from ingest import MISSING_ID, fetch_source, ingest_all, insert_data_to_fires_table, load_source
+from NYCfire_response import NYCSource
+from raw_store import append_records
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = NYCSource()
+    source.store = str(tmp_path / "NYC_data.ndjson")
+    return source
+
+
+def fetch(source, cur, conn, records):
+    return append_records(source.store, records, source.incident_id, cur, conn)
+
+
+def counts(cur):
+    cur.execute("SELECT COUNT(*) FROM Fire_Incidents WHERE City = 'NYC'")
+    fires = cur.fetchone()[0]
+    cur.execute("SELECT SUM(N) FROM Fire_Rollups WHERE City = 'NYC'")
+    return fires, cur.fetchone()[0]
+
+
+def test_a_refresh_reads_only_what_was_appended(db, source, nyc_record):
+    cur, conn = db
+    fetch(source, cur, conn, [nyc_record(i) for i in range(3)])
+    assert load_source(source, cur, conn) == 3
+
+    # the records already loaded are never parsed again, so breaking them changes nothing
+    with open(source.store, "r+b") as f:
+        first_line = f.readline()
+        f.seek(0)
+        f.write(b"x" * (len(first_line) - 1))
+
+    fetch(source, cur, conn, [nyc_record(i) for i in range(3, 5)])
+    assert load_source(source, cur, conn) == 2
+    assert load_source(source, cur, conn) == 0
+    assert counts(cur) == (5, 5)
+
+
+def test_records_fetched_by_a_run_that_never_loaded_them_are_loaded_next(db, source, nyc_record):
+    cur, conn = db
+    fetch(source, cur, conn, [nyc_record(1)])
+    load_source(source, cur, conn)
+    fetch(source, cur, conn, [nyc_record(2), nyc_record(3)])  # that run stopped here
+    fetch(source, cur, conn, [nyc_record(4)])
+    assert load_source(source, cur, conn) == 3
+
+
+def test_rows_without_an_incident_id_are_left_out(db, source, nyc_record, capsys):
+    cur, conn = db
+    fetch(source, cur, conn, [nyc_record(1), nyc_record(None, seconds=120), nyc_record(None, seconds=180)])
+    assert load_source(source, cur, conn) == 1
+    assert f"{MISSING_ID}: skipped 2 NYC data entries." in capsys.readouterr().out
+
+    # loaded straight from records (the way benchmark.py does) they would otherwise be added on every load
+    insert_data_to_fires_table(source, cur, conn, [nyc_record(None, seconds=120)])
+    insert_data_to_fires_table(source, cur, conn, [nyc_record(None, seconds=120)])
+    assert counts(cur) == (1, 1)
+
+
+def test_store_loaded_before_offsets_were_kept_skips_records_before_the_mark(db, source, nyc_record):
+    cur, conn = db
+    fetch(source, cur, conn, [nyc_record(1, day="2021-05-01"), nyc_record(2, day="2021-06-01"), nyc_record(3, day="2021-07-01")])
+    save_high_water_mark(cur, conn, "NYC", "2021-06-01T00:00:00.000")
+    assert load_source(source, cur, conn) == 2
+
+    cur.execute("SELECT High_water_mark, Store, Store_offset FROM Ingest_State WHERE Source = 'NYC'")
+    high_water_mark, store, offset = cur.fetchone()
+    assert high_water_mark == "2021-07-01T10:15:00.000"
+    assert store == source.store
+    with open(source.store, "rb") as f:
+        assert offset == len(f.read())
+
+
+def test_reloading_an_incident_updates_it(db, source, nyc_record):
+    cur, conn = db
+    insert_data_to_fires_table(source, cur, conn, [nyc_record(1, seconds=120), nyc_record(2)])
+    insert_data_to_fires_table(source, cur, conn, [nyc_record(1, seconds=600)])
+    cur.execute("SELECT Response_time FROM Fire_Incidents WHERE Incident_id = '1'")
+    assert cur.fetchone()[0] == 10.0
+    assert counts(cur) == (2, 2)
+
+
+def test_a_fetch_loads_what_it_stored_before_the_download_ends(db, source, nyc_record, soda_server, monkeypatch):
+    cur, conn = db
+    monkeypatch.setattr(ingest, "LOAD_EVERY", 1000)
+    source.base_url = soda_server([nyc_record(i, day=f"2021-06-{i % 28 + 1:02d}") for i in range(2500)]).url
+    loads = []
+
+    fetch_source(source, cur, conn, lambda: loads.append(load_source(source, cur, conn)))
+    assert loads == [1000, 1000]
+    assert load_source(source, cur, conn) == 500
+    assert counts(cur) == (2500, 2500)
+
+
+def test_ingest_all_queues_loads_while_fetching(tmp_path, source, nyc_record, soda_server, monkeypatch):
+    monkeypatch.setattr(ingest, "LOAD_EVERY", 1000)
+    source.base_url = soda_server([nyc_record(i, day=f"2021-06-{i % 28 + 1:02d}") for i in range(2500)]).url
+    jobs = []
+    load_job = ingest._load_job
+    monkeypatch.setattr(ingest, "_load_job", lambda *args: jobs.append(load_job(*args)))
+    db_name = str(tmp_path / "fire_data.db")
+
+    assert ingest_all([source], db_name) == []
+    assert len(jobs) > 1
+    conn = connect(db_name)
+    try:
+        assert counts(conn.cursor()) == (2500, 2500)
+    finally:
+        conn.close()
@@ -0,0 +1,87 @@
+import gzip
+import os
+
+import pytest
+
+import fire_db
+from fire_files import SCRIPT_DIR, project_path
+import raw_store
+from raw_store import append_records, read_records
+
+
+def record_id(record):
+    return record.get("id")
+
+
+def test_relative_names_are_next_to_the_scripts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert project_path("NYC_data.ndjson") == os.path.join(SCRIPT_DIR, "NYC_data.ndjson")
+    assert project_path(str(tmp_path / "LA_data.ndjson")) == str(tmp_path / "LA_data.ndjson")
+    assert project_path(":memory:") == ":memory:"
+    assert fire_db.database_path("fire_data.db") == os.path.join(SCRIPT_DIR, "fire_data.db")
+
+
+def test_append_drops_records_already_stored(db, tmp_path):
+    cur, conn = db
+    store = str(tmp_path / "NYC_data.ndjson")
+    assert append_records(store, [{"id": "1"}, {"id": "2"}, {"id": "1"}], record_id, cur, conn) == 2
+    assert append_records(store, [{"id": "2"}, {"id": "3"}, {"note": "no id"}], record_id, cur, conn) == 2
+    assert append_records(store, [{"note": "no id"}], record_id, cur, conn) == 0  # same content, same ID
+    assert list(read_records(store)) == [{"id": "1"}, {"id": "2"}, {"id": "3"}, {"note": "no id"}]
+
+    cur.execute("SELECT DISTINCT Store FROM Raw_Store_IDs")
+    assert cur.fetchall() == [(store,)]
+
+
+def test_half_written_last_line_is_skipped(tmp_path):
+    store = tmp_path / "LA_data.ndjson"
+    store.write_text('{"id": "1"}\n{"id": "2"}\n{"id": ')
+    assert list(read_records(str(store))) == [{"id": "1"}, {"id": "2"}]
+
+
+@pytest.mark.parametrize("name", ["NYC_data.ndjson", "NYC_data.ndjson.gz"])
+def test_append_after_a_crash_mid_append_starts_on_a_whole_line(db, tmp_path, name):
+    cur, conn = db
+    store = str(tmp_path / name)
+    append_records(store, [{"id": "1"}], record_id, cur, conn)
+    with open(store, "ab") as f:
+        f.write(gzip.compress(b'{"id": "2"}\n')[:15] if name.endswith(".gz") else b'{"id": ')  # then the crash
+    conn.rollback()
+
+    append_records(store, [{"id": "2"}, {"id": "3"}], record_id, cur, conn)
+    assert list(read_records(store)) == [{"id": "1"}, {"id": "2"}, {"id": "3"}]
+
+
+def test_broken_line_inside_a_block_is_skipped(tmp_path, capsys):
+    store = tmp_path / "NYC_data.ndjson"
+    lines = ['{"id": "1"}\n', '{"id": {"id": "2"}\n', '{"id": "3"}\n']  # a half line with the next record glued on
+    store.write_text("".join(lines))
+    position = {}
+    assert list(read_records(str(store), 0, position)) == [{"id": "1"}, {"id": "3"}]
+    assert position["offset"] == len("".join(lines))
+    assert "Skipped 1 lines" in capsys.readouterr().out
+
+
+def test_records_read_in_blocks_keep_their_offsets(tmp_path, monkeypatch):
+    monkeypatch.setattr(raw_store, "READ_LINES", 3)
+    store = tmp_path / "NYC_data.ndjson"
+    lines = [f'{{"id": "{i}"}}\n' for i in range(7)]
+    store.write_text("".join(lines) + '{"id": ')
+    position = {}
+    offsets = [position["offset"] for _ in read_records(str(store), 0, position)]
+    assert offsets == [len("".join(lines[:i + 1])) for i in range(7)]
+    assert list(read_records(str(store), offsets[3])) == [{"id": str(i)} for i in range(4, 7)]
+
+
+@pytest.mark.parametrize("name", ["LA_data.ndjson", "LA_data.ndjson.gz"])
+def test_reading_from_an_offset_gives_only_later_records(db, tmp_path, name):
+    cur, conn = db
+    store = str(tmp_path / name)
+    append_records(store, [{"id": "1", "note": "café"}, {"id": "2"}], record_id, cur, conn)
+    position = {}
+    assert len(list(read_records(store, 0, position))) == 2
+
+    append_records(store, [{"id": "3"}], record_id, cur, conn)  # a new compressed block for .gz
+    later = {}
+    assert list(read_records(store, position["offset"], later)) == [{"id": "3"}]
+    assert list(read_records(store, later["offset"])) == []
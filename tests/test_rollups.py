@@ -0,0 +1,133 @@
+import random
+
+import numpy as np
+import pytest
+
+import fire_db
+from fire_db import MIGRATIONS, connect, migrate
+from ingest import insert_data_to_fires_table
+from LA_firenew import LASource
+from NYCfire_response import NYCSource, insert_data_to_neighborhood_table
+from rollups import RELATIVE_ACCURACY, ZERO_BIN, bin_value, merge_sketches, rebuild_rollups, rollup_response_stats, sketch_bins
+
+BOROUGHS = ["BRONX", "BROOKLYN", "QUEENS"]
+
+
+def la_record(i, created, on_scene):
+    return {"randomized_incident_number": str(i), "dispatch_sequence": "1", "incident_date": "2021-03-14T00:00:00.000",
+            "incident_creation_time_gmt": created, "on_scene_time_gmt": on_scene}
+
+
+def march(day):
+    return f"2021-03-{day:02d}"
+
+
+def random_nyc_records(nyc_record, rng, ids):
+    return [nyc_record(i, rng.randint(60, 900), BOROUGHS[i % len(BOROUGHS)], march(rng.randint(1, 3)), rng.randrange(4)) for i in ids]
+
+
+#every rollup key that has fires -> (N, Total, Total_sq, bins, counts)
+def rollups(cur):
+    cur.execute("SELECT City, Borough, Day, Hour, N, Total, Total_sq, Sketch FROM Fire_Rollups WHERE N != 0")
+    return {tuple(row[:4]): (row[4], row[5], row[6]) + merge_sketches(row[7]) for row in cur.fetchall()}
+
+
+def assert_same_rollups(kept, rebuilt):
+    assert kept.keys() == rebuilt.keys()
+    for key, (n, total, square, bins, counts) in kept.items():
+        assert (n, total, square) == pytest.approx(rebuilt[key][:3]), key
+        assert bins.tolist() == rebuilt[key][3].tolist(), key
+        assert counts.tolist() == rebuilt[key][4].tolist(), key
+
+
+def test_incremental_rollups_match_a_rebuild(db, nyc_record):
+    cur, conn = db
+    rng = random.Random(9)
+    nyc = NYCSource()
+    first = random_nyc_records(nyc_record, rng, range(300))
+    insert_data_to_fires_table(nyc, cur, conn, iter(first), batch_size=40)
+    insert_data_to_neighborhood_table(cur, conn, iter(first), 40)
+    insert_data_to_fires_table(LASource(), cur, conn, iter([la_record(1, "10:00:00.000", "10:06:00.000"),
+                                                             la_record(2, "23:58:00.000", "00:04:00.000")]))
+
+    reloaded = [
+        nyc_record(0, 61, "BRONX", march(1), 0),  # moved to another day and hour
+        dict(first[1], incident_response_seconds_qy="899"),  # same key, only the sums change
+        dict(first[2], incident_response_seconds_qy="120"),
+        dict(first[2], incident_response_seconds_qy="240"),  # twice in one batch, the last one counts
+    ] + random_nyc_records(nyc_record, rng, range(300, 360)) + [dict(record) for record in first[100:140]]  # loaded again unchanged
+    insert_data_to_fires_table(nyc, cur, conn, iter(reloaded), batch_size=25)
+    insert_data_to_neighborhood_table(cur, conn, iter(reloaded), 25)
+
+    cur.execute("SELECT Response_time FROM Fire_Incidents WHERE City = 'NYC' AND Incident_id = '2'")
+    assert cur.fetchone()[0] == 4.0
+    kept = rollups(cur)
+    assert sum(n for n, *_ in kept.values()) == 362
+
+    rebuild_rollups(cur)
+    conn.commit()
+    assert_same_rollups(kept, rollups(cur))
+
+
+def test_change_within_a_key_updates_the_sums(db, nyc_record):
+    cur, conn = db
+    nyc = NYCSource()
+    insert_data_to_fires_table(nyc, cur, conn, iter([nyc_record(1, 300, day=march(2), hour=5)]))
+    insert_data_to_fires_table(nyc, cur, conn, iter([nyc_record(1, 600, day=march(2), hour=5)]))
+
+    [(n, total, square, bins, counts)] = rollups(cur).values()
+    assert (n, total, square) == (1, pytest.approx(10.0), pytest.approx(100.0))
+    assert counts.tolist() == [1]
+    assert bin_value(int(bins[0])) == pytest.approx(10.0, rel=RELATIVE_ACCURACY)
+
+
+def test_quantiles_within_the_sketch_accuracy(db, nyc_record):
+    cur, conn = db
+    rng = random.Random(4)
+    records = [nyc_record(i, rng.randint(30, 1800), rng.choice(BOROUGHS), march(rng.randint(1, 28)), rng.randrange(24)) for i in range(3000)]
+    insert_data_to_fires_table(NYCSource(), cur, conn, iter(records))
+
+    by_hour = {}
+    for record in records:
+        by_hour.setdefault(int(record["first_activation_datetime"][11:13]), []).append(round(int(record["incident_response_seconds_qy"]) / 60, 2))
+
+    stats = rollup_response_stats(cur, "NYC", "1h")
+    assert [row["bucket"] for row in stats] == sorted(by_hour)
+    for row in stats:
+        values = sorted(by_hour[row["bucket"]])
+        assert row["count"] == len(values)
+        assert row["mean"] == pytest.approx(np.mean(values))
+        for name, q in (("median", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            nearest_rank = values[int(q * (len(values) - 1))]
+            assert row[name] == pytest.approx(nearest_rank, rel=RELATIVE_ACCURACY), (row["bucket"], name)
+
+
+def test_every_bin_is_within_the_accuracy_of_its_values():
+    values = np.round(np.arange(1, 200001) / 100, 2)  # 0.01 to 2000 minutes
+    bins = sketch_bins(values)
+    assert (bins[values <= 0.01] == ZERO_BIN).all()
+    assert (bins[values > 0.01] > ZERO_BIN).all()
+    represented = np.array([bin_value(int(bin_number)) for bin_number in bins])
+    above = values > 0.01
+    assert (np.abs(represented[above] - values[above]) <= RELATIVE_ACCURACY * values[above]).all()
+
+
+def test_migration_fills_the_rollups_from_the_fires_already_loaded(tmp_path, monkeypatch):
+    conn = connect(str(tmp_path / "fire_data.db"))
+    cur = conn.cursor()
+    monkeypatch.setattr(fire_db, "MIGRATIONS", MIGRATIONS[:2])  # Fire_Incidents, but no rollups yet
+    migrate(cur, conn)
+    cur.executemany(
+        "INSERT INTO Fire_Incidents (City, Incident_id, Epoch, Minute_of_day, Response_time) VALUES ('LA', ?, ?, ?, ?)",
+        [("1:1", 1615716000, 600, 6.0), ("2:1", 1615719600, 660, 12.5), ("3:1", None, 30, 3.0)]
+    )
+    conn.commit()
+
+    monkeypatch.setattr(fire_db, "MIGRATIONS", MIGRATIONS)
+    migrate(cur, conn)
+    assert [(row["bucket"], row["count"], row["median"]) for row in rollup_response_stats(cur, "LA", "1h")] == [
+        (0, 1, pytest.approx(3.0, rel=RELATIVE_ACCURACY)),
+        (10, 1, pytest.approx(6.0, rel=RELATIVE_ACCURACY)),
+        (11, 1, pytest.approx(12.5, rel=RELATIVE_ACCURACY)),
+    ]
+    conn.close()
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+
+import metrics
+import soda_client
+from soda_client import fetch_pages, load_checkpoint
+
+
+def make_records(count):
+    return [{"id": str(i), "borough": "BROOKLYN", "seconds": str(60 + i % 900)} for i in range(count)]
+
+
+def fetch_all(server, cur, conn, **options):
+    records = []
+    for chunk in fetch_pages(server.url, {}, "TEST", cur, conn, **options):
+        records.extend(chunk)
+    return records
+
+
+def test_walks_every_page_in_order(soda_server, db):
+    cur, conn = db
+    records = make_records(2500)
+    server = soda_server(records)
+
+    assert fetch_all(server, cur, conn, page_size=1000, workers=2) == records
+    # the short last page ends the walk, so nothing past it is asked for beyond the pages already in flight
+    assert server.offsets()[:3] == [0, 1000, 2000]
+    assert all(offset <= 3000 for offset in server.offsets())
+
+
+def test_chunks_are_at_most_chunk_records_long(soda_server, db):
+    cur, conn = db
+    server = soda_server(make_records(1200))
+
+    sizes = [len(chunk) for chunk in fetch_pages(server.url, {}, "TEST", cur, conn, page_size=1000)]
+    assert sizes == [soda_client.CHUNK_RECORDS, soda_client.CHUNK_RECORDS, 200]
+
+
+def test_retries_a_503(soda_server, db):
+    cur, conn = db
+    records = make_records(2500)
+    server = soda_server(records, failures={1000: [503]})
+
+    assert fetch_all(server, cur, conn, page_size=1000, workers=1) == records
+    assert server.offsets(503) == [1000]
+    assert server.offsets().count(1000) == 1
+
+
+def test_retries_are_counted_under_the_callers_labels(soda_server, db, tmp_path, monkeypatch):
+    cur, conn = db
+    server = soda_server(make_records(1500), failures={1000: [503, 503]})
+    monkeypatch.setattr(soda_client.time, "sleep", lambda seconds: None)
+
+    metrics.start_run("test")
+    with metrics.labels(city="NYC"):
+        fetch_all(server, cur, conn, page_size=1000, workers=2)
+    with open(metrics.finish_run(directory=str(tmp_path))) as f:
+        counters = json.load(f)["counters"]
+    assert [(counter["labels"], counter["value"]) for counter in counters if counter["name"] == "http_retries"] == [
+        ({"city": "NYC", "reason": "503"}, 2)
+    ]
+
+
+def test_gives_up_after_max_retries(soda_server, db, monkeypatch):
+    cur, conn = db
+    server = soda_server(make_records(10), failures={0: [500] * 3})
+    monkeypatch.setattr(soda_client.time, "sleep", lambda seconds: None)
+
+    with pytest.raises(soda_client.requests.exceptions.HTTPError) as error:
+        soda_client.get_with_retries(soda_client.get_session(), server.url, {"$offset": 0}, max_retries=2)
+    assert error.value.response.status_code == 500
+    assert server.offsets(500) == [0, 0, 0]
+
+
+def test_resumes_from_the_checkpoint(soda_server, db):
+    cur, conn = db
+    records = make_records(2500)
+    server = soda_server(records)
+
+    first = []
+    pages = fetch_pages(server.url, {}, "TEST", cur, conn, page_size=1000, workers=1)
+    for chunk in pages:
+        first.extend(chunk)
+        if len(first) == 1500:
+            break  # as if the run stopped while handling the third chunk
+    pages.close()
+
+    # the third chunk was never finished, so the checkpoint stays after the second one
+    query = json.dumps({"url": server.url, "params": {"$order": ":id"}, "page_size": 1000}, sort_keys=True)
+    assert load_checkpoint(cur, "TEST", query) == 1000
+
+    second = fetch_all(server, cur, conn, page_size=1000, workers=1)
+    assert second == records[1000:]
+    assert load_checkpoint(cur, "TEST", query) == 2500
+
+
+def test_checkpoint_of_another_query_is_ignored(soda_server, db):
+    cur, conn = db
+    records = make_records(1500)
+    server = soda_server(records)
+
+    fetch_all(server, cur, conn, page_size=1000)
+    # a different page size is a different query, so it starts over instead of skipping rows
+    assert fetch_all(server, cur, conn, page_size=500) == records
+
+
+# names with two, three and four byte UTF-8 characters, so splits can land inside a character
+UNICODE_RECORDS = [
+    {"id": "1", "borough": "Bronx", "note": "café – 火災"},
+    {"id": "2", "borough": "Queens", "note": "\U0001f692 [not, an] {array}", "nested": {"a": [1, 2.5, None]}},
+    {"id": "3", "borough": "Brooklyn", "note": "quote \" and \\ backslash"},
+]
+
+
+def test_parses_the_array_whatever_the_chunk_boundaries():
+    body = json.dumps(UNICODE_RECORDS, ensure_ascii=False, indent=1).encode("utf-8")
+    for split in range(1, len(body)):
+        assert list(soda_client.iter_json_array([body[:split], body[split:]])) == UNICODE_RECORDS
+    assert list(soda_client.iter_json_array(body[i:i + 1] for i in range(len(body)))) == UNICODE_RECORDS
+
+
+def test_empty_array_gives_no_records():
+    assert list(soda_client.iter_json_array([b" [ ", b"]\n"])) == []
+
+
+def test_body_that_is_not_an_array_raises():
+    with pytest.raises(json.decoder.JSONDecodeError):
+        list(soda_client.iter_json_array([b'{"error": true}']))
+
+
+def test_body_cut_off_raises_after_the_complete_records():
+    body = json.dumps(UNICODE_RECORDS).encode("utf-8")
+    parsed = []
+    with pytest.raises(json.decoder.JSONDecodeError):
+        for record in soda_client.iter_json_array([body[:-20]]):
+            parsed.append(record)
+    assert parsed == UNICODE_RECORDS[:2]
+
+
+def test_multibyte_characters_split_across_reads(soda_server, db, monkeypatch):
+    cur, conn = db
+    records = [dict(record, id=str(i)) for i in range(40) for record in UNICODE_RECORDS[i % 3:i % 3 + 1]]
+    # a few bytes per write and per read, so most characters above are cut in two somewhere
+    server = soda_server(records, write_size=5)
+    monkeypatch.setattr(soda_client, "READ_SIZE", 7)
+
+    assert fetch_all(server, cur, conn, page_size=25, workers=2) == records